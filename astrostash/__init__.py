@@ -1,10 +1,36 @@
-from .astrostash import SQLiteDB
-from .astrostash import sha256sum
-from .astrostash import needs_refresh
+import importlib
+
+
+# Public names and the submodule defining them, imported on first access
+# (PEP 562) so that importing astrostash does not load pandas
+_LAZY_ATTRS = {
+    "SQLiteDB": "astrostash.astrostash",
+    "sha256sum": "astrostash.astrostash",
+    "needs_refresh": "astrostash.astrostash",
+    "make_result_hash": "astrostash.astrostash",
+}
+
+# Submodules, also imported on first access
+_SUBMODULES = ("astrostash", "cache", "cli", "heasarc", "metrics", "tracing")
 
 
 __all__ = [
     "SQLiteDB",
     "sha256sum",
     "needs_refresh",
+    "make_result_hash",
 ]
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRS:
+        value = getattr(importlib.import_module(_LAZY_ATTRS[name]), name)
+        globals()[name] = value
+        return value
+    if name in _SUBMODULES:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()).union(__all__, _SUBMODULES))
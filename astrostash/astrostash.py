@@ -1,12 +1,142 @@
 import pathlib as pl
 import sqlite3
-from sqlalchemy import create_engine
+import numpy as np
 import pandas as pd
 from datetime import datetime
 import hashlib
 import json
-import astropy
+import re
+import sys
+import threading
+import time
+import warnings
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from importlib.resources import files
+from astrostash.cache import ResultCache
+from astrostash.metrics import MetricsRegistry
+from astrostash.tracing import SQLTracer, TracedConnection
+
+
+# Columns of stashed catalogs that are commonly filtered on, and so get
+# indexed when present
+INDEX_COLUMNS = ("ra", "dec", "time")
+
+# Position columns of stashed catalogs covered by the spatial index
+POSITION_COLUMNS = ("ra", "dec")
+
+# Version of make_result_hash stored with each response hash
+RESULT_HASH_VERSION = 2
+
+# How fetch_sync serves a stale (or missing) stashed query. blocking queries
+# the external service first, stale-while-revalidate returns the stale rows
+# and refreshes in the background, cache-only never queries the service
+REFRESH_POLICIES = ("blocking", "stale-while-revalidate", "cache-only")
+
+# Connection PRAGMA profiles for SQLiteDB. default keeps SQLite's rollback
+# journal, concurrent (WAL) lets many processes read while one writes, and
+# bulk trades durability on power loss for ingest speed.
+PRAGMA_PROFILES = {
+    "default": {
+        "busy_timeout": 5000,
+    },
+    "concurrent": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 30000,
+        "cache_size": -65536,
+        "temp_store": "MEMORY",
+    },
+    "bulk": {
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "busy_timeout": 30000,
+        "cache_size": -262144,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+    },
+}
+
+
+# Temporary tables used while stashing
+TEMP_TABLES = ("staged_rowids", "staged_rowhashes", "duplicate_rowids")
+
+# Column of stashed catalogs holding the hash of each row, used to find the
+# rows a response changes. It is left out when rows are read back.
+ROW_HASH_COLUMN = "_astrostash_rowhash"
+
+# PRAGMAs that can be configured on SQLiteDB connections
+CONNECTION_PRAGMAS = ("journal_mode", "busy_timeout", "synchronous",
+                      "cache_size", "mmap_size", "temp_store")
+
+
+@lru_cache(maxsize=None)
+def schema_migrations() -> tuple:
+    """
+    Gets the schema migration scripts in order, migrating a database to
+    version n runs the nth script. Version 1 is schema/base.sql, later
+    versions are schema/migrations/NNNN_<description>.sql numbered from 0002.
+
+    Returns
+    -------
+    tuple, SQL script of each schema version
+    """
+    schema = files('astrostash.schema')
+    scripts = [schema.joinpath('base.sql').read_text()]
+    migrations = schema.joinpath('migrations')
+    if migrations.is_dir():
+        names = sorted(path.name for path in migrations.iterdir()
+                       if path.name.endswith(".sql"))
+        for version, name in enumerate(names, start=2):
+            if re.fullmatch(rf"0*{version}_\w+\.sql", name) is None:
+                raise ValueError(f"Schema migration {name} is out of "
+                                 f"sequence, expected version {version}")
+            scripts.append(migrations.joinpath(name).read_text())
+    return tuple(scripts)
+
+
+@lru_cache(maxsize=None)
+def _schema_tables() -> frozenset:
+    """
+    Gets the names of the tables astrostash itself creates, as opposed to
+    stashed catalogs
+
+    Returns
+    -------
+    frozenset, table names
+    """
+    tables = set(TEMP_TABLES)
+    for script in schema_migrations():
+        tables.update(re.findall(
+            r"CREATE\s+(?:VIRTUAL\s+)?TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?"
+            r"(\w+)", script, re.IGNORECASE))
+    return frozenset(tables)
+
+
+def _split_sql(script: str) -> list:
+    """
+    Splits a SQL script into its statements, so they can be run inside a
+    transaction (unlike with executescript, which commits first)
+
+    Parameters
+    ----------
+    script: str, SQL script
+
+    Returns
+    -------
+    list, SQL statements
+    """
+    statements = []
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            statements.append(statement.strip())
+            statement = ""
+    if statement.strip() != "":
+        statements.append(statement.strip())
+    return statements
 
 
 def sha256sum(query_dict: dict) -> str:
@@ -19,8 +149,10 @@ def sha256sum(query_dict: dict) -> str:
     Returns:
     str: SHA-256 hash of the query
     """
+    # Nothing can be a SkyCoord unless astropy.coordinates was imported
+    coordinates = sys.modules.get("astropy.coordinates")
     for key, val in query_dict.items():
-        if isinstance(val, astropy.coordinates.SkyCoord):
+        if coordinates is not None and isinstance(val, coordinates.SkyCoord):
             query_dict = query_dict.copy()
             query_dict[key] = val.to_string()
     json_str = json.dumps(query_dict, sort_keys=True, ensure_ascii=True)
@@ -38,10 +170,210 @@ def make_result_hash(df: pd.DataFrame) -> str:
     Returns:
     str, SHA-256 hash or response dataframe
     """
+    hasher = ResultHasher()
+    hasher.update(df)
+    return hasher.hexdigest()
+
+
+def legacy_make_result_hash(df: pd.DataFrame) -> str:
+    """
+    Computes the SHA-256 hash of a response the way versions before hash
+    version 2 did, used to match responses stashed by those versions
+
+    Parameters:
+    df: pd.DataFrame, response table from an external query
+
+    Returns:
+    str, legacy SHA-256 hash or response dataframe
+    """
     pdhash = pd.util.hash_pandas_object(df).to_dict()
     return sha256sum(pdhash)
 
 
+class ResultHasher:
+    """
+    Incremental SHA-256 hash of a response table fed in chunks of rows. The
+    column names and dtypes are hashed once, followed by the raw uint64
+    buffer of the row hashes of each chunk.
+    """
+    def __init__(self):
+        self._hash = hashlib.sha256()
+        self._columns = None
+
+    def update(self, df: pd.DataFrame) -> None:
+        """
+        Adds a chunk of rows of the response to the hash
+
+        Parameters:
+        df: pd.DataFrame, next rows of the response table
+        """
+        if self._columns is None:
+            self._columns = [[str(col), str(dtype)]
+                             for col, dtype in df.dtypes.items()]
+            self._hash.update(json.dumps(self._columns).encode("utf-8"))
+        rows = pd.util.hash_pandas_object(df, index=False)
+        self._hash.update(rows.to_numpy().tobytes())
+
+    def hexdigest(self) -> str:
+        """
+        Returns:
+        str, SHA-256 hash of all the rows added so far
+        """
+        return self._hash.hexdigest()
+
+
+def row_hashes(df: pd.DataFrame) -> np.ndarray:
+    """
+    Hashes each row of a frame from its values, column names and dtypes
+    (like make_result_hash), so rows can be compared with stashed rows
+    without comparing every column
+
+    Parameters:
+    df: pd.DataFrame, response table
+
+    Returns:
+    np.ndarray, int64 hash of each row
+    """
+    columns = [[str(col), str(dtype)] for col, dtype in df.dtypes.items()]
+    header = hashlib.sha256(json.dumps(columns).encode("utf-8")).digest()
+    rows = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    return (rows ^ np.frombuffer(header[:8], dtype=np.uint64)).view(np.int64)
+
+
+def _quote(name: str) -> str:
+    """
+    Quotes an identifier (table, column or index name) for use in SQL
+
+    Parameters:
+    name: str, identifier to quote
+
+    Returns:
+    str, double quoted identifier
+    """
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _sql_type(column: pd.Series) -> str:
+    """
+    Gets the SQLite column type to use for a pandas column
+
+    Parameters:
+    column: pd.Series, column of a response table
+
+    Returns:
+    str, SQLite type name
+    """
+    kind = column.dtype.kind
+    if kind in "biu":
+        return "INTEGER"
+    elif kind == "f":
+        return "REAL"
+    elif kind == "M":
+        return "TIMESTAMP"
+    return "TEXT"
+
+
+def _to_records(df: pd.DataFrame) -> list:
+    """
+    Converts a frame into a list of row tuples of python values that
+    sqlite3 can bind (missing values become None)
+
+    Parameters:
+    df: pd.DataFrame, response table
+
+    Returns:
+    list, one tuple per row of the frame
+    """
+    df = df.copy()
+    for col in df.columns:
+        if df[col].dtype.kind == "M":
+            df[col] = df[col].dt.strftime("%Y-%m-%d %H:%M:%S.%f")
+    df = df.astype(object).where(df.notna(), None)
+    return list(df.itertuples(index=False, name=None))
+
+
+def _today() -> str:
+    """
+    Gets today's date in the format used for last_refreshed dates
+
+    Returns:
+    str, date in format YYYY-MM-DD
+    """
+    return datetime.today().strftime('%Y-%m-%d')
+
+
+def _unit_vectors(ra, dec) -> np.ndarray:
+    """
+    Converts sky positions to unit vectors
+
+    Parameters
+    ----------
+    ra: array like, right ascensions in degrees
+
+    dec: array like, declinations in degrees
+
+    Returns
+    -------
+    np.ndarray, (n, 3) array of x, y, z
+    """
+    ra = np.radians(np.asarray(ra, dtype=float))
+    dec = np.radians(np.asarray(dec, dtype=float))
+    return np.column_stack((np.cos(dec) * np.cos(ra),
+                            np.cos(dec) * np.sin(ra),
+                            np.sin(dec)))
+
+
+def _separation(ra1, dec1, ra2, dec2) -> np.ndarray:
+    """
+    Angular separation between sky positions
+
+    Parameters
+    ----------
+    ra1, dec1: array like, first positions in degrees
+
+    ra2, dec2: array like, second positions in degrees
+
+    Returns
+    -------
+    np.ndarray, separations in degrees
+    """
+    chord = np.linalg.norm(_unit_vectors(ra1, dec1) - _unit_vectors(ra2, dec2),
+                           axis=1)
+    return np.degrees(2 * np.arcsin(np.clip(chord / 2, 0, 1)))
+
+
+def _encode_param(obj):
+    """
+    json default hook for query parameters, so calls can be stored and
+    replayed. SkyCoords and Quantities are stored by value.
+    """
+    if hasattr(obj, "frame") and hasattr(obj, "spherical"):
+        spherical = obj.spherical
+        return {"__skycoord__": [float(spherical.lon.deg),
+                                 float(spherical.lat.deg),
+                                 obj.frame.name]}
+    if hasattr(obj, "unit") and hasattr(obj, "value"):
+        return {"__quantity__": [float(obj.value), obj.unit.to_string()]}
+    if hasattr(obj, "item"):
+        return obj.item()
+    raise TypeError(f"{type(obj).__name__} query parameters can not be "
+                    "stored")
+
+
+def _decode_param(obj: dict):
+    """
+    json object hook reversing _encode_param
+    """
+    if "__skycoord__" in obj:
+        from astropy.coordinates import SkyCoord
+        lon, lat, frame = obj["__skycoord__"]
+        return SkyCoord(lon, lat, unit="deg", frame=frame)
+    if "__quantity__" in obj:
+        from astropy.units import Quantity
+        return Quantity(*obj["__quantity__"])
+    return obj
+
+
 def needs_refresh(last_refreshed: str, refresh_rate: int) -> bool:
     """
     Determins a if a refresh is needed based off of the set refresh rate and
@@ -64,13 +396,148 @@ def needs_refresh(last_refreshed: str, refresh_rate: int) -> bool:
 
 
 class SQLiteDB:
-    def __init__(self, db_name=None):
+    def __init__(self, db_name=None, cache_entries: int = 128,
+                 cache_bytes: int = 64 * 1024 ** 2,
+                 profile: str = "default", pragmas: dict | None = None,
+                 retries: int = 5, thread_safe: bool = False,
+                 refresh_policy: str = "blocking",
+                 refresh_workers: int = 4,
+                 metrics: MetricsRegistry | None = None):
+        """
+        Parameters
+        ----------
+        db_name: str or None, optional, path to the database,
+                                        default astrostash.db
+
+        cache_entries: int, optional, maximum number of query results kept
+                                      in memory, 0 disables the result cache
+
+        cache_bytes: int, optional, maximum memory usage in bytes of the
+                                    query results kept in memory
+
+        profile: str, optional, connection PRAGMA profile from
+                                PRAGMA_PROFILES (default, concurrent or bulk)
+
+        pragmas: dict or None, optional, PRAGMA values overriding the profile
+                                         (journal_mode, busy_timeout,
+                                         synchronous, cache_size, mmap_size,
+                                         temp_store)
+
+        retries: int, optional, number of times to retry starting or
+                                committing a write transaction when the
+                                database is still locked after busy_timeout
+
+        thread_safe: bool, optional, allow the instance to be shared between
+                                     threads, each thread reads through its
+                                     own connection while writes go through
+                                     a single connection one transaction at a
+                                     time (default False)
+
+        refresh_policy: str, optional, default refresh policy of fetch_sync,
+                                       one of REFRESH_POLICIES
+
+        refresh_workers: int, optional, maximum number of stale queries
+                                        refreshed in the background at once
+
+        metrics: MetricsRegistry or None, optional, registry recording the
+                 phase timings, counts and outcome of each fetch_sync, a
+                 new registry if None
+        """
+        if profile not in PRAGMA_PROFILES:
+            raise ValueError(f"{profile} is not one of "
+                             f"{list(PRAGMA_PROFILES)}")
         self.db_name = self._get_db_file(db_name)
-        self.conn = sqlite3.connect(self.db_name)
-        self.aconn = create_engine(f"sqlite:///{self.db_name}")
-        self.cursor = self.conn.cursor()
+        self.refresh_policy = self._check_refresh_policy(refresh_policy)
+        self.refresh_workers = refresh_workers
+        self._refreshes = {}
+        self._failed_refreshes = []
+        self._refresh_lock = threading.Lock()
+        self._refresh_executor = None
+        self._refresh_db = None
+        self.pragmas = {**PRAGMA_PROFILES[profile], **(pragmas or {})}
+        self.retries = retries
+        self.result_cache = ResultCache(cache_entries, cache_bytes)
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.tracer = None
+        self._table_versions = {}
+        self.thread_safe = thread_safe
+        self._local = threading.local()
+        self._write_lock = threading.RLock()
+        self._readers = []
+        # Bumped when the connections have to be reopened, see start_tracing
+        self._connections_version = 0
+        self._writer_conn = self._connect()
+        self._writer_cursor = self._writer_conn.cursor()
+        self._engine = None
+        self._footprint_lookups = 0
+        self._footprint_hits = 0
+        self._refresh_count = 0
+        self._unchanged_refreshes = 0
         self._create_schema()
 
+    @property
+    def aconn(self):
+        """
+        SQLAlchemy engine for the database, only created (and SQLAlchemy
+        only imported) on first use. astrostash itself reads and writes
+        through conn.
+        """
+        if self._engine is None:
+            from sqlalchemy import create_engine
+            self._engine = create_engine(f"sqlite:///{self.db_name}")
+        return self._engine
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """
+        Connection used by the calling thread. Without thread_safe this is
+        always the one connection, with it this is the writer connection
+        inside transaction() and the thread's own read connection otherwise.
+        """
+        if self.thread_safe is False or self._transaction_depth > 0:
+            return self._writer_conn
+        return self._reader()[0]
+
+    @property
+    def cursor(self) -> sqlite3.Cursor:
+        """
+        Cursor of the connection used by the calling thread
+        """
+        if self.thread_safe is False or self._transaction_depth > 0:
+            return self._writer_cursor
+        return self._reader()[1]
+
+    @property
+    def _transaction_depth(self) -> int:
+        return getattr(self._local, "depth", 0)
+
+    @_transaction_depth.setter
+    def _transaction_depth(self, depth: int) -> None:
+        self._local.depth = depth
+
+    def _reader(self) -> tuple:
+        """
+        Gets, opening it on first use or once the connections have to be
+        reopened, the calling thread's read connection
+
+        Returns
+        -------
+        tuple, connection, cursor and version of the connections
+        """
+        reader = getattr(self._local, "reader", None)
+        if reader is not None and reader[2] != self._connections_version:
+            with self._write_lock:
+                self._readers.remove(reader[0])
+            reader[0].close()
+            reader = None
+        if reader is None:
+            conn = self._connect()
+            reader = (conn, conn.cursor(), self._connections_version)
+            self._local.reader = reader
+            with self._write_lock:
+                self._readers.append(conn)
+        return reader
+
     def _get_db_file(self, dbpath=None) -> pl.Path:
         """
         Gets or makes a path object for a sqlite database
@@ -83,12 +550,142 @@ class SQLiteDB:
         else:
             return pl.Path(dbpath).resolve()
 
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Opens a connection to the database and applies the PRAGMA settings
+
+        Returns
+        -------
+        sqlite3.Connection, connection to the database
+        """
+        unknown = set(self.pragmas).difference(CONNECTION_PRAGMAS)
+        if len(unknown) > 0:
+            raise ValueError(f"{sorted(unknown)} are not supported pragmas")
+        timeout = self.pragmas.get("busy_timeout", 5000) / 1000
+        # Statements are only routed through the traced cursors while
+        # tracing
+        factory = sqlite3.Connection if self.tracer is None \
+            else TracedConnection
+        # In thread_safe mode connections are only closed from another thread
+        conn = sqlite3.connect(self.db_name, timeout=timeout,
+                               check_same_thread=not self.thread_safe,
+                               factory=factory)
+        if self.tracer is not None:
+            conn.tracer = self.tracer
+            conn.set_trace_callback(self.tracer.trace_callback)
+        # journal_mode goes first as it may need to wait for other
+        # connections, which the busy timeout set by connect allows
+        for name in sorted(self.pragmas, key=lambda n: n != "journal_mode"):
+            self._retry_locked(conn.execute,
+                               f"PRAGMA {name} = {self.pragmas[name]};")
+        return conn
+
+    def get_pragmas(self) -> dict:
+        """
+        Gets the current values of the connection PRAGMA settings
+
+        Returns
+        -------
+        dict, value of each of the supported pragmas
+        """
+        return {name: self.conn.execute(f"PRAGMA {name};").fetchone()[0]
+                for name in CONNECTION_PRAGMAS}
+
+    def _retry_locked(self, func, *args):
+        """
+        Calls a function, retrying with exponential backoff while it fails
+        because the database is locked by another connection
+
+        Parameters
+        ----------
+        func: function, function to call
+
+        *args: args to be passed into func
+
+        Returns
+        -------
+        return value of func
+        """
+        delay = 0.05
+        for attempt in range(self.retries + 1):
+            try:
+                return func(*args)
+            except sqlite3.OperationalError as exc:
+                locked = "locked" in str(exc) or "busy" in str(exc)
+                if locked is False or attempt == self.retries:
+                    raise
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+    def get_schema_version(self) -> int:
+        """
+        Gets the schema version of the database, stored in PRAGMA
+        user_version
+
+        Returns
+        -------
+        int, schema version, 0 for a new or unversioned database
+        """
+        return self.conn.execute("PRAGMA user_version;").fetchone()[0]
+
     def _create_schema(self):
         """
-        Creates initial schema for the database
+        Creates the schema of the database or migrates it to the latest
+        version, which is skipped when PRAGMA user_version already matches
+        """
+        migrations = schema_migrations()
+        if self.get_schema_version() >= len(migrations):
+            return
+        for version, script in enumerate(migrations, start=1):
+            with self.transaction():
+                # Another connection may have migrated while this one waited
+                # for the write lock
+                if self.get_schema_version() >= version:
+                    continue
+                for statement in _split_sql(script):
+                    self.cursor.execute(statement)
+                if version == 1:
+                    self._upgrade_unversioned()
+                self.cursor.execute(f"PRAGMA user_version = {version};")
+
+    def _upgrade_unversioned(self) -> None:
+        """
+        Brings a database created before the schema was versioned up to
+        version 1, base.sql only creates what is missing
+        """
+        if "hash_version" not in self.get_columns("responses"):
+            # Responses stashed before hashes were versioned used the legacy
+            # hash
+            self.cursor.execute("""ALTER TABLE responses
+                                   ADD COLUMN hash_version INTEGER
+                                   NOT NULL DEFAULT 1;""")
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups all writes made inside the with block into a single
+        transaction, which is committed when the outermost block exits and
+        rolled back if an exception is raised. Nested blocks join the
+        enclosing transaction. Transactions from different threads are
+        serialized on the writer connection.
         """
-        schema = files('astrostash.schema').joinpath('base.sql').read_text()
-        self.cursor.executescript(schema)
+        with self._write_lock:
+            conn = self._writer_conn
+            if self._transaction_depth == 0 and not conn.in_transaction:
+                # Take the write lock up front, so another connection's write
+                # cannot make this transaction fail part way through
+                self._retry_locked(conn.execute, "BEGIN IMMEDIATE;")
+            self._transaction_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._transaction_depth -= 1
+                if self._transaction_depth == 0:
+                    conn.rollback()
+                raise
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                self._retry_locked(conn.commit)
 
     def get_query(self, query_hash: str) -> pd.DataFrame:
         """
@@ -107,6 +704,23 @@ class SQLiteDB:
                                params={"query_hash": query_hash})
         return stashref
 
+    def get_queries(self, query_hashes: list) -> pd.DataFrame:
+        """
+        Gets the query records (if they exist) of many query hashes at once
+
+        Parameters:
+        query_hashes: list, unique sha256 hashes of the queries
+
+        Returns:
+        pd.DataFrame, reference info for the queries that have been
+                      requested before
+        """
+        return pd.read_sql(
+            """SELECT * FROM queries
+               WHERE hash IN (SELECT value FROM json_each(:hashes));""",
+            self.conn,
+            params={"hashes": json.dumps(list(query_hashes))})
+
     def get_refresh_rate(self, qid: int) -> int | None:
         """
         Gets the refresh rate (in days) associated with a query id (if exists)
@@ -175,22 +789,23 @@ class SQLiteDB:
         Returns:
         int, id for the specific query
         """
-        self.cursor.execute("""
-            INSERT INTO queries (
-                hash,
-                last_refreshed,
-                refresh_rate
-            )
-            VALUES (
-                :hash,
-                :last_refreshed,
-                :refresh_rate
-            );""", {"hash": query_hash,
-                    "last_refreshed": datetime.today().strftime('%Y-%m-%d'),
-                    "refresh_rate": refresh_rate}
-            )
-        self.conn.commit()
-        return self.cursor.lastrowid
+        with self.transaction():
+            self.cursor.execute("""
+                INSERT INTO queries (
+                    hash,
+                    last_refreshed,
+                    refresh_rate
+                )
+                VALUES (
+                    :hash,
+                    :last_refreshed,
+                    :refresh_rate
+                );""", {"hash": query_hash,
+                        "last_refreshed": _today(),
+                        "refresh_rate": refresh_rate}
+                )
+            lastrowid = self.cursor.lastrowid
+        return lastrowid
 
     def _get_response_id(self, rhash: str) -> int | None:
         """
@@ -218,11 +833,13 @@ class SQLiteDB:
         Returns:
         int, id associated with the response after insertion
         """
-        self.cursor.execute(
-            """INSERT INTO responses (hash) VALUES (:hash);""",
-            {"hash": response_hash})
-        self.conn.commit()
-        return self.cursor.lastrowid
+        with self.transaction():
+            self.cursor.execute(
+                """INSERT INTO responses (hash, hash_version)
+                   VALUES (:hash, :hash_version);""",
+                {"hash": response_hash, "hash_version": RESULT_HASH_VERSION})
+            lastrowid = self.cursor.lastrowid
+        return lastrowid
 
     def insert_query_response_pivot(self, qid: int, rid: int) -> None:
         """
@@ -233,17 +850,17 @@ class SQLiteDB:
 
         rid: int, response id from the responses table
         """
-        self.cursor.execute(
-            """ INSERT OR IGNORE INTO query_response_pivot (
-                queryid,
-                responseid
-            )
-            VALUES (
-                :qid,
-                :rid
-            );""",
-            {"qid": qid, "rid": rid})
-        self.conn.commit()
+        with self.transaction():
+            self.cursor.execute(
+                """ INSERT OR IGNORE INTO query_response_pivot (
+                    queryid,
+                    responseid
+                )
+                VALUES (
+                    :qid,
+                    :rid
+                );""",
+                {"qid": qid, "rid": rid})
 
     def _check_query_response_link(self, qid: int, rid: int) -> int:
         """
@@ -277,17 +894,85 @@ class SQLiteDB:
         rowid: str, id associated with a unique row (obsid, name, doi)
                     of an external table (nicermastr, heasarc_catalog_list)
         """
+        with self.transaction():
+            self.cursor.execute(
+                """ INSERT INTO response_rowid_pivot (
+                    responseid,
+                    rowid
+                )
+                VALUES (
+                    :responseid,
+                    :rowid
+                );""",
+                {"responseid": responseid, "rowid": rowid})
+
+    def insert_response_rowid_pivots(self, responseid: int,
+                                     rowids) -> None:
+        """
+        Inserts many response id and generic rowid pairs in a single batch
+
+        Parameters:
+        responseid: int, response id from responses table
+
+        rowids: iterable, ids associated with unique rows (obsid, name, doi)
+                          of an external table
+        """
+        with self.transaction():
+            self.cursor.executemany(
+                """ INSERT OR IGNORE INTO response_rowid_pivot (
+                    responseid,
+                    rowid
+                )
+                VALUES (
+                    ?,
+                    ?
+                );""",
+                ((responseid, str(rowid)) for rowid in rowids))
+
+    def _migrate_legacy_response(self, df: pd.DataFrame, qid: int,
+                                 response_hash: str) -> tuple | None:
+        """
+        Matches a response against the legacy response hashes (made by an
+        older version of make_result_hash) of the responses the query is
+        linked to, and if it is one of them, upgrades its stored hash to the
+        current version so the response is recognised from then on. The
+        legacy hash is only computed for queries linked to a legacy response.
+
+        Parameters
+        ----------
+        df: pd.DataFrame, response table
+
+        qid: int, query id
+
+        response_hash: str, current version hash of the response
+
+        Returns
+        -------
+        tuple or None, (id,) of the matching response, None if not found
+        """
         self.cursor.execute(
-            """ INSERT INTO response_rowid_pivot (
-                responseid,
-                rowid
-            )
-            VALUES (
-                :responseid,
-                :rowid
-            );""",
-            {"responseid": responseid, "rowid": rowid})
-        self.conn.commit()
+            """SELECT r.id, r.hash FROM query_response_pivot qrp
+               INNER JOIN responses r ON r.id = qrp.responseid
+               WHERE qrp.queryid = :qid
+                 AND r.hash_version < :hash_version;""",
+            {"qid": qid, "hash_version": RESULT_HASH_VERSION})
+        legacy = dict(self.cursor.fetchall())
+        if len(legacy) == 0:
+            return None
+        legacy_hash = legacy_make_result_hash(df)
+        rid = next((rid for rid, rhash in legacy.items()
+                    if rhash == legacy_hash), None)
+        if rid is None:
+            return None
+        with self.transaction():
+            self.cursor.execute(
+                """UPDATE responses
+                   SET hash = :hash, hash_version = :hash_version
+                   WHERE id = :id;""",
+                {"hash": response_hash,
+                 "hash_version": RESULT_HASH_VERSION,
+                 "id": rid})
+        return (rid,)
 
     def _ingest_response_and_links(self, df: pd.DataFrame, qid: int,
                                    idcol: str) -> None:
@@ -302,16 +987,65 @@ class SQLiteDB:
         qid: int, query id
 
         idcol: str, name of id column from response table
+
+        Returns
+        -------
+        bool, False if the query was already linked to the same response,
+              i.e. the response is unchanged, otherwise True
         """
         response_hash = make_result_hash(df)
-        rid = self._get_response_id(response_hash)
-        if rid is None:
-            rid = self.insert_response(response_hash)
+        with self.transaction():
+            rid = self._get_response_id(response_hash)
+            if rid is None:
+                rid = self._migrate_legacy_response(df, qid, response_hash)
+            if rid is None:
+                rid = self.insert_response(response_hash)
+                self.insert_response_rowid_pivots(rid, df[idcol].values)
+                self._relink_query(qid, rid)
+            elif self._check_query_response_link(qid, rid[0]) == 0:
+                self._relink_query(qid, rid[0])
+            else:
+                return False
+        return True
+
+    def _relink_query(self, qid: int, rid: int) -> int:
+        """
+        Links a query to its latest response, unlinking the responses it
+        was linked to before, so rows dropped from the response are no
+        longer returned for the query
+
+        Parameters
+        ----------
+        qid: int, query id
+
+        rid: int, response id
+
+        Returns
+        -------
+        int, number of rows linked to the query before, but not in the
+             response (deleted)
+        """
+        with self.transaction():
+            self.cursor.execute(
+                """SELECT COUNT(DISTINCT old.rowid)
+                   FROM response_rowid_pivot old
+                   INNER JOIN query_response_pivot qrp
+                   ON qrp.responseid = old.responseid
+                   WHERE qrp.queryid = :qid AND qrp.responseid != :rid
+                     AND NOT EXISTS (
+                         SELECT 1 FROM response_rowid_pivot new
+                         WHERE new.responseid = :rid
+                           AND new.rowid = old.rowid
+                     );""",
+                {"qid": qid, "rid": rid})
+            deleted = self.cursor.fetchone()[0]
+            self.cursor.execute(
+                """DELETE FROM query_response_pivot
+                   WHERE queryid = :qid AND responseid != :rid;""",
+                {"qid": qid, "rid": rid})
             self.insert_query_response_pivot(qid, rid)
-            for rowid in df[idcol].values:
-                self.insert_response_rowid_pivot(rid, rowid)
-        elif self._check_query_response_link(qid, rid[0]) == 0:
-            self.insert_query_response_pivot(qid, rid[0])
+        self.metrics.count("rows_deleted", deleted)
+        return deleted
 
     def ingest_table(self, table, name, if_exists="append") -> None:
         """
@@ -326,11 +1060,11 @@ class SQLiteDB:
         if_exists: str, optional, how to behave if the table already exists.
                                   (fail, replace, or append)
         """
-        table.to_sql(name,
-                     self.conn,
-                     if_exists=if_exists,
-                     index=False)
-        self.conn.commit()
+        with self.transaction():
+            table.to_sql(name,
+                         self.conn,
+                         if_exists=if_exists,
+                         index=False)
 
     def update_last_refreshed(self, qid: int) -> int:
         """
@@ -342,14 +1076,15 @@ class SQLiteDB:
         Returns:
         int, query id which was updated
         """
-        self.cursor.execute("""UPDATE queries
-                               SET last_refreshed = :last_refreshed
-                               WHERE id = :id""",
-                            {"last_refreshed": datetime.today()
-                                                       .strftime('%Y-%m-%d'),
-                             "id": qid})
-        self.conn.commit()
-        return self.cursor.lastrowid
+        with self.transaction():
+            self.cursor.execute("""UPDATE queries
+                                   SET last_refreshed = :last_refreshed
+                                   WHERE id = :id""",
+                                {"last_refreshed": _today(),
+                                 "id": qid})
+            lastrowid = self.cursor.lastrowid
+        self.result_cache.invalidate_query(qid)
+        return lastrowid
 
     def update_refresh_rate(self, qid: int, refresh_rate: int | None) -> int:
         """
@@ -364,13 +1099,15 @@ class SQLiteDB:
         Returns:
         int, last accessed queryid that was updated
         """
-        self.cursor.execute("""UPDATE queries
-                               SET refresh_rate = :refresh_rate
-                               WHERE id = :id""",
-                            {"refresh_rate": refresh_rate,
-                             "id": qid})
-        self.conn.commit()
-        return self.cursor.lastrowid
+        with self.transaction():
+            self.cursor.execute("""UPDATE queries
+                                   SET refresh_rate = :refresh_rate
+                                   WHERE id = :id""",
+                                {"refresh_rate": refresh_rate,
+                                 "id": qid})
+            lastrowid = self.cursor.lastrowid
+        self.result_cache.invalidate_query(qid)
+        return lastrowid
 
     def _get_queryid(self, qdf: pd.DataFrame, refresh: bool,
                      refresh_rate: int | None) -> tuple:
@@ -403,128 +1140,1584 @@ class SQLiteDB:
             qid = None
         return qid, refresh
 
-    def _stash_table(self, df: pd.DataFrame,
-                     table_name: str, idcol: str) -> None:
+    def _add_missing_columns(self, df: pd.DataFrame,
+                             table_name: str) -> None:
         """
-        Merges the results of a query into a the designated table in
-        the database (if exists), or creates a new table and ingests the new
-        data
+        Adds any columns present in a response frame, but missing from the
+        stashed table, to the stashed table
 
         Parameters
         ----------
         df: pd.DataFrame, frame with response data from a query
 
-        table_name: str, name of the table/catlog in the database
-
-        idcol: str, column name of the column to be used for id info
+        table_name: str, name of the table/catalog in the database
         """
-        ta_exists = self._check_table_exists(table_name)
-        if ta_exists is True:
-            dd1 = pd.read_sql_table(table_name, self.aconn)
-            dd2 = pd.merge(df, dd1, how="left", indicator=True)
-            changes = dd2[
-                dd2["_merge"] == "left_only"
-                ].drop(columns="_merge")
-            if len(changes) > 0:
-                diffs = dd1[dd1[idcol].isin(changes[idcol])]
-                if len(diffs) > 0:
-                    idxs = diffs.index[0]
-                    dd1 = dd1.drop(idxs)
-                updated_table = pd.merge(dd1, df, how="outer")
-                self.ingest_table(updated_table,
-                                  table_name,
-                                  if_exists="replace")
-            else:
-                self.ingest_table(changes, table_name)
-        else:
-            self.ingest_table(df, table_name)
-
-    def _get_stashed_rows(self, catalog: str,
-                          qid: int, idcol: str) -> pd.DataFrame:
+        existing = set(self.get_columns(table_name))
+        for col in df.columns:
+            if col not in existing:
+                self.cursor.execute(
+                    f"""ALTER TABLE {_quote(table_name)}
+                        ADD COLUMN {_quote(col)} {_sql_type(df[col])};""")
+
+    def list_indexes(self, table_name: str | None = None) -> pd.DataFrame:
         """
-        Gets the stashed rows associated with a query and response
+        Lists the indexes in the database
 
         Parameters
         ----------
-        catalog: str, name of catalog/table
-
-        qid: int, query id
+        table_name: str or None, optional, only list the indexes of this table
 
-        idcol: str, name of column in catalog/table used for id
-
-        Returns:
-        pd.DataFrame, rows of a catalog associated with a query
+        Returns
+        -------
+        pd.DataFrame, name, table, columns (comma separated) and uniqueness
+                      of each index
         """
-        rows = pd.read_sql(
-            """SELECT rowid FROM response_rowid_pivot rrp
-               INNER JOIN query_response_pivot qrp
-               ON qrp.responseid = rrp.responseid
-               WHERE qrp.queryid = :queryid;""",
+        indexes = pd.read_sql(
+            """SELECT m.name, m.tbl_name AS "table",
+                      ii.name AS "column", il."unique"
+               FROM sqlite_master m
+               INNER JOIN pragma_index_list(m.tbl_name) il
+               ON il.name = m.name
+               INNER JOIN pragma_index_info(m.name) ii
+               WHERE m.type = 'index'
+               AND (:table_name IS NULL OR m.tbl_name = :table_name)
+               ORDER BY m.tbl_name, m.name, ii.seqno;""",
             self.conn,
-            params={"queryid": qid})
-        df = pd.read_sql_table(catalog, self.aconn)
-        return df[df[idcol].isin(rows["rowid"])]
-
-    def get_local_data_paths_by_catalog(self, catalog: str) -> pd.DataFrame:
+            params={"table_name": table_name})
+        indexes = indexes.groupby(["name", "table", "unique"], sort=False)
+        indexes = indexes["column"].agg(",".join).reset_index()
+        indexes["unique"] = indexes["unique"].astype(bool)
+        return indexes[["name", "table", "column", "unique"]].rename(
+            columns={"column": "columns"})
+
+    def create_index(self, table_name: str, columns: str | list,
+                     unique: bool = False, name: str | None = None) -> str:
         """
-        Gets rows of local_data_paths for a specific catalog
+        Creates an index on one or more columns of a table (if it does not
+        already exist)
 
         Parameters
         ----------
-        catalog: str, name of catalog to filter local_data_paths by
+        table_name: str, name of the table to index
+
+        columns: str or list, column name(s) to index
+
+        unique: bool, optional, create a unique index, default False
+
+        name: str or None, optional, name of the index, defaults to
+                                     ix_<table>_<columns> (ux_ if unique)
 
         Returns
         -------
-        pd.DataFrame, rows of local_data_paths for a the specified catalog
+        str, name of the index
         """
-        query = "SELECT * FROM local_data_paths WHERE catalog = :catalog"
-        df = pd.read_sql(query, self.conn, params={"catalog": catalog})
-        return df
+        if isinstance(columns, str):
+            columns = [columns]
+        missing = set(columns).difference(self.get_columns(table_name))
+        if len(missing) > 0:
+            raise ValueError(f"{sorted(missing)} not in {table_name}")
+        if name is None:
+            prefix = "ux" if unique else "ix"
+            name = f"{prefix}_{table_name}_{'_'.join(columns)}"
+        with self.transaction():
+            self.cursor.execute(
+                f"""CREATE {"UNIQUE " if unique else ""}INDEX
+                    IF NOT EXISTS {_quote(name)} ON {_quote(table_name)}
+                    ({", ".join(_quote(col) for col in columns)});""")
+        return name
 
-    def insert_local_data_path(self, catalog: str,
-                               rowid: int | str, location: str) -> int:
+    def drop_index(self, name: str) -> None:
         """
-        Inserts a new record into the local_data_paths table.
-        If a record with the same (catalog, rowid, location) already exists,
-        it is ignored.
+        Drops an index from the database (if it exists)
 
         Parameters
         ----------
-        catalog: str, catalog the data product is associated with
+        name: str, name of the index
+        """
+        with self.transaction():
+            self.cursor.execute(f"DROP INDEX IF EXISTS {_quote(name)};")
 
-        rowid: str, id from the catalog table
+    def explain_query_plan(self, query: str,
+                           params: dict | None = None) -> pd.DataFrame:
+        """
+        Gets the plan SQLite would use to run a query, e.g. to check that an
+        index is used rather than a full table scan
+
+        Parameters
+        ----------
+        query: str, SQL query
+
+        params: dict or None, optional, parameters of the query
+
+        Returns
+        -------
+        pd.DataFrame, rows of the query plan (id, parent, notused, detail)
+        """
+        return pd.read_sql(f"EXPLAIN QUERY PLAN {query}",
+                           self.conn,
+                           params=params)
+
+    def start_tracing(self, slow_threshold: float = 0.1,
+                      tracer: SQLTracer | None = None) -> SQLTracer:
+        """
+        Starts tracing the SQL statements run on this instance's connections,
+        see SQLTracer. Full table scans of the astrostash tables are not
+        flagged, so the flagged scans are those of stashed catalogs. The
+        connections are reopened as traced connections, so tracing can not
+        be started inside a transaction or while rows are being read.
+
+        Parameters
+        ----------
+        slow_threshold: float, optional, duration in seconds above which the
+                                         query plan of a statement is
+                                         captured (default 0.1)
+
+        tracer: SQLTracer or None, optional, tracer to record to, e.g. one
+                                             shared with other instances, a
+                                             new tracer if None
+
+        Returns
+        -------
+        SQLTracer, the tracer, see SQLTracer.report()
+        """
+        if tracer is None:
+            tracer = SQLTracer(slow_threshold,
+                               ignore_tables=_schema_tables())
+        self._set_tracer(tracer)
+        return tracer
+
+    def stop_tracing(self) -> SQLTracer | None:
+        """
+        Stops tracing the SQL statements, the connections are reopened as
+        plain connections
+
+        Returns
+        -------
+        SQLTracer or None, the tracer that was recording, None if not tracing
+        """
+        tracer = self.tracer
+        if tracer is not None:
+            self._set_tracer(None)
+        return tracer
+
+    def _set_tracer(self, tracer: SQLTracer | None) -> None:
+        """
+        Sets (or with None, clears) the tracer and reopens the connections,
+        which are traced connections (TracedConnection) only while tracing.
+        The writer connection is reopened at once, the read connections of
+        each thread the next time the thread uses them.
+
+        Parameters
+        ----------
+        tracer: SQLTracer or None, tracer to record to
+        """
+        with self._write_lock:
+            if self._transaction_depth > 0:
+                raise RuntimeError("Tracing can not be started or stopped "
+                                   "inside a transaction")
+            self.tracer = tracer
+            self._writer_conn.close()
+            self._writer_conn = self._connect()
+            self._writer_cursor = self._writer_conn.cursor()
+            self._connections_version += 1
+
+    def _ensure_id_index(self, table_name: str, idcol: str) -> None:
+        """
+        Ensures a unique index exists on the id column of a stashed table so
+        rows can be upserted by id. Tables stashed before the index existed
+        may hold duplicate ids, which are first removed with
+        drop_duplicate_ids.
+
+        Parameters
+        ----------
+        table_name: str, name of the table/catalog in the database
+
+        idcol: str, column name of the column to be used for id info
+        """
+        try:
+            self.create_index(table_name, idcol, unique=True)
+        except sqlite3.IntegrityError:
+            self.drop_duplicate_ids(table_name, idcol)
+
+    def drop_duplicate_ids(self, table_name: str, idcol: str) -> int:
+        """
+        Migrates a table stashed before ids were unique, keeping only the
+        latest row for each id and then adding the unique index on the id
+        column, and issues a warning with the number of dropped rows. Rows
+        without an id are left as they are, the unique index allows any
+        number of them. Links in response_rowid_pivot are by id, so they now
+        point at the kept row. Spatial indexes are keyed on the id column
+        once it is unique, so they never hold a dropped row.
+
+        Parameters
+        ----------
+        table_name: str, name of the table/catalog in the database
+
+        idcol: str, column name of the column to be used for id info
+
+        Returns
+        -------
+        int, number of rows dropped
+        """
+        table = _quote(table_name)
+        col = _quote(idcol)
+        with self.transaction():
+            self.cursor.execute(
+                """CREATE TEMP TABLE IF NOT EXISTS duplicate_rowids (
+                        rowid INTEGER PRIMARY KEY);""")
+            self.cursor.execute("DELETE FROM temp.duplicate_rowids;")
+            self.cursor.execute(
+                f"""INSERT INTO temp.duplicate_rowids (rowid)
+                    SELECT rowid FROM {table}
+                    WHERE {col} IS NOT NULL AND rowid NOT IN (
+                        SELECT MAX(rowid) FROM {table}
+                        WHERE {col} IS NOT NULL
+                        GROUP BY {col}
+                    );""")
+            dropped = self.cursor.rowcount
+            self.cursor.execute(
+                f"""DELETE FROM {table} WHERE rowid IN (
+                        SELECT rowid FROM temp.duplicate_rowids);""")
+            self.cursor.execute("DELETE FROM temp.duplicate_rowids;")
+            self.create_index(table_name, idcol, unique=True)
+        if dropped > 0:
+            warnings.warn(f"Dropped {dropped} rows of {table_name} with a "
+                          f"duplicate {idcol}, keeping the latest row of "
+                          "each", stacklevel=2)
+        return dropped
+
+    def _ensure_indexes(self, table_name: str, idcol: str) -> None:
+        """
+        Ensures a stashed table is indexed on its id column and on any of
+        the common filter columns (INDEX_COLUMNS) it has
+
+        Parameters
+        ----------
+        table_name: str, name of the table/catalog in the database
+
+        idcol: str, column name of the column to be used for id info
+        """
+        self._ensure_id_index(table_name, idcol)
+        columns = self.get_columns(table_name)
+        for col in INDEX_COLUMNS:
+            if col in columns and col != idcol:
+                self.create_index(table_name, col)
+
+    def get_spatial_index(self, table_name: str) -> str | None:
+        """
+        Gets the name of the R*Tree spatial index of a stashed catalog
+
+        Parameters
+        ----------
+        table_name: str, name of the table/catalog
+
+        Returns
+        -------
+        str or None, name of the R*Tree table, None if not indexed
+        """
+        spatial_index = self._get_spatial_index(table_name)
+        return None if spatial_index is None else spatial_index[0]
+
+    def _get_spatial_index(self, table_name: str) -> tuple | None:
+        """
+        Gets the R*Tree spatial index of a stashed catalog and the id column
+        it is keyed on
+
+        Parameters
+        ----------
+        table_name: str, name of the table/catalog
+
+        Returns
+        -------
+        tuple or None, name of the R*Tree table and the id column, None if
+                       not indexed
+        """
+        self.cursor.execute("""SELECT rtree, idcol FROM spatial_indexes
+                               WHERE catalog = :catalog;""",
+                            {"catalog": table_name})
+        return self.cursor.fetchone()
+
+    def create_spatial_index(self, table_name: str,
+                             idcol: str = "__row") -> str:
+        """
+        Creates an R*Tree spatial index over the ra/dec positions (as unit
+        vectors) of a stashed catalog's rows, which is then kept up to date
+        as rows are stashed. Catalogs with ra and dec columns are indexed
+        automatically when first stashed to. The R*Tree ids map to the
+        catalog's id column through the <rtree>_ids table, rather than to
+        its rowids which VACUUM may renumber. An index keyed on another id
+        column is rebuilt.
+
+        Parameters
+        ----------
+        table_name: str, name of the table/catalog
+
+        idcol: str, optional, name of id column of the catalog
+
+        Returns
+        -------
+        str, name of the R*Tree table
+        """
+        columns = self.get_columns(table_name)
+        missing = [col for col in POSITION_COLUMNS + (idcol,)
+                   if col not in columns]
+        if len(missing) > 0:
+            raise ValueError(f"{table_name} has no {missing} columns")
+        with self.transaction():
+            spatial_index = self._get_spatial_index(table_name)
+            if spatial_index is not None and spatial_index[1] == idcol:
+                return spatial_index[0]
+            self._ensure_id_index(table_name, idcol)
+            rtree = f"rtree_{table_name}"
+            # Indexes keyed on another column, or left over from before
+            # indexes were keyed on the id column, are rebuilt
+            self.cursor.execute(f"DROP TABLE IF EXISTS {_quote(rtree)};")
+            self.cursor.execute(
+                f"DROP TABLE IF EXISTS {_quote(rtree + '_ids')};")
+            self.cursor.execute(
+                f"""CREATE VIRTUAL TABLE {_quote(rtree)}
+                    USING rtree(id, minx, maxx, miny, maxy, minz, maxz);""")
+            self.cursor.execute(
+                f"""CREATE TABLE {_quote(rtree + '_ids')} (
+                        id INTEGER PRIMARY KEY,
+                        catalog_id NOT NULL,
+                        UNIQUE (catalog_id)
+                    );""")
+            self.cursor.execute(
+                """INSERT OR REPLACE INTO spatial_indexes (
+                       catalog, rtree, idcol)
+                   VALUES (:catalog, :rtree, :idcol);""",
+                {"catalog": table_name, "rtree": rtree, "idcol": idcol})
+            self._index_positions(table_name, rtree, idcol)
+        return rtree
+
+    def _index_positions(self, table_name: str, rtree: str, idcol: str,
+                         ids: list | None = None) -> None:
+        """
+        Writes the positions of a catalog's rows into its spatial index,
+        rows without a valid position are left out
+
+        Parameters
+        ----------
+        table_name: str, name of the table/catalog
+
+        rtree: str, name of the R*Tree table
+
+        idcol: str, column name of the id column the index is keyed on
+
+        ids: list or None, optional, ids of the rows to (re)index,
+                                     every row if None
+        """
+        table = _quote(table_name)
+        rtree_ids = _quote(rtree + "_ids")
+        where = ""
+        params = {}
+        if ids is not None:
+            where = f"""WHERE c.{_quote(idcol)} IN (
+                            SELECT value FROM json_each(:ids))"""
+            params["ids"] = json.dumps(ids, default=str)
+        self.cursor.execute(
+            f"""INSERT OR IGNORE INTO {rtree_ids} (catalog_id)
+                SELECT c.{_quote(idcol)} FROM {table} c {where};""",
+            params)
+        # Separate cursor, self.cursor writes while the rows are read
+        rows = self.conn.cursor()
+        rows.execute(
+            f"""SELECT m.id, c.ra, c.dec FROM {table} c
+                INNER JOIN {rtree_ids} m ON m.catalog_id = c.{_quote(idcol)}
+                {where};""",
+            params)
+        while True:
+            chunk = rows.fetchmany(50000)
+            if len(chunk) == 0:
+                break
+            pos = pd.DataFrame(chunk, columns=["id", "ra", "dec"])
+            xyz = _unit_vectors(pd.to_numeric(pos["ra"], errors="coerce"),
+                                pd.to_numeric(pos["dec"], errors="coerce"))
+            valid = np.isfinite(xyz).all(axis=1)
+            self.cursor.executemany(
+                f"""INSERT OR REPLACE INTO {_quote(rtree)}
+                    VALUES (?, ?, ?, ?, ?, ?, ?);""",
+                ((int(rid), x, x, y, y, z, z) for rid, (x, y, z)
+                 in zip(pos["id"][valid], xyz[valid].tolist())))
+            self.cursor.executemany(
+                f"DELETE FROM {_quote(rtree)} WHERE id = ?;",
+                ((int(rid),) for rid in pos["id"][~valid]))
+
+    def _update_spatial_index(self, df: pd.DataFrame,
+                              table_name: str, idcol: str) -> None:
+        """
+        Indexes the positions of freshly stashed rows, creating (or
+        rebuilding) the catalog's spatial index if needed
+
+        Parameters
+        ----------
+        df: pd.DataFrame, stashed rows
+
+        table_name: str, name of the table/catalog
+
+        idcol: str, column name of the id column
+        """
+        spatial_index = self._get_spatial_index(table_name)
+        if spatial_index is None or spatial_index[1] != idcol:
+            self.create_spatial_index(table_name, idcol)
+        else:
+            self._index_positions(table_name, spatial_index[0], idcol,
+                                  df[idcol].tolist())
+
+    def cone_search(self, catalog: str, ra: float, dec: float,
+                    radius: float, qid: int | None = None,
+                    idcol: str = "__row") -> pd.DataFrame:
+        """
+        Finds the stashed rows of a catalog within a cone, through the
+        catalog's spatial index so only rows near the cone are read
+
+        Parameters
+        ----------
+        catalog: str, name of the table/catalog
+
+        ra: float, right ascension of the center in degrees
+
+        dec: float, declination of the center in degrees
+
+        radius: float, radius of the cone in degrees
+
+        qid: int or None, optional, only search the rows of this query,
+                                    every stashed row if None
+
+        idcol: str, optional, name of id column of the catalog, used with
+                              qid and to key a new spatial index
+
+        Returns
+        -------
+        pd.DataFrame, stashed rows within the cone
+        """
+        spatial_index = self._get_spatial_index(catalog)
+        if spatial_index is None:
+            spatial_index = (self.create_spatial_index(catalog, idcol),
+                             idcol)
+        rtree, index_idcol = spatial_index
+        center = _unit_vectors([ra], [dec])[0]
+        # Chord length between the center and the edge of the cone
+        chord = 2 * np.sin(np.radians(min(radius, 180)) / 2)
+        bounds = {}
+        for axis, value in zip("xyz", center):
+            bounds[f"{axis}0"] = value - chord
+            bounds[f"{axis}1"] = value + chord
+        query_rows = ""
+        if qid is not None:
+            query_rows = f"""AND c.{_quote(idcol)} IN (
+                                 SELECT rrp.rowid FROM response_rowid_pivot rrp
+                                 INNER JOIN query_response_pivot qrp
+                                 ON qrp.responseid = rrp.responseid
+                                 WHERE qrp.queryid = :queryid)"""
+            bounds["queryid"] = qid
+        df = pd.read_sql(
+            f"""SELECT {self._catalog_columns(catalog)}
+                FROM {_quote(rtree)} r
+                JOIN {_quote(rtree + "_ids")} m ON m.id = r.id
+                JOIN {_quote(catalog)} c
+                ON c.{_quote(index_idcol)} = m.catalog_id
+                WHERE r.maxx >= :x0 AND r.minx <= :x1
+                  AND r.maxy >= :y0 AND r.miny <= :y1
+                  AND r.maxz >= :z0 AND r.minz <= :z1
+                  {query_rows}
+                ORDER BY c.rowid;""",
+            self.conn,
+            params=bounds)
+        xyz = _unit_vectors(pd.to_numeric(df["ra"], errors="coerce"),
+                            pd.to_numeric(df["dec"], errors="coerce"))
+        inside = ((xyz - center) ** 2).sum(axis=1) <= chord ** 2
+        return df[inside].reset_index(drop=True)
+
+    def insert_footprint(self, qid: int, catalog: str, ra: float,
+                         dec: float, radius: float, signature: str,
+                         spatial: str = "cone") -> None:
+        """
+        Records the sky footprint of a region query, so later queries inside
+        it can be answered from its stashed rows
+
+        Parameters
+        ----------
+        qid: int, query id
+
+        catalog: str, name of the table/catalog
+
+        ra: float, right ascension of the center in degrees
+
+        dec: float, declination of the center in degrees
+
+        radius: float, radius in degrees
+
+        signature: str, hash of the query parameters other than the
+                        footprint, only queries with the same signature
+                        can answer each other
+
+        spatial: str, optional, shape of the footprint, only cone is
+                                supported
+        """
+        with self.transaction():
+            self.cursor.execute(
+                """INSERT OR REPLACE INTO query_footprints (
+                       queryid,
+                       catalog,
+                       spatial,
+                       ra,
+                       dec,
+                       radius,
+                       signature
+                   )
+                   VALUES (:qid, :catalog, :spatial, :ra, :dec, :radius,
+                           :signature);""",
+                {"qid": qid, "catalog": catalog, "spatial": spatial,
+                 "ra": ra, "dec": dec, "radius": radius,
+                 "signature": signature})
+
+    def get_footprint(self, qid: int) -> tuple | None:
+        """
+        Gets the recorded footprint of a query
+
+        Parameters
+        ----------
+        qid: int, query id
+
+        Returns
+        -------
+        tuple or None, (catalog, spatial, ra, dec, radius, signature),
+                       None if no footprint is recorded
+        """
+        self.cursor.execute("""SELECT catalog, spatial, ra, dec, radius,
+                                      signature
+                               FROM query_footprints
+                               WHERE queryid = :qid;""",
+                            {"qid": qid})
+        return self.cursor.fetchone()
+
+    def get_covering_footprints(self, catalog: str, signature: str,
+                                ra: float, dec: float,
+                                radius: float) -> pd.DataFrame:
+        """
+        Gets the recorded cone footprints that fully contain a cone
+
+        Parameters
+        ----------
+        catalog: str, name of the table/catalog
+
+        signature: str, hash of the query parameters other than the
+                        footprint
+
+        ra: float, right ascension of the center in degrees
+
+        dec: float, declination of the center in degrees
+
+        radius: float, radius in degrees
+
+        Returns
+        -------
+        pd.DataFrame, covering footprints with the last_refreshed and
+                      refresh_rate of their queries, smallest first
+        """
+        footprints = pd.read_sql(
+            """SELECT f.queryid, f.ra, f.dec, f.radius,
+                      q.last_refreshed, q.refresh_rate
+               FROM query_footprints f
+               JOIN queries q ON q.id = f.queryid
+               WHERE f.catalog = :catalog
+                 AND f.signature = :signature
+                 AND f.spatial = 'cone'
+                 AND f.radius >= :radius
+               ORDER BY f.radius;""",
+            self.conn,
+            params={"catalog": catalog, "signature": signature,
+                    "radius": radius})
+        sep = _separation(footprints["ra"], footprints["dec"],
+                          np.full(len(footprints), ra),
+                          np.full(len(footprints), dec))
+        # Small tolerance so a query repeated at the same footprint counts
+        covers = sep + radius <= footprints["radius"] + 1e-9
+        return footprints[covers].reset_index(drop=True)
+
+    def get_covering_query(self, catalog: str, signature: str, ra: float,
+                           dec: float, radius: float,
+                           refresh_rate: int | None = None,
+                           allow_stale: bool = False) -> tuple | None:
+        """
+        Finds the smallest fresh query whose recorded footprint contains a
+        cone
+
+        Parameters
+        ----------
+        catalog: str, name of the table/catalog
+
+        signature: str, hash of the query parameters other than the
+                        footprint
+
+        ra: float, right ascension of the center in degrees
+
+        dec: float, declination of the center in degrees
+
+        radius: float, radius in degrees
+
+        refresh_rate: int or None, optional, number of days before the
+                                             covering query needs a refresh,
+                                             its own refresh rate if None
+
+        allow_stale: bool, optional, also use a covering query that needs a
+                                     refresh
+
+        Returns
+        -------
+        tuple or None, query id, last_refreshed and refresh_rate of the
+                       covering query, None if no (fresh) query covers it
+        """
+        self._footprint_lookups += 1
+        footprints = self.get_covering_footprints(catalog, signature,
+                                                  ra, dec, radius)
+        for footprint in footprints.itertuples(index=False):
+            rate = footprint.refresh_rate if refresh_rate is None \
+                else refresh_rate
+            if allow_stale is False and not pd.isna(rate) \
+                    and needs_refresh(footprint.last_refreshed, int(rate)):
+                continue
+            if not set(POSITION_COLUMNS).issubset(self.get_columns(catalog)):
+                return None
+            self._footprint_hits += 1
+            return (int(footprint.queryid), footprint.last_refreshed,
+                    None if pd.isna(footprint.refresh_rate)
+                    else int(footprint.refresh_rate))
+        return None
+
+    def get_covered_rows(self, catalog: str, signature: str, ra: float,
+                         dec: float, radius: float,
+                         refresh_rate: int | None = None,
+                         idcol: str = "__row") -> pd.DataFrame | None:
+        """
+        Answers a cone search from the stashed rows of a fresh query whose
+        footprint contains the cone, read through the catalog's spatial
+        index
+
+        Parameters
+        ----------
+        catalog: str, name of the table/catalog
+
+        signature: str, hash of the query parameters other than the
+                        footprint
+
+        ra: float, right ascension of the center in degrees
+
+        dec: float, declination of the center in degrees
+
+        radius: float, radius in degrees
+
+        refresh_rate: int or None, optional, number of days before the
+                                             covering query needs a refresh,
+                                             its own refresh rate if None
+
+        idcol: str, optional, name of id column of the catalog
+
+        Returns
+        -------
+        pd.DataFrame or None, rows within the cone, None if no fresh query
+                              covers it
+        """
+        covering = self.get_covering_query(catalog, signature, ra, dec,
+                                           radius, refresh_rate)
+        if covering is None:
+            return None
+        return self.cone_search(catalog, ra, dec, radius, covering[0], idcol)
+
+    def footprint_stats(self) -> dict:
+        """
+        Gets how often region queries were answered from a covering query
+
+        Returns
+        -------
+        dict, lookups (queries checked against the recorded footprints) and
+              covered (queries answered locally)
+        """
+        return {"lookups": self._footprint_lookups,
+                "covered": self._footprint_hits}
+
+    def refresh_stats(self) -> dict:
+        """
+        Gets how many refreshes found the response unchanged, and so only
+        updated the query's last_refreshed date
+
+        Returns
+        -------
+        dict, refreshes (refreshed queries stashed) and unchanged
+              (refreshes that were no-ops)
+        """
+        stats = {"refreshes": self._refresh_count,
+                 "unchanged": self._unchanged_refreshes}
+        if self._refresh_db not in (None, self):
+            for key, value in self._refresh_db.refresh_stats().items():
+                stats[key] += value
+        return stats
+
+    def _upsert_rows(self, df: pd.DataFrame,
+                     table_name: str, idcol: str) -> None:
+        """
+        Inserts the rows of a frame into a stashed table, updating any
+        existing rows with the same id in place
+
+        Parameters
+        ----------
+        df: pd.DataFrame, frame with response data from a query
+
+        table_name: str, name of the table/catalog in the database
+
+        idcol: str, column name of the column to be used for id info
+        """
+        cols = [_quote(col) for col in df.columns]
+        updates = [f"{col} = excluded.{col}" for col in cols
+                   if col != _quote(idcol)]
+        if len(updates) > 0:
+            action = f"DO UPDATE SET {', '.join(updates)}"
+        else:
+            action = "DO NOTHING"
+        self.cursor.executemany(
+            f"""INSERT INTO {_quote(table_name)} ({', '.join(cols)})
+                VALUES ({', '.join('?' * len(cols))})
+                ON CONFLICT ({_quote(idcol)}) {action};""",
+            _to_records(df))
+
+    def _stash_table(self, df: pd.DataFrame,
+                     table_name: str, idcol: str) -> dict:
+        """
+        Upserts the results of a query into a the designated table in
+        the database (if exists), or creates a new table and ingests the new
+        data. Each row is stored with its hash (ROW_HASH_COLUMN), so only the
+        rows that are new or whose hash differs from the stashed row with the
+        same id are written.
+
+        Parameters
+        ----------
+        df: pd.DataFrame, frame with response data from a query
+
+        table_name: str, name of the table/catlog in the database
+
+        idcol: str, column name of the column to be used for id info
+
+        Returns
+        -------
+        dict, number of rows inserted, updated, and left as they were
+              (unchanged)
+        """
+        nrows = len(df)
+        df = df.assign(**{ROW_HASH_COLUMN: row_hashes(df)})
+        with self.transaction():
+            if self._check_table_exists(table_name) is True:
+                self._add_missing_columns(df, table_name)
+                self._ensure_indexes(table_name, idcol)
+                changed, inserted = self._changed_rows(df, table_name, idcol)
+                df = df.iloc[changed]
+            else:
+                self.cursor.execute(pd.io.sql.get_schema(df, table_name))
+                self._ensure_indexes(table_name, idcol)
+                inserted = len(df)
+            self._upsert_rows(df, table_name, idcol)
+            self.metrics.count("rows_written", len(df))
+            self.metrics.count("rows_inserted", inserted)
+            self.metrics.count("rows_updated", len(df) - inserted)
+            if set(POSITION_COLUMNS).issubset(df.columns):
+                self._update_spatial_index(df, table_name, idcol)
+        self.result_cache.invalidate_table(table_name)
+        self._table_versions[table_name] = self.table_version(table_name) + 1
+        return {"inserted": inserted,
+                "updated": len(df) - inserted,
+                "unchanged": nrows - len(df)}
+
+    def _changed_rows(self, df: pd.DataFrame, table_name: str,
+                      idcol: str) -> tuple:
+        """
+        Finds the rows of a response that are not stashed yet or differ from
+        the stashed row with the same id, by staging the ids and row hashes
+        in a temporary table and joining it on the catalog's id index
+
+        Parameters
+        ----------
+        df: pd.DataFrame, response rows with their ROW_HASH_COLUMN
+
+        table_name: str, name of the table/catalog in the database
+
+        idcol: str, column name of the column to be used for id info
+
+        Returns
+        -------
+        tuple, (positions in df of the changed rows, number of them that are
+                new)
+        """
+        self.cursor.execute(
+            """CREATE TEMP TABLE IF NOT EXISTS staged_rowhashes (
+                   pos INTEGER PRIMARY KEY,
+                   id,
+                   rowhash INTEGER
+               );""")
+        self.cursor.execute("DELETE FROM temp.staged_rowhashes;")
+        self.cursor.executemany(
+            """INSERT INTO temp.staged_rowhashes (pos, id, rowhash)
+               VALUES (?, ?, ?);""",
+            zip(range(len(df)), df[idcol].tolist(),
+                df[ROW_HASH_COLUMN].tolist()))
+        col = _quote(idcol)
+        self.cursor.execute(
+            f"""SELECT s.pos, c.{col} IS NULL
+                FROM temp.staged_rowhashes s
+                LEFT JOIN {_quote(table_name)} c ON c.{col} = s.id
+                WHERE c.{col} IS NULL
+                   OR c.{_quote(ROW_HASH_COLUMN)} IS NOT s.rowhash
+                ORDER BY s.pos;""")
+        changed = self.cursor.fetchall()
+        self.cursor.execute("DELETE FROM temp.staged_rowhashes;")
+        return ([pos for pos, _ in changed],
+                sum(new for _, new in changed))
+
+    def table_version(self, table_name: str) -> int:
+        """
+        Gets the number of times a table/catalog has been stashed to by this
+        connection, so callers can tell when data derived from it is stale
+        without a database round trip
+
+        Parameters
+        ----------
+        table_name: str, name of the table/catalog
+
+        Returns
+        -------
+        int, write version of the table, 0 if never written
+        """
+        return self._table_versions.get(table_name, 0)
+
+    def _catalog_columns(self, catalog: str, alias: str = "c") -> str:
+        """
+        Gets the SQL select list of a stashed catalog's columns, leaving out
+        ROW_HASH_COLUMN
+
+        Parameters
+        ----------
+        catalog: str, name of catalog/table
+
+        alias: str, optional, alias of the catalog in the query
+
+        Returns
+        -------
+        str, comma separated columns
+        """
+        return ", ".join(f"{alias}.{_quote(col)}"
+                         for col in self.get_columns(catalog)
+                         if col != ROW_HASH_COLUMN)
+
+    def _stashed_rows_sql(self, catalog: str, idcol: str) -> str:
+        """
+        Gets the SQL selecting the stashed rows of a catalog associated with
+        a query (:queryid)
+
+        Parameters
+        ----------
+        catalog: str, name of catalog/table
+
+        idcol: str, name of column in catalog/table used for id
+
+        Returns
+        -------
+        str, SQL query
+        """
+        return f"""SELECT {self._catalog_columns(catalog)}
+                   FROM {_quote(catalog)} c
+                   WHERE c.{_quote(idcol)} IN (
+                       SELECT rrp.rowid FROM response_rowid_pivot rrp
+                       INNER JOIN query_response_pivot qrp
+                       ON qrp.responseid = rrp.responseid
+                       WHERE qrp.queryid = :queryid
+                   )
+                   ORDER BY c.rowid;"""
+
+    def _get_stashed_rows(self, catalog: str,
+                          qid: int, idcol: str) -> pd.DataFrame:
+        """
+        Gets the stashed rows associated with a query and response
+
+        Parameters
+        ----------
+        catalog: str, name of catalog/table
+
+        qid: int, query id
+
+        idcol: str, name of column in catalog/table used for id
+
+        Returns:
+        pd.DataFrame, rows of a catalog associated with a query
+        """
+        return pd.read_sql(
+            self._stashed_rows_sql(catalog, idcol),
+            self.conn,
+            params={"queryid": qid})
+
+    def _iter_stashed_rows(self, catalog: str, qid: int, idcol: str,
+                           chunksize: int):
+        """
+        Gets the stashed rows associated with a query in chunks
+
+        Parameters
+        ----------
+        catalog: str, name of catalog/table
+
+        qid: int, query id
+
+        idcol: str, name of column in catalog/table used for id
+
+        chunksize: int, number of rows per chunk
+
+        Yields
+        ------
+        pd.DataFrame, chunks of rows of a catalog associated with a query
+        """
+        yield from pd.read_sql(
+            self._stashed_rows_sql(catalog, idcol),
+            self.conn,
+            params={"queryid": qid},
+            chunksize=chunksize)
+
+    def _get_stashed_rows_many(self, catalog: str, qids: list,
+                               idcol: str) -> dict:
+        """
+        Gets the stashed rows associated with many queries in one pass
+
+        Parameters
+        ----------
+        catalog: str, name of catalog/table
+
+        qids: list, query ids
+
+        idcol: str, name of column in catalog/table used for id
+
+        Returns:
+        dict, rows of the catalog associated with each query id
+        """
+        rows = pd.read_sql(
+            f"""SELECT links.queryid AS _astrostash_queryid,
+                       {self._catalog_columns(catalog)}
+                FROM {_quote(catalog)} c
+                INNER JOIN (
+                    SELECT DISTINCT qrp.queryid, rrp.rowid
+                    FROM response_rowid_pivot rrp
+                    INNER JOIN query_response_pivot qrp
+                    ON qrp.responseid = rrp.responseid
+                    WHERE qrp.queryid IN (
+                        SELECT value FROM json_each(:queryids)
+                    )
+                ) links
+                ON c.{_quote(idcol)} = links.rowid
+                ORDER BY links.queryid, c.rowid;""",
+            self.conn,
+            params={"queryids": json.dumps([int(qid) for qid in qids])})
+        groups = rows.groupby("_astrostash_queryid", sort=False)
+        empty = rows.iloc[0:0].drop(columns="_astrostash_queryid")
+        stashed = {qid: empty for qid in qids}
+        for qid, group in groups:
+            stashed[qid] = group.drop(
+                columns="_astrostash_queryid").reset_index(drop=True)
+        return stashed
+
+    def get_local_data_paths_by_catalog(self, catalog: str) -> pd.DataFrame:
+        """
+        Gets rows of local_data_paths for a specific catalog
+
+        Parameters
+        ----------
+        catalog: str, name of catalog to filter local_data_paths by
+
+        Returns
+        -------
+        pd.DataFrame, rows of local_data_paths for a the specified catalog
+        """
+        query = "SELECT * FROM local_data_paths WHERE catalog = :catalog"
+        df = pd.read_sql(query, self.conn, params={"catalog": catalog})
+        return df
+
+    def insert_local_data_path(self, catalog: str,
+                               rowid: int | str, location: str) -> int:
+        """
+        Inserts a new record into the local_data_paths table.
+        If a record with the same (catalog, rowid, location) already exists,
+        it is ignored.
+
+        Parameters
+        ----------
+        catalog: str, catalog the data product is associated with
+
+        rowid: str, id from the catalog table
+
+        location: str, local path to data product
+
+        Returns
+        -------
+        int, id for the record of the data path location
+        """
+        query = """INSERT OR IGNORE INTO local_data_paths (
+                        catalog,
+                        rowid,
+                        location)
+                   VALUES (
+                        :catalog,
+                        :rowid,
+                        :location)"""
+        with self.transaction():
+            self.cursor.execute(query, {"catalog": catalog,
+                                        "rowid": rowid,
+                                        "location": location})
+            lastrowid = self.cursor.lastrowid
+        return lastrowid
+
+    def get_resolved_names(self, names: list) -> pd.DataFrame:
+        """
+        Gets the stashed coordinates of resolved object names
+
+        Parameters
+        ----------
+        names: list, object names (e.x. PSR B0531+21)
+
+        Returns
+        -------
+        pd.DataFrame, name, ra, dec, frame, resolved date and refresh_rate of
+                      each of the names that have been resolved before
+        """
+        return pd.read_sql(
+            """SELECT * FROM resolved_names
+               WHERE name IN (SELECT value FROM json_each(:names));""",
+            self.conn,
+            params={"names": json.dumps(list(names))})
+
+    def insert_resolved_names(self, records: list,
+                              refresh_rate: int | None = None) -> None:
+        """
+        Stashes the coordinates of resolved object names, replacing any
+        previous resolution of the same names
+
+        Parameters
+        ----------
+        records: list, (name, ra, dec, frame) tuples with ra and dec in
+                       degrees
+
+        refresh_rate: int or None, optional, number of days before the names
+                                             should be resolved again
+        """
+        with self.transaction():
+            self.cursor.executemany(
+                """INSERT INTO resolved_names (
+                       name,
+                       ra,
+                       dec,
+                       frame,
+                       resolved,
+                       refresh_rate
+                   )
+                   VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (name) DO UPDATE SET
+                       ra = excluded.ra,
+                       dec = excluded.dec,
+                       frame = excluded.frame,
+                       resolved = excluded.resolved,
+                       refresh_rate = excluded.refresh_rate;""",
+                [(name, ra, dec, frame, _today(), refresh_rate)
+                 for name, ra, dec, frame in records])
+
+    def fetch_sync(self, query_func, table_name: str,
+                   query_params: dict,
+                   refresh_rate: int | None,
+                   idcol: str = "__row",
+                   refresh: bool = False,
+                   *args, refresh_policy: str | None = None,
+                   call_name: str | None = None,
+                   footprint: tuple | None = None,
+                   row_limit=None,
+                   **kwargs) -> pd.DataFrame:
+        """
+        Fetches existing data from the user's database if it exists from a
+        previous query. Otherwise adds the query reference to the db, executes
+        the query function with the passed in function args + kwargs, and
+        stashes the results in the db in the table name specified.
+
+        Parameters:
+        query_func: function, function to call to execute astroquery function
+                              if stashed results do not exist
+
+        table_name: str, table name from user's db
+
+        db_query: str, SQL query to get data from local db table
+
+        *args: args to be passed into query_func (if executed)
+
+        refresh_policy: str or None, how a stale query is served, one of
+                        REFRESH_POLICIES, the instance's refresh_policy if
+                        None. cache-only raises a ValueError for queries
+                        that are not stashed, and with refresh=True.
+
+        call_name: str or None, name the call is stored under so
+                   refresh_stale can replay it, not stored if None
+
+        footprint: tuple or None, signature, ra, dec and radius in degrees
+                   of a cone search (see insert_footprint). A query not
+                   stashed yet is answered from a query whose footprint
+                   contains the cone, and the footprint of a query that is
+                   run is recorded if its response is known to be complete,
+                   i.e. has fewer rows than row_limit.
+
+        row_limit: int, function or None, maximum number of rows the
+                   service returns for the query, or a function getting
+                   it that is only called once the query is run. An int
+                   limit is also applied to the rows of a covering query.
+                   No footprint is recorded if None.
+
+        **kwargs: kwargs to be passed into the query_func (if executed)
+
+        Returns:
+        pd.DataFrame, table with the results of the query
+        """
+        refresh_policy = self._get_refresh_policy(refresh_policy, refresh)
+        with self.metrics.fetch(table_name):
+            plan = self._plan_fetch(query_params, refresh_rate, refresh)
+            if plan["frame"] is not None:
+                self.metrics.set_outcome("cache_hit")
+                self._count_rows(plan["frame"])
+                return plan["frame"]
+            if footprint is not None and plan["qid"] is None \
+                    and refresh is False:
+                df = self._fetch_covered(plan, table_name, idcol, footprint,
+                                         refresh_policy == "cache-only",
+                                         row_limit)
+                if df is not None:
+                    return df
+            # An explicit refresh always waits for the new response
+            if plan["fetch"] is True and refresh is False \
+                    and refresh_policy != "blocking":
+                df = self._serve_stale(query_func, plan, table_name, idcol,
+                                       refresh_policy, *args, **kwargs)
+                if df is not None:
+                    return df
+            df = None
+            if plan["fetch"] is True:
+                # If there is no query matching the hash then the query
+                # has not been requested before, so we need to insert the
+                # query hash to get a queryid, and then stash the query
+                # results in a new data table
+                self.metrics.set_outcome(
+                    "miss" if plan["qid"] is None else "refresh")
+                df = self._run_query(query_func, plan["params"],
+                                     *args, **kwargs)
+                if call_name is not None:
+                    plan["call"] = (call_name, kwargs)
+                if self._is_complete(df, footprint, row_limit) is True:
+                    plan["footprint"] = footprint
+            else:
+                self.metrics.set_outcome("hit")
+            return self._finish_fetch(plan, df, table_name, idcol)
+
+    def _serve_stale(self, query_func, plan: dict, table_name: str,
+                     idcol: str, refresh_policy: str,
+                     *args, **kwargs) -> pd.DataFrame | None:
+        """
+        Serves a query that needs a refresh from its stashed rows without
+        waiting for the heasarc, as the stale-while-revalidate and
+        cache-only refresh policies do. stale-while-revalidate refreshes the
+        query in the background.
+
+        Parameters
+        ----------
+        query_func: function, function to call to refresh the query
+
+        plan: dict, plan from _plan_fetch
+
+        table_name: str, name of the table/catalog in the database
+
+        idcol: str, name of id column from response table
+
+        refresh_policy: str, stale-while-revalidate or cache-only
+
+        *args: args to be passed into query_func
+
+        **kwargs: kwargs to be passed into query_func
+
+        Returns
+        -------
+        pd.DataFrame or None, stashed rows, None if the query is not stashed
+                              and has to be run
+        """
+        if plan["qid"] is None:
+            if refresh_policy == "cache-only":
+                raise ValueError(f"Query is not stashed in {table_name}, "
+                                 "and the refresh policy is cache-only")
+            return None
+        if refresh_policy == "stale-while-revalidate":
+            self._refresh_in_background(query_func, plan, table_name, idcol,
+                                        *args, **kwargs)
+        self.metrics.set_outcome("stale")
+        with self.metrics.phase("read"):
+            df = self._get_stashed_rows(table_name, plan["qid"], idcol)
+        self._count_rows(df)
+        return df
+
+    def _is_complete(self, df: pd.DataFrame, footprint: tuple | None,
+                     row_limit) -> bool:
+        """
+        Checks whether a cone search response holds every row in its
+        footprint, i.e. was not cut at the row limit of the service
+
+        Parameters
+        ----------
+        df: pd.DataFrame, response of the query
+
+        footprint: tuple or None, footprint of the query
+
+        row_limit: int, function or None, row limit of the query (see
+                   fetch_sync)
+
+        Returns
+        -------
+        bool, True if the footprint of the response can be recorded
+        """
+        if footprint is None or row_limit is None:
+            return False
+        if callable(row_limit):
+            row_limit = row_limit()
+        return row_limit is not None and len(df) < row_limit
+
+    def _fetch_covered(self, plan: dict, table_name: str, idcol: str,
+                       footprint: tuple, allow_stale: bool,
+                       row_limit=None) -> pd.DataFrame | None:
+        """
+        Serves a cone search not stashed yet from the rows of a query whose
+        footprint contains it, caching the result under the cone's own query
+        hash
+
+        Parameters
+        ----------
+        plan: dict, plan from _plan_fetch
+
+        table_name: str, name of the table/catalog in the database
+
+        idcol: str, name of id column from response table
+
+        footprint: tuple, signature, ra, dec and radius of the cone
+
+        allow_stale: bool, also serve from a covering query that needs a
+                           refresh
+
+        row_limit: int, function or None, optional, maximum number of rows
+                   returned, only applied if an int
+
+        Returns
+        -------
+        pd.DataFrame or None, rows within the cone, None if no query covers
+                              it
+        """
+        signature, ra, dec, radius = footprint
+        with self.metrics.phase("footprint"):
+            covering = self.get_covering_query(table_name, signature, ra,
+                                               dec, radius,
+                                               plan["refresh_rate"],
+                                               allow_stale)
+        if covering is None:
+            return None
+        qid, last_refreshed, refresh_rate = covering
+        self.metrics.set_outcome("covered")
+        with self.metrics.phase("read"):
+            df = self.cone_search(table_name, ra, dec, radius, qid, idcol)
+        if isinstance(row_limit, int):
+            df = df.head(row_limit)
+        self._count_rows(df)
+        # Cached with the covering query's id, so refreshing it drops the
+        # cached result too
+        self.result_cache.put(plan["hash"], df, table_name, qid,
+                              last_refreshed, refresh_rate)
+        return df.copy()
+
+    def _count_rows(self, df: pd.DataFrame, prefix: str = "") -> None:
+        """
+        Adds the number of rows and (shallow) memory usage in bytes of a
+        frame to the counts of the fetch being recorded
+
+        Parameters
+        ----------
+        df: pd.DataFrame, frame to count
+
+        prefix: str, optional, prefix of the rows and bytes count names
+        """
+        if self.metrics.current() is not None:
+            self.metrics.count(f"{prefix}rows", len(df))
+            self.metrics.count(f"{prefix}bytes",
+                               df.memory_usage(index=False).sum())
+
+    def _check_refresh_policy(self, refresh_policy: str) -> str:
+        """
+        Checks a refresh policy is one of REFRESH_POLICIES
+
+        Parameters
+        ----------
+        refresh_policy: str, refresh policy
+
+        Returns
+        -------
+        str, the refresh policy
+        """
+        if refresh_policy not in REFRESH_POLICIES:
+            raise ValueError(f"{refresh_policy} is not one of "
+                             f"{list(REFRESH_POLICIES)}")
+        return refresh_policy
+
+    def _get_refresh_policy(self, refresh_policy: str | None,
+                            refresh: bool) -> str:
+        """
+        Gets the refresh policy of a fetch
+
+        Parameters
+        ----------
+        refresh_policy: str or None, refresh policy of the fetch, the
+                        instance's refresh_policy if None
+
+        refresh: bool, True if refresh toggled on, which cache-only does not
+                 allow
+
+        Returns
+        -------
+        str, the refresh policy
+        """
+        if refresh_policy is None:
+            refresh_policy = self.refresh_policy
+        self._check_refresh_policy(refresh_policy)
+        if refresh is True and refresh_policy == "cache-only":
+            raise ValueError("A refresh can not be requested with the "
+                             "cache-only refresh policy")
+        return refresh_policy
+
+    def _refresh_in_background(self, query_func, plan: dict,
+                               table_name: str, idcol: str,
+                               *args, **kwargs):
+        """
+        Refreshes a stale query in the background, concurrent refreshes of
+        the same query share a single one
+
+        Parameters
+        ----------
+        query_func: function, function to call to execute astroquery function
+
+        plan: dict, plan from _plan_fetch
+
+        table_name: str, name of the table/catalog in the database
+
+        idcol: str, name of id column from response table
+
+        *args: args to be passed into query_func
+
+        **kwargs: kwargs to be passed into the query_func
+
+        Returns
+        -------
+        `concurrent.futures.Future`, the refresh
+        """
+        query_hash = plan["hash"]
+        with self._refresh_lock:
+            future = self._refreshes.get(query_hash)
+            if future is not None:
+                return future
+            if self._refresh_executor is None:
+                self._refresh_executor = ThreadPoolExecutor(
+                    max_workers=self.refresh_workers,
+                    thread_name_prefix="astrostash-refresh")
+            future = self._refresh_executor.submit(
+                self._refresh, query_func, plan, table_name, idcol,
+                *args, **kwargs)
+            self._refreshes[query_hash] = future
+        future.add_done_callback(
+            lambda f: self._refresh_done(query_hash, f))
+        return future
+
+    def _refresh(self, query_func, plan: dict, table_name: str, idcol: str,
+                 *args, **kwargs) -> None:
+        """
+        Runs a background refresh, stashing through a connection that can
+        be used from the refresher threads
+        """
+        with self.metrics.fetch(table_name):
+            self.metrics.set_outcome("refresh")
+            df = self._run_query(query_func, plan["params"], *args, **kwargs)
+            self._stash_background_refresh(df, plan, table_name, idcol)
+
+    def _stash_background_refresh(self, df: pd.DataFrame, plan: dict,
+                                  table_name: str, idcol: str) -> None:
+        """
+        Stashes the response of a background refresh
+        """
+        with self._refresh_lock:
+            if self.thread_safe is True:
+                self._refresh_db = self
+            elif self._refresh_db is None:
+                self._refresh_db = SQLiteDB(self.db_name, cache_entries=0,
+                                            pragmas=self.pragmas,
+                                            retries=self.retries,
+                                            thread_safe=True,
+                                            metrics=self.metrics)
+                if self.tracer is not None:
+                    self._refresh_db.start_tracing(tracer=self.tracer)
+        _, changed = self._refresh_db._stash_response(
+            df, plan["hash"], plan["qid"], plan["refresh_rate"], table_name,
+            idcol)
+        if changed is True and self._refresh_db is not self:
+            self.result_cache.invalidate_table(table_name)
+            self._table_versions[table_name] = \
+                self.table_version(table_name) + 1
+
+    def _refresh_done(self, query_hash: str, future) -> None:
+        """
+        Removes a finished background refresh from the pending refreshes,
+        keeping it until the next wait_for_refreshes if it failed
+        """
+        with self._refresh_lock:
+            if self._refreshes.get(query_hash) is future:
+                del self._refreshes[query_hash]
+            if future.exception() is not None:
+                self._failed_refreshes.append(future)
 
-        location: str, local path to data product
+    def pending_refreshes(self) -> dict:
+        """
+        Gets the background refreshes still running
 
         Returns
         -------
-        int, id for the record of the data path location
+        dict, `concurrent.futures.Future` of each refresh by query hash
         """
-        query = """INSERT OR IGNORE INTO local_data_paths (
-                        catalog,
-                        rowid,
-                        location)
-                   VALUES (
-                        :catalog,
-                        :rowid,
-                        :location)"""
-        self.cursor.execute(query, {"catalog": catalog,
-                                    "rowid": rowid,
-                                    "location": location})
-        self.conn.commit()
-        return self.cursor.lastrowid
+        with self._refresh_lock:
+            return dict(self._refreshes)
 
-    def fetch_sync(self, query_func, table_name: str,
-                   query_params: dict,
-                   refresh_rate: int | None,
-                   idcol: str = "__row",
-                   refresh: bool = False,
-                   *args, **kwargs) -> pd.DataFrame:
+    def wait_for_refreshes(self, timeout: float | None = None) -> list:
         """
-        Fetches existing data from the user's database if it exists from a
-        previous query. Otherwise adds the query reference to the db, executes
-        the query function with the passed in function args + kwargs, and
-        stashes the results in the db in the table name specified.
+        Waits for the pending background refreshes to finish
+
+        Parameters
+        ----------
+        timeout: float or None, optional, maximum number of seconds to wait
+
+        Returns
+        -------
+        list, exceptions raised by the refreshes that failed since the last
+              call
+        """
+        done, _ = wait(self.pending_refreshes().values(), timeout=timeout)
+        failed = {f for f in done if f.exception() is not None}
+        with self._refresh_lock:
+            failed.update(self._failed_refreshes)
+            self._failed_refreshes.clear()
+        return [f.exception() for f in failed]
+
+    def _plan_fetch(self, query_params: dict, refresh_rate: int | None,
+                    refresh: bool) -> dict:
+        """
+        Database side first half of fetch_sync, works out whether a query
+        can be served from the stash or needs to be sent to the external
+        service
+
+        Parameters
+        ----------
+        query_params: dict, parameters for the query, including the
+                            refresh_rate and refresh parameters
+
+        refresh_rate: int or None, number of days before refresh is needed
+
+        refresh: bool, True if refresh toggled on
+
+        Returns
+        -------
+        dict, plan with the query parameters (params), hash, query id (qid),
+              whether the query needs to be run (fetch), the last refresh
+              date, refresh rate, and the cached result (frame) if the query
+              can be served from the result cache
+        """
+        query_params = query_params.copy()
+        del query_params["refresh_rate"], query_params["refresh"]
+        with self.metrics.phase("hash"):
+            query_hash = sha256sum(query_params)
+        plan = {"params": query_params,
+                "hash": query_hash,
+                "qid": None,
+                "fetch": False,
+                "frame": None,
+                "last_refreshed": None,
+                "refresh_rate": refresh_rate}
+        if refresh is False:
+            with self.metrics.phase("result_cache"):
+                cached = self.result_cache.get(
+                    query_hash,
+                    lambda entry: self._is_cache_fresh(entry, refresh_rate))
+            if cached is not None:
+                plan["frame"] = cached["frame"].copy()
+                return plan
+        with self.metrics.phase("get_query"):
+            qdf = self.get_query(query_hash)
+            plan["qid"], refresh = self._get_queryid(qdf, refresh,
+                                                     refresh_rate)
+        if qdf.empty is True or refresh is True:
+            plan["fetch"] = True
+        else:
+            plan["last_refreshed"] = qdf["last_refreshed"].iloc[0]
+        return plan
+
+    def _finish_fetch(self, plan: dict, df: pd.DataFrame | None,
+                      table_name: str, idcol: str) -> pd.DataFrame:
+        """
+        Database side second half of fetch_sync, stashes the response of the
+        external query (if it was run) and reads the query's stashed rows
+
+        Parameters
+        ----------
+        plan: dict, plan from _plan_fetch
+
+        df: pd.DataFrame or None, response of the external query, None if the
+                                  query was not run
+
+        table_name: str, name of the table/catalog in the database
+
+        idcol: str, name of id column from response table
+
+        Returns
+        -------
+        pd.DataFrame, table with the results of the query
+        """
+        qid = plan["qid"]
+        last_refreshed = plan["last_refreshed"]
+        if df is not None:
+            with self.transaction():
+                qid, _ = self._stash_response(df, plan["hash"], qid,
+                                              plan["refresh_rate"],
+                                              table_name, idcol)
+                if "call" in plan:
+                    self.insert_query_call(qid, plan["call"][0], table_name,
+                                           idcol, plan["params"],
+                                           plan["call"][1])
+                if "footprint" in plan:
+                    signature, ra, dec, radius = plan["footprint"]
+                    self.insert_footprint(qid, table_name, ra, dec, radius,
+                                          signature)
+            last_refreshed = _today()
+        with self.metrics.phase("read"):
+            df = self._get_stashed_rows(table_name, qid, idcol)
+        self._count_rows(df)
+        self.result_cache.put(plan["hash"], df, table_name, qid,
+                              last_refreshed, self.get_refresh_rate(qid))
+        return df.copy()
+
+    def fetch_sync_iter(self, query_func, table_name: str,
+                        query_params: dict,
+                        refresh_rate: int | None,
+                        idcol: str = "__row",
+                        refresh: bool = False,
+                        chunksize: int = 10000,
+                        *args, **kwargs):
+        """
+        Streaming fetch_sync for large results. The response of the external
+        query (if executed) is converted and stashed chunksize rows at a
+        time, and the stashed rows are read back and yielded in chunks of
+        chunksize rows, so no full DataFrame of the result is built.
 
         Parameters:
         query_func: function, function to call to execute astroquery function
@@ -532,43 +2725,617 @@ class SQLiteDB:
 
         table_name: str, table name from user's db
 
-        db_query: str, SQL query to get data from local db table
+        query_params: dict, parameters for the query
+
+        refresh_rate: int or None, number of days before refresh is needed
+
+        idcol: str, name of id column from response table
+
+        refresh: bool, refresh the query if True
+
+        chunksize: int, number of rows per chunk
+
+        *args: args to be passed into query_func (if executed)
+
+        **kwargs: kwargs to be passed into the query_func (if executed)
+
+        Yields:
+        pd.DataFrame, chunks of the table with the results of the query
+        """
+        plan = self._plan_fetch(query_params, refresh_rate, refresh)
+        if plan["frame"] is not None:
+            for start in range(0, len(plan["frame"]), chunksize):
+                yield plan["frame"].iloc[start:start + chunksize]
+            return
+        qid = plan["qid"]
+        if plan["fetch"] is True:
+            table = self._run_query_table(query_func, plan["params"],
+                                          *args, **kwargs)
+            qid = self._stash_response_chunks(table, plan["hash"], qid,
+                                              refresh_rate, table_name,
+                                              idcol, chunksize)
+            del table
+        yield from self._iter_stashed_rows(table_name, qid, idcol, chunksize)
+
+    def fetch_sync_many(self, query_func, table_name: str,
+                        params_list: list,
+                        refresh_rate: int | None,
+                        idcol: str = "__row",
+                        refresh: bool = False,
+                        max_workers: int = 8,
+                        *args, call_name: str | None = None,
+                        **kwargs) -> list:
+        """
+        Batched fetch_sync for many queries against the same table. Repeated
+        queries are only run once, stashed results are read in one pass, and
+        the queries that need to go to the external service run concurrently
+        in a bounded thread pool, with all of their responses stashed in a
+        single transaction.
+
+        Parameters:
+        query_func: function, function to call to execute astroquery function
+                              if stashed results do not exist
+
+        table_name: str, table name from user's db
+
+        params_list: list, query parameters (dict) of each query
+
+        refresh_rate: int or None, number of days before refresh is needed
+
+        idcol: str, name of id column from response table
+
+        refresh: bool, refresh all of the queries if True
+
+        max_workers: int, maximum number of concurrent external queries
 
         *args: args to be passed into query_func (if executed)
 
+        call_name: str or None, name the calls are stored under so
+                   refresh_stale can replay them, not stored if None
+
         **kwargs: kwargs to be passed into the query_func (if executed)
 
         Returns:
-        pd.DataFrame, table with the results of the query
+        list, table with the results of each query in params_list
         """
-        del query_params["refresh_rate"], query_params["refresh"]
-        query_hash = sha256sum(query_params)
-        qdf = self.get_query(query_hash)
-        qid, refresh = self._get_queryid(qdf, refresh, refresh_rate)
-        if qdf.empty is True or refresh is True:
-            # If there is no query matching the hash then the query
-            # has not been requested before, so we need to insert the query
-            # hash to get a queryid, and then stash the query results in a
-            # new data table
+        plan = self._plan_fetch_many(params_list, refresh_rate, refresh)
+        results, qids = plan["results"], plan["qids"]
+        if len(plan["fetch"]) > 0:
+            self._run_queries(query_func, plan, refresh_rate, table_name,
+                              idcol, max_workers, call_name, *args, **kwargs)
+        if len(plan["pending"]) > 0:
+            stashed = self._get_stashed_rows_many(table_name,
+                                                  list(qids.values()),
+                                                  idcol)
+        for query_hash in plan["pending"]:
+            qid = qids[query_hash]
+            results[query_hash] = stashed[qid]
+            self.result_cache.put(query_hash, stashed[qid], table_name, qid,
+                                  plan["last_refreshed"][query_hash],
+                                  self.get_refresh_rate(qid))
+        return [results[query_hash].copy() for query_hash in plan["hashes"]]
+
+    def _plan_fetch_many(self, params_list: list, refresh_rate: int | None,
+                         refresh: bool) -> dict:
+        """
+        Plans a fetch_sync_many, hashing and deduplicating the queries,
+        serving what it can from the result cache, and looking the rest up
+        in one pass
+
+        Parameters
+        ----------
+        params_list: list, query parameters (dict) of each query
+
+        refresh_rate: int or None, number of days before refresh is needed
+
+        refresh: bool, refresh all of the queries if True
+
+        Returns
+        -------
+        dict, plan with the hash of each query (hashes), the parameters of
+              each unique query (unique), the cached results (results), the
+              hashes not cached (pending) with their query ids (qids) and
+              last refresh dates (last_refreshed), and the hashes of the
+              queries that need to be run (fetch)
+        """
+        hashes = []
+        unique = {}
+        for query_params in params_list:
+            query_params = query_params.copy()
+            del query_params["refresh_rate"], query_params["refresh"]
+            query_hash = sha256sum(query_params)
+            hashes.append(query_hash)
+            unique.setdefault(query_hash, query_params)
+        results = {}
+        if refresh is False:
+            for query_hash in unique:
+                cached = self.result_cache.get(
+                    query_hash,
+                    lambda entry: self._is_cache_fresh(entry, refresh_rate))
+                if cached is not None:
+                    results[query_hash] = cached["frame"]
+        pending = [h for h in unique if h not in results]
+        qdfs = self.get_queries(pending)
+        qids = {}
+        fetch = []
+        last_refreshed = {}
+        for query_hash in pending:
+            qdf = qdfs[qdfs["hash"] == query_hash].reset_index(drop=True)
+            qids[query_hash], needed = self._get_queryid(qdf, refresh,
+                                                         refresh_rate)
+            if qdf.empty is True or needed is True:
+                fetch.append(query_hash)
+                last_refreshed[query_hash] = _today()
+            else:
+                last_refreshed[query_hash] = qdf["last_refreshed"].iloc[0]
+        return {"hashes": hashes,
+                "unique": unique,
+                "results": results,
+                "pending": pending,
+                "qids": qids,
+                "last_refreshed": last_refreshed,
+                "fetch": fetch}
+
+    def _run_queries(self, query_func, plan: dict, refresh_rate: int | None,
+                     table_name: str, idcol: str, max_workers: int,
+                     call_name: str | None, *args, **kwargs) -> None:
+        """
+        Runs the queries of a fetch_sync_many plan that need to go to the
+        external service concurrently in a bounded thread pool, and stashes
+        all of their responses in a single transaction, updating the query
+        ids of the plan
+
+        Parameters
+        ----------
+        query_func: function, function to call to execute the queries
+
+        plan: dict, plan from _plan_fetch_many
+
+        refresh_rate: int or None, number of days before refresh is needed
+
+        table_name: str, name of the table/catalog in the database
+
+        idcol: str, name of id column from response table
+
+        max_workers: int, maximum number of concurrent external queries
+
+        call_name: str or None, name the calls are stored under, not stored
+                   if None
+
+        *args: args to be passed into query_func
+
+        **kwargs: kwargs to be passed into query_func
+        """
+        unique, qids = plan["unique"], plan["qids"]
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {h: pool.submit(self._run_query, query_func,
+                                      unique[h], *args, **kwargs)
+                       for h in plan["fetch"]}
+            responses = {h: f.result() for h, f in futures.items()}
+        with self.transaction():
+            for query_hash in plan["fetch"]:
+                qids[query_hash], _ = self._stash_response(
+                    responses[query_hash], query_hash, qids[query_hash],
+                    refresh_rate, table_name, idcol)
+                if call_name is not None:
+                    self.insert_query_call(qids[query_hash], call_name,
+                                           table_name, idcol,
+                                           unique[query_hash], kwargs)
+
+    def insert_query_call(self, qid: int, method: str, table_name: str,
+                          idcol: str, params: dict, kwargs: dict) -> bool:
+        """
+        Stores the call behind a query, so it can be replayed to refresh
+        the query
+
+        Parameters
+        ----------
+        qid: int, query id
+
+        method: str, name of the call, refresh_stale looks the function to
+                     replay it with up by this name
+
+        table_name: str, name of the table/catalog the query is stashed to
+
+        idcol: str, name of id column from response table
+
+        params: dict, query parameters (without refresh_rate and refresh)
+
+        kwargs: dict, additional kwargs passed into the query function
+
+        Returns
+        -------
+        bool, True if stored, False if the parameters can not be serialized
+        """
+        try:
+            params = json.dumps(params, default=_encode_param)
+            kwargs = json.dumps(kwargs, default=_encode_param)
+        except (TypeError, ValueError):
+            return False
+        with self.transaction():
+            self.cursor.execute(
+                """INSERT OR REPLACE INTO query_calls (
+                       queryid,
+                       method,
+                       table_name,
+                       idcol,
+                       params,
+                       kwargs
+                   )
+                   VALUES (:qid, :method, :table_name, :idcol, :params,
+                           :kwargs);""",
+                {"qid": qid, "method": method, "table_name": table_name,
+                 "idcol": idcol, "params": params, "kwargs": kwargs})
+        return True
+
+    def get_query_call(self, qid: int) -> dict | None:
+        """
+        Gets the stored call behind a query
+
+        Parameters
+        ----------
+        qid: int, query id
+
+        Returns
+        -------
+        dict or None, method, table_name, idcol, params and kwargs of the
+                      call, None if not stored
+        """
+        self.cursor.execute("""SELECT method, table_name, idcol, params,
+                                      kwargs
+                               FROM query_calls
+                               WHERE queryid = :qid;""",
+                            {"qid": qid})
+        call = self.cursor.fetchone()
+        if call is None:
+            return None
+        return {"method": call[0],
+                "table_name": call[1],
+                "idcol": call[2],
+                "params": json.loads(call[3], object_hook=_decode_param),
+                "kwargs": json.loads(call[4], object_hook=_decode_param)}
+
+    def get_stale_queries(self) -> pd.DataFrame:
+        """
+        Gets the queries due for a refresh (same rule as needs_refresh)
+        that have a stored call to replay
+
+        Returns
+        -------
+        pd.DataFrame, id, hash, last_refreshed and refresh_rate of each
+                      stale query, with the method, table_name, idcol,
+                      params and kwargs (json) of its call
+        """
+        return pd.read_sql(
+            """SELECT q.id, q.hash, q.last_refreshed, q.refresh_rate,
+                      c.method, c.table_name, c.idcol, c.params, c.kwargs
+               FROM queries q
+               JOIN query_calls c ON c.queryid = q.id
+               WHERE q.refresh_rate IS NOT NULL
+                 AND julianday(date('now', 'localtime'))
+                     - julianday(q.last_refreshed) >= q.refresh_rate
+               ORDER BY q.id;""",
+            self.conn)
+
+    def refresh_stale(self, query_funcs: dict, max_workers: int = 8,
+                      batch_size: int = 50) -> dict:
+        """
+        Refreshes every stale query with a stored call, replaying the calls
+        concurrently and stashing the responses batch_size at a time in a
+        single transaction each
+
+        Parameters
+        ----------
+        query_funcs: dict, function to replay the calls of each method with
+
+        max_workers: int, optional, maximum number of concurrent external
+                                    queries
+
+        batch_size: int, optional, number of responses stashed per
+                                   transaction
+
+        Returns
+        -------
+        dict, ids of the refreshed queries (refreshed), ids of the
+              refreshed queries whose response was unchanged (unchanged),
+              the exception of each query that failed (failed), and ids of
+              the queries with no function for their method (skipped)
+        """
+        stale = self.get_stale_queries()
+        summary = {"refreshed": [], "unchanged": [], "failed": {},
+                   "skipped": []}
+        calls = []
+        for row in stale.itertuples(index=False):
+            if row.method in query_funcs:
+                calls.append(row)
+            else:
+                summary["skipped"].append(int(row.id))
+        if len(calls) == 0:
+            return summary
+        batch = []
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {}
+            for row in calls:
+                params = json.loads(row.params, object_hook=_decode_param)
+                kwargs = json.loads(row.kwargs, object_hook=_decode_param)
+                futures[pool.submit(self._run_query, query_funcs[row.method],
+                                    params, **kwargs)] = row
+            for future in as_completed(futures):
+                row = futures[future]
+                try:
+                    batch.append((row, future.result()))
+                except Exception as exc:
+                    summary["failed"][int(row.id)] = exc
+                if len(batch) >= batch_size:
+                    self._stash_refreshed(batch, summary)
+                    batch = []
+        self._stash_refreshed(batch, summary)
+        return summary
+
+    def _stash_refreshed(self, batch: list, summary: dict) -> None:
+        """
+        Stashes a batch of refreshed responses in a single transaction
+
+        Parameters
+        ----------
+        batch: list, (stale query row, response) pairs
+
+        summary: dict, refresh_stale summary the refreshed (and unchanged)
+                       query ids are added to
+        """
+        stashed = []
+        with self.transaction():
+            for row, df in batch:
+                with self.metrics.fetch(row.table_name):
+                    self.metrics.set_outcome("refresh")
+                    stashed.append(self._stash_response(df, row.hash,
+                                                        int(row.id), None,
+                                                        row.table_name,
+                                                        row.idcol))
+        for qid, changed in stashed:
+            summary["refreshed"].append(qid)
+            if changed is False:
+                summary["unchanged"].append(qid)
+
+    def _is_cache_fresh(self, entry: dict,
+                        refresh_rate: int | None) -> bool:
+        """
+        Checks whether a cached query result can be served as is, i.e. it
+        does not need a refresh and the refresh rate is not being changed
+
+        Parameters
+        ----------
+        entry: dict, result cache entry
+
+        refresh_rate: int or None, refresh rate requested by the caller
+
+        Returns
+        -------
+        bool, True if the cached result can be served
+        """
+        if refresh_rate is not None and refresh_rate != entry["refresh_rate"]:
+            return False
+        if entry["refresh_rate"] is None:
+            return True
+        return not needs_refresh(entry["last_refreshed"],
+                                 entry["refresh_rate"])
+
+    def _run_query(self, query_func, query_params: dict,
+                   *args, **kwargs) -> pd.DataFrame:
+        """
+        Executes an external query and converts the response to a frame
+
+        Parameters
+        ----------
+        query_func: function, astroquery function to execute
+
+        query_params: dict, parameters to be passed into query_func
+
+        *args: args to be passed into query_func
+
+        **kwargs: kwargs to be passed into the query_func
+
+        Returns
+        -------
+        pd.DataFrame, response of the external query
+        """
+        table = self._run_query_table(query_func, query_params,
+                                      *args, **kwargs)
+        with self.metrics.phase("to_pandas"):
+            df = table.to_pandas(index=False)
+        self._count_rows(df, "response_")
+        return df
+
+    def _run_query_table(self, query_func, query_params: dict,
+                         *args, **kwargs):
+        """
+        Executes an external query
+
+        Parameters
+        ----------
+        query_func: function, astroquery function to execute
+
+        query_params: dict, parameters to be passed into query_func
+
+        *args: args to be passed into query_func
+
+        **kwargs: kwargs to be passed into the query_func
+
+        Returns
+        -------
+        `astropy.table.Table`, response of the external query
+        """
+        with self.metrics.phase("remote"):
+            response = query_func(*args, **query_params, **kwargs)
+            if not hasattr(response, "to_pandas"):
+                response = response.to_table()
+        return response
+
+    def _stash_response(self, df: pd.DataFrame, query_hash: str,
+                        qid: int | None, refresh_rate: int | None,
+                        table_name: str, idcol: str) -> tuple:
+        """
+        Records a query, its response and the response rows in a single
+        transaction, so a failure part way through leaves nothing behind.
+        When the query is already linked to the same response (same
+        response hash), its rows are not stashed again, which makes
+        refreshing an unchanged query a no-op apart from its last_refreshed
+        date.
+
+        Parameters
+        ----------
+        df: pd.DataFrame, response of the external query
+
+        query_hash: str, sha256 hash of the query parameters
+
+        qid: int or None, query id, None if the query is not yet recorded
+
+        refresh_rate: int or None, number of days before refresh is needed
+
+        table_name: str, name of the table/catalog in the database
+
+        idcol: str, name of id column from response table
+
+        Returns
+        -------
+        tuple, (query id, False if the response was unchanged)
+        """
+        refresh = qid is not None
+        with self.transaction():
+            qid = self._record_query(query_hash, qid, refresh_rate)
+            with self.metrics.phase("ingest"):
+                changed = self._ingest_response_and_links(df, qid, idcol)
+            if changed is False \
+                    and self._check_table_exists(table_name) is False:
+                changed = True
+            if changed is True:
+                # Stash the the external response in the database
+                with self.metrics.phase("stash"):
+                    self._stash_table(df, table_name, idcol)
+        if refresh is True:
+            self._refresh_count += 1
+            if changed is False:
+                self._unchanged_refreshes += 1
+                self.metrics.count("unchanged_refreshes", 1)
+        return qid, changed
+
+    def _record_query(self, query_hash: str, qid: int | None,
+                      refresh_rate: int | None) -> int:
+        """
+        Inserts a new query, or marks an existing query as refreshed
+
+        Parameters
+        ----------
+        query_hash: str, sha256 hash of the query parameters
+
+        qid: int or None, query id, None if the query is not yet recorded
+
+        refresh_rate: int or None, number of days before refresh is needed
+
+        Returns
+        -------
+        int, query id
+        """
+        with self.transaction():
+            if qid is None:
+                # Another writer may have recorded the query since it was
+                # looked up
+                qdf = self.get_query(query_hash)
+                if qdf.empty is False:
+                    qid = int(qdf["id"].iloc[0])
             if qid is None:
                 qid = self.insert_query(query_hash, refresh_rate)
             else:
                 self.update_last_refreshed(qid)
-            try:
-                df = query_func(*args,
-                                **query_params,
-                                **kwargs).to_pandas(index=False)
-            except AttributeError:
-                df = query_func(*args,
-                                **query_params,
-                                **kwargs).to_table().to_pandas(index=False)
-            self._ingest_response_and_links(df, qid, idcol)
-            # Stash the the external response in the database
-            self._stash_table(df, table_name, idcol)
-        return self._get_stashed_rows(table_name, qid, idcol)
+        return qid
+
+    def _stash_response_chunks(self, table, query_hash: str,
+                               qid: int | None, refresh_rate: int | None,
+                               table_name: str, idcol: str,
+                               chunksize: int) -> int:
+        """
+        Streaming counterpart of _stash_response. The response is converted,
+        hashed and stashed chunksize rows at a time, with the row ids staged
+        in a temporary table until the response hash is known, all in a
+        single transaction.
+
+        Parameters
+        ----------
+        table: `astropy.table.Table`, response of the external query
+
+        query_hash: str, sha256 hash of the query parameters
+
+        qid: int or None, query id, None if the query is not yet recorded
+
+        refresh_rate: int or None, number of days before refresh is needed
+
+        table_name: str, name of the table/catalog in the database
+
+        idcol: str, name of id column from response table
+
+        chunksize: int, number of rows to convert and stash at a time
+
+        Returns
+        -------
+        int, query id
+        """
+        hasher = ResultHasher()
+        with self.transaction():
+            qid = self._record_query(query_hash, qid, refresh_rate)
+            self.cursor.execute(
+                """CREATE TEMP TABLE IF NOT EXISTS staged_rowids (
+                       rowid TEXT
+                   );""")
+            self.cursor.execute("DELETE FROM temp.staged_rowids;")
+            for start in range(0, max(len(table), 1), chunksize):
+                df = table[start:start + chunksize].to_pandas(index=False)
+                hasher.update(df)
+                self._stash_table(df, table_name, idcol)
+                self.cursor.executemany(
+                    "INSERT INTO temp.staged_rowids (rowid) VALUES (?);",
+                    ((str(rowid),) for rowid in df[idcol].values))
+            self._link_staged_response(hasher.hexdigest(), qid)
+            self.cursor.execute("DELETE FROM temp.staged_rowids;")
+        return qid
+
+    def _link_staged_response(self, response_hash: str, qid: int) -> None:
+        """
+        Ingests response info and links between the response and the row
+        ids staged in the temp.staged_rowids table
+
+        Parameters
+        ----------
+        response_hash: str, SHA-256 hash of the response
+
+        qid: int, query id
+        """
+        with self.transaction():
+            rid = self._get_response_id(response_hash)
+            if rid is None:
+                rid = self.insert_response(response_hash)
+                self.cursor.execute(
+                    """INSERT OR IGNORE INTO response_rowid_pivot (
+                           responseid,
+                           rowid
+                       )
+                       SELECT :rid, rowid FROM temp.staged_rowids;""",
+                    {"rid": rid})
+                self._relink_query(qid, rid)
+            elif self._check_query_response_link(qid, rid[0]) == 0:
+                self._relink_query(qid, rid[0])
 
     def close(self):
         """
-        Close the database connection.
+        Close the database connections, after any background refreshes
+        finish.
         """
-        return self.conn.close()
+        if self._refresh_executor is not None:
+            self._refresh_executor.shutdown(wait=True)
+            if self._refresh_db not in (None, self):
+                self._refresh_db.close()
+        self.result_cache.clear()
+        with self._write_lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers.clear()
+            return self._writer_conn.close()
@@ -0,0 +1,170 @@
+from collections import OrderedDict
+import threading
+import pandas as pd
+
+
+class ResultCache:
+    """
+    Bounded in-memory LRU cache of query results keyed by query hash
+    """
+    def __init__(self, max_entries: int = 128,
+                 max_bytes: int = 64 * 1024 ** 2):
+        """
+        Parameters
+        ----------
+        max_entries: int, optional, maximum number of cached results,
+                                    0 disables the cache (default 128)
+
+        max_bytes: int, optional, maximum total (deep) memory usage of the
+                                  cached frames in bytes (default 64 MiB)
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, query_hash: str) -> bool:
+        return query_hash in self._entries
+
+    def get(self, query_hash: str, is_valid=None) -> dict | None:
+        """
+        Gets a cached result and marks it as the most recently used
+
+        Parameters
+        ----------
+        query_hash: str, sha256 hash of the query parameters
+
+        is_valid: function or None, optional, called with the entry, a
+                  falsy return drops the entry and counts as a miss
+
+        Returns
+        -------
+        dict or None, entry with the cached frame (frame), table name (table),
+                      query id (qid), last_refreshed and refresh_rate,
+                      None if not cached
+        """
+        with self._lock:
+            entry = self._entries.get(query_hash)
+            if entry is not None and is_valid is not None \
+                    and not is_valid(entry):
+                self._remove(query_hash)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(query_hash)
+            self.hits += 1
+            return entry
+
+    def put(self, query_hash: str, frame: pd.DataFrame, table: str,
+            qid: int, last_refreshed: str,
+            refresh_rate: int | None) -> None:
+        """
+        Caches a query result, evicting the least recently used results
+        when the entry or memory limits are exceeded
+
+        Parameters
+        ----------
+        query_hash: str, sha256 hash of the query parameters
+
+        frame: pd.DataFrame, result of the query
+
+        table: str, name of the table/catalog the result was read from
+
+        qid: int, query id
+
+        last_refreshed: str, date of last refresh in format YYYY-MM-DD
+
+        refresh_rate: int or None, number of days before refresh is needed
+        """
+        nbytes = int(frame.memory_usage(index=True, deep=True).sum())
+        if self.max_entries <= 0 or nbytes > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(query_hash)
+            self._entries[query_hash] = {"frame": frame,
+                                         "table": table,
+                                         "qid": qid,
+                                         "last_refreshed": last_refreshed,
+                                         "refresh_rate": refresh_rate,
+                                         "nbytes": nbytes}
+            self.nbytes += nbytes
+            while len(self._entries) > self.max_entries \
+                    or self.nbytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, query_hash: str) -> None:
+        """
+        Removes an entry (if cached), the caller must hold the lock
+        """
+        entry = self._entries.pop(query_hash, None)
+        if entry is not None:
+            self.nbytes -= entry["nbytes"]
+
+    def invalidate(self, query_hash: str) -> None:
+        """
+        Drops the cached result of a query
+
+        Parameters
+        ----------
+        query_hash: str, sha256 hash of the query parameters
+        """
+        with self._lock:
+            self._remove(query_hash)
+
+    def invalidate_query(self, qid: int) -> None:
+        """
+        Drops the cached result of a query by query id
+
+        Parameters
+        ----------
+        qid: int, query id
+        """
+        with self._lock:
+            for key in [key for key, entry in self._entries.items()
+                        if entry["qid"] == qid]:
+                self._remove(key)
+
+    def invalidate_table(self, table: str) -> None:
+        """
+        Drops every cached result read from a table, e.g. after the table is
+        written to
+
+        Parameters
+        ----------
+        table: str, name of the table/catalog
+        """
+        with self._lock:
+            for key in [key for key, entry in self._entries.items()
+                        if entry["table"] == table]:
+                self._remove(key)
+
+    def clear(self) -> None:
+        """
+        Drops every cached result
+        """
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        """
+        Gets the cache counters, e.g. to size the cache
+
+        Returns
+        -------
+        dict, hits, misses, evictions, entries and bytes
+        """
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.nbytes}
@@ -0,0 +1,66 @@
+import argparse
+import sys
+
+
+def refresh(args) -> int:
+    """
+    Refreshes the stale queries of a database
+
+    Parameters:
+    args: argparse.Namespace, parsed command line arguments
+
+    Returns:
+    int, exit code, 1 if any query failed to refresh
+    """
+    from astrostash.heasarc import Heasarc
+    heasarc = Heasarc(db_name=args.db)
+    try:
+        if args.dry_run is True:
+            stale = heasarc.ldb.get_stale_queries()
+            for row in stale.itertuples(index=False):
+                print(f"{row.id}\t{row.method}\t{row.table_name}\t"
+                      f"{row.last_refreshed}")
+            print(f"{len(stale)} stale queries")
+            return 0
+        summary = heasarc.refresh_stale(max_workers=args.max_workers,
+                                        batch_size=args.batch_size)
+    finally:
+        heasarc.ldb.close()
+    for qid, exc in summary["failed"].items():
+        print(f"query {qid} failed: {exc!r}", file=sys.stderr)
+    print(f"{len(summary['refreshed'])} refreshed "
+          f"({len(summary['unchanged'])} unchanged), "
+          f"{len(summary['failed'])} failed, "
+          f"{len(summary['skipped'])} skipped")
+    return 1 if len(summary["failed"]) > 0 else 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """
+    Builds the parser of the astrostash command line interface
+    """
+    parser = argparse.ArgumentParser(prog="astrostash")
+    commands = parser.add_subparsers(dest="command", required=True)
+    refresh_parser = commands.add_parser(
+        "refresh", help="re-run every stashed query due for a refresh")
+    refresh_parser.add_argument("--db", default=None,
+                                help="path to the database "
+                                     "(default astrostash.db)")
+    refresh_parser.add_argument("--max-workers", type=int, default=8,
+                                help="maximum number of concurrent queries")
+    refresh_parser.add_argument("--batch-size", type=int, default=50,
+                                help="number of responses stashed per "
+                                     "transaction")
+    refresh_parser.add_argument("--dry-run", action="store_true",
+                                help="only list the stale queries")
+    refresh_parser.set_defaults(func=refresh)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
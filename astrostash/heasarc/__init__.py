@@ -1,6 +1,32 @@
-from .core import Heasarc
+import importlib
+
+
+# Public names and the submodule defining them, imported on first access
+# (PEP 562) so that importing astrostash.heasarc does not load astroquery
+_LAZY_ATTRS = {
+    "Heasarc": "astrostash.heasarc.core",
+    "AsyncHeasarc": "astrostash.heasarc.aio",
+}
+
+# Submodules, also imported on first access
+_SUBMODULES = ("aio", "core")
 
 
 __all__ = [
     "Heasarc",
+    "AsyncHeasarc",
 ]
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRS:
+        value = getattr(importlib.import_module(_LAZY_ATTRS[name]), name)
+        globals()[name] = value
+        return value
+    if name in _SUBMODULES:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()).union(__all__))
@@ -0,0 +1,166 @@
+import asyncio
+import functools
+import inspect
+import json
+from concurrent.futures import ThreadPoolExecutor
+from astrostash.astrostash import _encode_param
+from astrostash.heasarc.core import Heasarc
+import pandas as pd
+
+
+class AsyncHeasarc:
+    """
+    asyncio front end for Heasarc. Each call runs the matching blocking
+    Heasarc method in a thread pool (bounded by max_concurrency), so
+    requests to the heasarc overlap. The wrapped Heasarc shares its database
+    between the threads (thread_safe), which serializes every write on a
+    single writer connection.
+    """
+    def __init__(self, db_name=None, max_concurrency=16, **kwargs):
+        """
+        Parameters
+        ----------
+        db_name: str or None, optional, path to the database,
+                                        default astrostash.db
+
+        max_concurrency: int, optional, maximum number of Heasarc calls in
+                                        flight at once
+
+        **kwargs: additional kwargs to be passed into astrostash.SQLiteDB
+        """
+        self.heasarc = Heasarc(db_name, thread_safe=True, **kwargs)
+        self.ldb = self.heasarc.ldb
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency,
+            thread_name_prefix="astrostash-heasarc")
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._inflight = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    async def _call(self, method: str, *args, **kwargs):
+        """
+        Runs a blocking Heasarc method in the thread pool
+
+        Parameters
+        ----------
+        method: str, name of the Heasarc method
+
+        *args: args to be passed into the method
+
+        **kwargs: kwargs to be passed into the method
+        """
+        loop = asyncio.get_running_loop()
+        async with self._semaphore:
+            return await loop.run_in_executor(
+                self._executor,
+                functools.partial(getattr(self.heasarc, method),
+                                  *args, **kwargs))
+
+    def _query_key(self, method: str, args: tuple, kwargs: dict):
+        """
+        Gets the key concurrent calls are shared on, the method's parameters
+        as the method sees them (the same params fetch_sync hashes), so
+        positional and keyword arguments and defaults give the same key
+
+        Returns
+        -------
+        str or None, key of the call, None if a parameter can not be encoded
+        """
+        bound = inspect.signature(getattr(self.heasarc, method)).bind(
+            *args, **kwargs)
+        bound.apply_defaults()
+        params = dict(bound.arguments, method=method)
+        try:
+            return json.dumps(params, sort_keys=True, ensure_ascii=True,
+                              default=_encode_param)
+        except TypeError:
+            return None
+
+    async def _query(self, method: str, *args, **kwargs) -> pd.DataFrame:
+        """
+        Runs a Heasarc query method, concurrent calls with the same
+        parameters share a single call
+        """
+        key = self._query_key(method, args, kwargs)
+        if key is None:
+            return await self._call(method, *args, **kwargs)
+        if key in self._inflight:
+            return (await asyncio.shield(self._inflight[key])).copy()
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await self._call(method, *args, **kwargs)
+            future.set_result(result)
+        except BaseException as exc:
+            future.set_exception(exc)
+            # Mark the exception as retrieved if no other call awaits it
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+        return result if result is None else result.copy()
+
+    async def list_catalogs(self, **kwargs) -> pd.DataFrame:
+        """
+        Async Heasarc.list_catalogs
+        """
+        return await self._query("list_catalogs", **kwargs)
+
+    async def query_region(self, position=None, catalog=None,
+                           radius=None, **kwargs) -> pd.DataFrame:
+        """
+        Async Heasarc.query_region
+        """
+        return await self._query("query_region", position=position,
+                                 catalog=catalog, radius=radius, **kwargs)
+
+    async def resolve_names(self, names: list, **kwargs) -> dict:
+        """
+        Async Heasarc.resolve_names
+        """
+        return await self._call("resolve_names", names, **kwargs)
+
+    async def query_object(self, object_name, catalog=None,
+                           radius=None, **kwargs) -> pd.DataFrame:
+        """
+        Async Heasarc.query_object
+        """
+        return await self._query("query_object", object_name,
+                                 catalog=catalog, radius=radius, **kwargs)
+
+    async def query_tap(self, query: str, catalog: str,
+                        **kwargs) -> pd.DataFrame:
+        """
+        Async Heasarc.query_tap
+        """
+        return await self._query("query_tap", query, catalog, **kwargs)
+
+    async def locate_data(self, result_table: pd.DataFrame,
+                          catalog: str) -> pd.DataFrame:
+        """
+        Async Heasarc.locate_data
+        """
+        return await self._call("locate_data", result_table, catalog)
+
+    async def download_data(self, links: pd.DataFrame, catalog: str,
+                            **kwargs) -> None:
+        """
+        Async Heasarc.download_data, the data products are downloaded
+        concurrently by Heasarc.download_data
+        """
+        await self._call("download_data", links, catalog, **kwargs)
+
+    async def aclose(self) -> None:
+        """
+        Shuts down the thread pool, waiting for the calls in flight, then
+        closes the database connections
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None, functools.partial(self._executor.shutdown, wait=True))
+        await loop.run_in_executor(None, self.ldb.close)
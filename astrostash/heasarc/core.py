@@ -1,21 +1,85 @@
-import astroquery.heasarc
-from astropy.coordinates import SkyCoord
-from astropy.table import Table
-from astrostash import SQLiteDB
+from astrostash import SQLiteDB, needs_refresh, sha256sum
 import pandas as pd
 import pathlib as pl
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 class Heasarc:
-    def __init__(self, db_name=None):
-        self.aq = astroquery.heasarc.Heasarc()
-        self.ldb = SQLiteDB(db_name=db_name)
+    # Maximum number of concurrent downloads from each host
+    host_limits = {"aws": 8, "sciserver": 4, "heasarc": 4}
+    # Number of rows the heasarc returns for a query without maxrec, read
+    # from the service if None
+    service_maxrec = None
+
+    def __init__(self, db_name=None, **kwargs):
+        """
+        Parameters
+        ----------
+        db_name: str or None, optional, path to the database,
+                                        default astrostash.db
+
+        **kwargs: additional kwargs to be passed into astrostash.SQLiteDB
+                  (e.g. cache_entries, cache_bytes)
+        """
+        self._aq = None
+        self.ldb = SQLiteDB(db_name=db_name, **kwargs)
+        self._catalog_names = None
+        self._catalog_names_version = None
+        self._host_semaphores = {}
+        self._host_semaphores_lock = threading.Lock()
+
+    @property
+    def aq(self):
+        """
+        astroquery.heasarc.Heasarc instance, astroquery is only imported on
+        first use so cache hits never load it
+        """
+        if self._aq is None:
+            import astroquery.heasarc
+            self._aq = astroquery.heasarc.Heasarc()
+        return self._aq
+
+    @aq.setter
+    def aq(self, aq) -> None:
+        self._aq = aq
+
+    def _get_service_maxrec(self) -> int | None:
+        """
+        Gets the number of rows the heasarc TAP service returns when no
+        maxrec is passed, read from the service's capabilities on first use
+
+        Returns:
+        int or None, row limit, None if it can not be read
+        """
+        if self.service_maxrec is None:
+            try:
+                self.service_maxrec = int(self.aq.tap.maxrec)
+            except Exception:
+                return None
+        return self.service_maxrec
+
+    def _aq_call(self, name: str):
+        """
+        Gets a function calling the astroquery method name, which only
+        imports astroquery once the heasarc actually has to be queried
+
+        Parameters:
+        name: str, name of the astroquery.heasarc.Heasarc method
+
+        Returns:
+        function, calls self.aq.<name> with its args and kwargs
+        """
+        def call(*args, **kwargs):
+            return getattr(self.aq, name)(*args, **kwargs)
+        return call
 
     def list_catalogs(self, *,
                       master=False,
                       keywords=None,
                       refresh_rate=None,
-                      refresh=False) -> pd.DataFrame:
+                      refresh=False,
+                      refresh_policy=None) -> pd.DataFrame:
         """
         Gets a DataFrame of all available catalogs in the form of
         (name, description)
@@ -34,21 +98,30 @@ class Heasarc:
                  Toggles call to the heasarc to refresh the table names
                  response if True
 
+        refresh_policy: str or None, default = None,
+                        how a stale stashed response is served, blocking,
+                        stale-while-revalidate or cache-only, see
+                        SQLiteDB.fetch_sync
+
         Returns:
         pd.DataFrame, heasarc catalogs and descriptions
         """
         params = locals().copy()
-        del params["self"]
-        return self.ldb.fetch_sync(self.aq.list_catalogs,
+        del params["self"], params["refresh_policy"]
+        return self.ldb.fetch_sync(self._aq_call("list_catalogs"),
                                    "heasarc_catalog_list",
                                    params,
                                    refresh_rate,
                                    idcol="name",
-                                   refresh=refresh)
+                                   refresh=refresh,
+                                   refresh_policy=refresh_policy,
+                                   call_name="list_catalogs")
 
     def _check_catalog_exists(self, catalog: str) -> bool:
         """
-        Checks whether or not a catalog exists at the heasarc
+        Checks whether or not a catalog exists at the heasarc. The catalog
+        names are loaded once and reused until the heasarc_catalog_list
+        table is stashed to again.
 
         Parameters:
         catalog: str, name of catalog
@@ -56,12 +129,19 @@ class Heasarc:
         Returns:
         bool, True if catalog exists at the heasarc otherwise false
         """
-        catalogs = self.list_catalogs()["name"].values
-        return catalog in catalogs
+        version = self.ldb.table_version("heasarc_catalog_list")
+        if self._catalog_names is None \
+                or version != self._catalog_names_version:
+            catalogs = self.list_catalogs()["name"].values
+            self._catalog_names = set(catalogs)
+            self._catalog_names_version = self.ldb.table_version(
+                "heasarc_catalog_list")
+        return catalog in self._catalog_names
 
     def query_region(self, position=None, catalog=None,
                      radius=None, refresh_rate=None,
-                     refresh=False, **kwargs) -> pd.DataFrame:
+                     refresh=False, refresh_policy=None,
+                     **kwargs) -> pd.DataFrame:
         """
         Queries a catalog at the heasarc for records around a specific
         region
@@ -83,6 +163,11 @@ class Heasarc:
                  Toggles call to the heasarc to refresh the query response
                  if True
 
+        refresh_policy: str or None, default = None,
+                        how a stale stashed response is served, blocking,
+                        stale-while-revalidate or cache-only, see
+                        SQLiteDB.fetch_sync
+
         **kwargs: additional kwargs to be passed into
                   astroquery.Heasarc.query_region
 
@@ -90,21 +175,257 @@ class Heasarc:
         pd.DataFrame, table of catalog's records around the specified region
         """
         params = locals().copy()
-        del params["self"]
+        del params["self"], params["refresh_policy"]
         if self._check_catalog_exists(catalog):
-            return self.ldb.fetch_sync(self.aq.query_region,
+            # A new cone inside the footprint of a stashed query is answered
+            # from its rows
+            footprint = self._cone_footprint(position, catalog, radius,
+                                             kwargs)
+            # Without maxrec the service's own limit applies, only read once
+            # the heasarc is queried
+            row_limit = kwargs.get("maxrec")
+            if row_limit is None:
+                row_limit = self._get_service_maxrec
+            return self.ldb.fetch_sync(self._aq_call("query_region"),
                                        catalog,
                                        params,
                                        refresh_rate,
                                        refresh=refresh,
+                                       refresh_policy=refresh_policy,
+                                       call_name="query_region",
+                                       footprint=footprint,
+                                       row_limit=row_limit,
                                        **kwargs)
 
+    def _cone_footprint(self, position, catalog: str, radius,
+                        kwargs: dict) -> tuple | None:
+        """
+        Works out the footprint of a region query, if it is one that can be
+        answered from (and used to answer) other cone searches
+
+        Parameters:
+        position: `astropy.coordinates.SkyCoord`, center of the region
+
+        catalog: str, catalog name
+
+        radius: str, float or `~astropy.units.Quantity`, search radius
+
+        kwargs: dict, additional kwargs of the query
+
+        Returns:
+        tuple or None, signature of the other query parameters, ra, dec and
+                       radius in degrees, None if the footprint is unknown
+        """
+        if position is None or isinstance(position, str) \
+                or radius is None \
+                or str(kwargs.get("spatial", "cone")).lower() != "cone" \
+                or kwargs.get("add_offset", False):
+            return None
+        from astropy.coordinates import Angle, SkyCoord
+        if not isinstance(position, SkyCoord) or not position.isscalar:
+            return None
+        if isinstance(radius, (int, float)):
+            radius = Angle(radius, unit="deg")
+        other = {key: val for key, val in kwargs.items()
+                 if key not in ("spatial", "maxrec")}
+        signature = sha256sum({"catalog": catalog, "kwargs": other})
+        icrs = position.icrs
+        return (signature, float(icrs.ra.deg), float(icrs.dec.deg),
+                float(Angle(radius).deg))
+
+    def query_region_local(self, position, catalog: str,
+                           radius) -> pd.DataFrame:
+        """
+        Cone search of the rows of a catalog already stashed, answered
+        through the catalog's spatial index without querying the heasarc
+
+        Parameters:
+        position: str or `astropy.coordinates.SkyCoord`, center of the
+                  cone, a str is resolved as an object name
+
+        catalog: str, catalog name as listed at the heasarc
+
+        radius: str, float or `~astropy.units.Quantity`, search radius,
+                a float is in degrees
+
+        Returns:
+        pd.DataFrame, stashed records of the catalog within the cone
+        """
+        from astropy.coordinates import Angle
+        if isinstance(position, str):
+            position = self.resolve_name(position)
+        if isinstance(radius, (int, float)):
+            radius = Angle(radius, unit="deg")
+        icrs = position.icrs
+        return self.ldb.cone_search(catalog, icrs.ra.deg, icrs.dec.deg,
+                                    Angle(radius).deg)
+
+    def query_region_many(self, positions, catalog=None,
+                          radius=None, refresh_rate=None,
+                          refresh=False, as_dict=False,
+                          max_workers=8, **kwargs):
+        """
+        Queries a catalog at the heasarc for records around many positions.
+        Each position is stashed as the same query query_region would make,
+        repeated positions are only queried once, and positions that are not
+        stashed are queried concurrently.
+
+        Parameters:
+        positions: list of `astropy.coordinates` objects, or a non-scalar
+                   `astropy.coordinates.SkyCoord`, positions to search around
+
+        catalog: str, catalog name as listed at the heasarc
+
+        radius: str or `~astropy.units.Quantity`,
+                search radius
+
+        refresh_rate: int or None, default = None,
+                      time in days before the queries should be refreshed
+
+        refresh: bool, default = False
+                 Toggles call to the heasarc to refresh the query responses
+                 if True
+
+        as_dict: bool, default = False
+                 Return a dict of tables keyed by the index of each position
+                 instead of one concatenated table
+
+        max_workers: int, default = 8
+                     maximum number of concurrent queries to the heasarc
+
+        **kwargs: additional kwargs to be passed into
+                  astroquery.Heasarc.query_region
+
+        Returns:
+        pd.DataFrame, table of catalog's records around the positions, with
+                      the index of the position in an input_index column
+                      (or dict, if as_dict is True)
+        """
+        from astropy.coordinates import SkyCoord
+        if isinstance(positions, SkyCoord) and positions.isscalar:
+            positions = [positions]
+        if self._check_catalog_exists(catalog):
+            params_list = [{"position": position,
+                            "catalog": catalog,
+                            "radius": radius,
+                            "refresh_rate": refresh_rate,
+                            "refresh": refresh,
+                            "kwargs": kwargs} for position in positions]
+            frames = self.ldb.fetch_sync_many(self._aq_call("query_region"),
+                                              catalog,
+                                              params_list,
+                                              refresh_rate,
+                                              refresh=refresh,
+                                              max_workers=max_workers,
+                                              call_name="query_region",
+                                              **kwargs)
+            if as_dict is True:
+                return dict(enumerate(frames))
+            for i, frame in enumerate(frames):
+                frame.insert(0, "input_index", i)
+            return pd.concat(frames, ignore_index=True)
+
+    def resolve_names(self, names: list, refresh_rate=None,
+                      refresh=False) -> dict:
+        """
+        Resolves object names to coordinates, using the names stashed in the
+        resolved_names table where possible, and looking up (and stashing)
+        the rest with Sesame
+
+        Parameters:
+        names: list, object names (e.x. PSR B0531+21)
+
+        refresh_rate: int or None, default = None,
+                      time in days before the names should be resolved again
+
+        refresh: bool, default = False
+                 Resolves all the names again if True
+
+        Returns:
+        dict, `astropy.coordinates.SkyCoord` position of each name
+        """
+        from astropy.coordinates import SkyCoord
+        coords = {}
+        if refresh is False:
+            coords = self._get_stashed_coords(names, refresh_rate)
+        resolved = {}
+        for name in dict.fromkeys(names):
+            if name not in coords:
+                resolved[name] = SkyCoord.from_name(name)
+        self._stash_coords(resolved, refresh_rate)
+        coords.update(resolved)
+        return {name: coords[name] for name in names}
+
+    def _get_stashed_coords(self, names: list, refresh_rate=None) -> dict:
+        """
+        Gets the stashed positions of the names that do not need to be
+        resolved again
+
+        Parameters:
+        names: list, object names (e.x. PSR B0531+21)
+
+        refresh_rate: int or None, default = None,
+                      time in days before the names should be resolved again
+
+        Returns:
+        dict, `astropy.coordinates.SkyCoord` position of each stashed name
+        """
+        from astropy.coordinates import SkyCoord
+        coords = {}
+        stashed = self.ldb.get_resolved_names(names)
+        for row in stashed.itertuples(index=False):
+            rate = row.refresh_rate if refresh_rate is None else refresh_rate
+            if pd.isna(rate) or not needs_refresh(row.resolved, int(rate)):
+                coords[row.name] = SkyCoord(row.ra, row.dec,
+                                            unit="deg",
+                                            frame=row.frame)
+        return coords
+
+    def _stash_coords(self, coords: dict, refresh_rate=None) -> None:
+        """
+        Stashes the positions of resolved names
+
+        Parameters:
+        coords: dict, `astropy.coordinates.SkyCoord` position of each name
+
+        refresh_rate: int or None, default = None,
+                      time in days before the names should be resolved again
+        """
+        if len(coords) > 0:
+            self.ldb.insert_resolved_names(
+                [(name, coord.spherical.lon.deg, coord.spherical.lat.deg,
+                  coord.frame.name) for name, coord in coords.items()],
+                refresh_rate)
+
+    def resolve_name(self, object_name: str, refresh_rate=None,
+                     refresh=False):
+        """
+        Resolves an object name to coordinates, see resolve_names
+
+        Parameters:
+        object_name: str, object name (e.x. PSR B0531+21)
+
+        refresh_rate: int or None, default = None,
+                      time in days before the name should be resolved again
+
+        refresh: bool, default = False
+                 Resolves the name again if True
+
+        Returns:
+        `astropy.coordinates.SkyCoord`, position of the object
+        """
+        return self.resolve_names([object_name],
+                                  refresh_rate=refresh_rate,
+                                  refresh=refresh)[object_name]
+
     def query_object(self, object_name, catalog=None,
                      radius=None, refresh_rate=None,
-                     refresh=False, **kwargs) -> pd.DataFrame:
+                     refresh=False, refresh_policy=None,
+                     **kwargs) -> pd.DataFrame:
         """
         Queries a catalog at the heasarc for records around a specific
-        object/source
+        object/source. The object name is resolved with resolve_name, so
+        names resolved before are not looked up again.
 
         Parameters:
         object_name: str, object name (e.x. PSR B0531+21)
@@ -121,19 +442,26 @@ class Heasarc:
                  Toggles call to the heasarc to refresh the query response
                  if True
 
+        refresh_policy: str or None, default = None,
+                        how a stale stashed response is served, blocking,
+                        stale-while-revalidate or cache-only, see
+                        SQLiteDB.fetch_sync
+
         Returns:
         pd.DataFrame, table of catalog's records for the specified object
         """
-        pos = SkyCoord.from_name(object_name)
+        pos = self.resolve_name(object_name)
         return self.query_region(position=pos,
                                  catalog=catalog,
                                  radius=radius,
                                  refresh_rate=refresh_rate,
                                  refresh=refresh,
+                                 refresh_policy=refresh_policy,
                                  **kwargs)
 
     def query_tap(self, query: str, catalog: str, maxrec=None,
-                  refresh_rate=None, refresh=False) -> pd.DataFrame:
+                  refresh_rate=None, refresh=False,
+                  refresh_policy=None) -> pd.DataFrame:
         """
         Queries the HEASARC's Xamin TAP using ADQL
 
@@ -145,18 +473,81 @@ class Heasarc:
         maxrec : int or None (default), optional,
                  maximum number of records to return
 
+        refresh_policy: str or None, default = None,
+                        how a stale stashed response is served, blocking,
+                        stale-while-revalidate or cache-only, see
+                        SQLiteDB.fetch_sync
+
         Returns:
         pd.DataFrame, response from HEASARC for the ADQL query
         """
         params = locals().copy()
-        del params["self"]
+        del params["self"], params["refresh_policy"]
         if self._check_catalog_exists(catalog):
             del params["catalog"]
-            return self.ldb.fetch_sync(self.aq.query_tap,
+            return self.ldb.fetch_sync(self._aq_call("query_tap"),
                                        catalog,
                                        params,
                                        refresh_rate,
-                                       refresh=refresh)
+                                       refresh=refresh,
+                                       refresh_policy=refresh_policy,
+                                       call_name="query_tap")
+
+    def query_tap_iter(self, query: str, catalog: str, maxrec=None,
+                       refresh_rate=None, refresh=False, chunksize=10000):
+        """
+        Streaming query_tap for large results, stashes and yields the
+        response chunksize rows at a time. Shares its stash with query_tap.
+
+        Parameters:
+        query: str, ADQL query
+
+        catalog: str, catalog table name to stash the data to
+
+        maxrec : int or None (default), optional,
+                 maximum number of records to return
+
+        chunksize: int, default = 10000, number of rows per chunk
+
+        Yields:
+        pd.DataFrame, chunks of the response from HEASARC for the ADQL query
+        """
+        params = {"query": query,
+                  "maxrec": maxrec,
+                  "refresh_rate": refresh_rate,
+                  "refresh": refresh}
+        if self._check_catalog_exists(catalog):
+            yield from self.ldb.fetch_sync_iter(self._aq_call("query_tap"),
+                                                catalog,
+                                                params,
+                                                refresh_rate,
+                                                refresh=refresh,
+                                                chunksize=chunksize)
+
+    def refresh_stale(self, max_workers: int = 8,
+                      batch_size: int = 50) -> dict:
+        """
+        Refreshes every stashed query that is due for a refresh by replaying
+        its call to the heasarc, e.g. nightly so daytime calls are served
+        from the stash
+
+        Parameters:
+        max_workers: int, optional, maximum number of concurrent requests to
+                                    the heasarc
+
+        batch_size: int, optional, number of responses stashed per
+                                   transaction
+
+        Returns:
+        dict, ids of the refreshed queries (refreshed), ids of the refreshed
+              queries whose response was unchanged (unchanged), the
+              exception of each query that failed (failed), and ids of the
+              queries that can not be replayed by Heasarc (skipped)
+        """
+        query_funcs = {name: self._aq_call(name) for name
+                       in ("list_catalogs", "query_region", "query_tap")}
+        return self.ldb.refresh_stale(query_funcs, max_workers=max_workers,
+                                      batch_size=batch_size)
 
     def locate_data(self,
                     result_table: pd.DataFrame,
@@ -175,22 +566,62 @@ class Heasarc:
         pd.DataFrame, all relevant links and paths to access heasarc
                       data products
         """
+        remote_df = self._locate_remote_data(result_table, catalog)
+        return self._merge_local_data_paths(remote_df, catalog)
+
+    def _locate_remote_data(self, result_table: pd.DataFrame,
+                            catalog: str) -> pd.DataFrame:
+        """
+        Gets links to heasarc data products from the heasarc
+
+        Parameters
+        ----------
+        result_table: pd.DataFrame, results of a previous region, object, or
+                                    tap query
+
+        catalog: str, catalog name
+
+        Returns:
+        pd.DataFrame, links to the data products keyed by rowid
+        """
+        from astropy.table import Table
         aq_table = Table.from_pandas(result_table)
         remote_df = self.aq.locate_data(aq_table, catalog).to_pandas()
         remote_df.rename(columns={'ID': 'rowid'}, inplace=True)
         remote_df["rowid"] = remote_df["rowid"].str.extract(r'\?(\d+)',
                                                             expand=False)
+        return remote_df
+
+    def _merge_local_data_paths(self, remote_df: pd.DataFrame,
+                                catalog: str) -> pd.DataFrame:
+        """
+        Merges the local paths of downloaded data products into the links
+        to the data products
+
+        Parameters
+        ----------
+        remote_df: pd.DataFrame, links to the data products keyed by rowid
+
+        catalog: str, catalog name
+
+        Returns:
+        pd.DataFrame, all relevant links and paths to access heasarc
+                      data products
+        """
         local_df = self.ldb.get_local_data_paths_by_catalog(catalog)
         local_df.drop(columns=["catalog"], inplace=True)
         local_df.rename(columns={'id': 'local_id'}, inplace=True)
         return pd.merge(remote_df, local_df, how="outer")
 
     def download_data(self, links: pd.DataFrame, catalog: str, *,
-                      host="aws", location="."):
+                      host="aws", location=".", max_workers=4):
         """
         Downloads data from from using the links from the specified host
         to the location specified, and adds the full path to the data product
-        to the local_data_paths table
+        to the local_data_paths table. Products already recorded in
+        local_data_paths and present on disk are skipped, the rest are
+        downloaded concurrently, and each product is recorded as soon as it
+        finishes so an interrupted download resumes where it stopped.
 
         Parameters
         ----------
@@ -204,16 +635,106 @@ class Heasarc:
 
         location str, optional, path of the location to download the data to
                                 (default is ".")
+
+        max_workers: int, optional, maximum number of concurrent downloads,
+                                    further limited per host by host_limits
+                                    (default is 4)
         """
-        links = Table.from_pandas(links)
-        linkcol = host
         location = pl.Path(location).resolve()
-        if linkcol == 'heasarc':
-            linkcol = "access_url"
-        for row in links:
-            download_name = row[linkcol].split("/")[-2]
+        rows = self._pending_downloads(links, catalog, host, location)
+        error = None
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(self._download_product,
+                                   row, host, location): row
+                       for row in rows}
+            for future in as_completed(futures):
+                try:
+                    path = future.result()
+                except Exception as exc:
+                    error = exc if error is None else error
+                    continue
+                self.ldb.insert_local_data_path(catalog,
+                                                futures[future]["rowid"],
+                                                path)
+        if error is not None:
+            raise error
+
+    def _product_path(self, row, host: str, location: pl.Path) -> str:
+        """
+        Gets the full path a data product is downloaded to
+
+        Parameters
+        ----------
+        row: `astropy.table.Row`, links to the data product
+
+        host: str, host to retrieve the data product from
+
+        location: pl.Path, path of the location to download the data to
+
+        Returns
+        -------
+        str, full path of the data product
+        """
+        linkcol = "access_url" if host == "heasarc" else host
+        download_name = row[linkcol].split("/")[-2]
+        return f"{location}/{download_name}"
+
+    def _pending_downloads(self, links: pd.DataFrame, catalog: str,
+                           host: str, location: pl.Path) -> list:
+        """
+        Gets the data products that still need to be downloaded, i.e. those
+        not recorded in local_data_paths or missing from disk
+
+        Parameters
+        ----------
+        links: pd.DataFrame, dataframe with links
+
+        catalog: str, catalog the links come from
+
+        host: str, host to retrieve the data products from
+
+        location: pl.Path, path of the location to download the data to
+
+        Returns
+        -------
+        list, `astropy.table.Row` links of the products to download
+        """
+        from astropy.table import Table
+        local_df = self.ldb.get_local_data_paths_by_catalog(catalog)
+        present = {(rowid, path) for rowid, path
+                   in zip(local_df["rowid"], local_df["location"])
+                   if pl.Path(path).exists()}
+        return [row for row in Table.from_pandas(links)
+                if (str(row["rowid"]),
+                    self._product_path(row, host, location)) not in present]
+
+    def _host_semaphore(self, host: str) -> threading.BoundedSemaphore:
+        """
+        Gets the semaphore limiting concurrent downloads from a host
+        """
+        with self._host_semaphores_lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(
+                    self.host_limits.get(host, 1))
+            return self._host_semaphores[host]
+
+    def _download_product(self, row, host: str, location: pl.Path) -> str:
+        """
+        Downloads a single data product, waiting for a free slot if the host
+        is at its concurrent download limit
+
+        Parameters
+        ----------
+        row: `astropy.table.Row`, links to the data product
+
+        host: str, host to retrieve the data product from
+
+        location: pl.Path, path of the location to download the data to
+
+        Returns
+        -------
+        str, full path of the downloaded data product
+        """
+        with self._host_semaphore(host):
             self.aq.download_data(row, host=host, location=location)
-            self.ldb.insert_local_data_path(
-                catalog,
-                row["rowid"],
-                f"{location}/{download_name}")
+        return self._product_path(row, host, location)
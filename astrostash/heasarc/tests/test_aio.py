@@ -0,0 +1,113 @@
+from astrostash.heasarc import AsyncHeasarc
+from astropy.coordinates import SkyCoord
+from astropy.table import Table
+import asyncio
+import shutil
+import time
+import pytest
+import pandas as pd
+from unittest.mock import MagicMock, patch
+
+
+@pytest.fixture
+def async_heasarc(tmp_path):
+    dbcopy = tmp_path / "processed-conflict-async.db"
+    shutil.copy("astrostash/heasarc/tests/data/processed-conflict.db",
+                dbcopy)
+    heasarc = AsyncHeasarc(str(dbcopy), max_concurrency=8)
+    yield heasarc
+
+
+def slow_query_region(position, catalog, radius, kwargs):
+    time.sleep(0.2)
+    return Table({"__row": [f"{position.ra.deg:.0f}"],
+                  "ra": [position.ra.deg],
+                  "dec": [position.dec.deg]})
+
+
+def test_concurrent_query_region(async_heasarc):
+    heasarc = async_heasarc
+    heasarc.heasarc.aq.query_region = MagicMock(side_effect=slow_query_region)
+    positions = [SkyCoord(ra, 0.0, unit="deg") for ra in range(10, 90, 10)]
+
+    async def run():
+        async with heasarc:
+            start = time.perf_counter()
+            tables = await asyncio.gather(
+                *(heasarc.query_region(position=pos, catalog="numaster",
+                                       radius="1 deg")
+                  for pos in positions + positions[:2]))
+            return tables, time.perf_counter() - start
+
+    tables, elapsed = asyncio.run(run())
+    # Requests overlap, and duplicate in flight queries share a request
+    assert elapsed < 0.2 * len(positions) / 2
+    assert heasarc.heasarc.aq.query_region.call_count == len(positions)
+    assert [t["__row"].iloc[0] for t in tables] == \
+        [f"{ra}" for ra in range(10, 90, 10)] + ["10", "20"]
+
+
+def test_async_query_object(async_heasarc):
+    heasarc = async_heasarc
+    heasarc.heasarc.aq.query_region = MagicMock(side_effect=slow_query_region)
+    crab = SkyCoord(83.63308, 22.01450, unit="deg")
+
+    async def run():
+        async with heasarc:
+            first = await heasarc.query_object("crab", catalog="numaster")
+            second = await heasarc.query_object("crab", catalog="numaster")
+            return first, second
+
+    sesame = MagicMock(return_value=crab)
+    with patch.object(SkyCoord, "from_name", sesame):
+        first, second = asyncio.run(run())
+    assert sesame.call_count == 1
+    assert heasarc.heasarc.aq.query_region.call_count == 1
+    pd.testing.assert_frame_equal(first, second)
+
+
+def test_async_delegates_to_heasarc(async_heasarc):
+    heasarc = async_heasarc
+    heasarc.heasarc.aq.query_region = MagicMock(side_effect=slow_query_region)
+    pos = SkyCoord(10.0, 0.0, unit="deg")
+
+    async def run():
+        async with heasarc:
+            with pytest.raises(ValueError):
+                await heasarc.query_region(position=pos, catalog="numaster",
+                                           radius="1 deg",
+                                           refresh_policy="cache-only")
+            await heasarc.query_region(position=pos, catalog="numaster",
+                                       radius="1 deg")
+            return await heasarc.query_region(position=pos,
+                                              catalog="numaster",
+                                              radius="1 deg",
+                                              refresh_policy="cache-only")
+
+    df = asyncio.run(run())
+    assert df["__row"].to_list() == ["10"]
+    assert heasarc.heasarc.aq.query_region.call_count == 1
+    outcomes = heasarc.ldb.metrics.snapshot()["outcomes"]
+    assert outcomes["miss"] == 1
+    assert outcomes["cache_hit"] == 1
+
+
+def test_query_key(async_heasarc):
+    heasarc = async_heasarc
+    pos = SkyCoord(10.0, 0.0, unit="deg")
+    key = heasarc._query_key("query_region", (),
+                             {"position": pos, "catalog": "numaster",
+                              "radius": "1 deg"})
+    # Equal parameters passed positionally, with defaults spelled out or as
+    # a new SkyCoord share a key
+    assert heasarc._query_key("query_region",
+                              (SkyCoord(10.0, 0.0, unit="deg"), "numaster"),
+                              {"radius": "1 deg", "refresh": False}) == key
+    assert heasarc._query_key("query_region", (pos, "numaster", "2 deg"),
+                              {}) != key
+    assert heasarc._query_key("query_region", (pos, "numaster", "1 deg"),
+                              {"refresh": True}) != key
+    assert heasarc._query_key("query_region", (pos, "numaster", "1 deg"),
+                              {"columns": object()}) is None
+    asyncio.run(heasarc.aclose())
+    assert heasarc._executor._shutdown
@@ -1,27 +1,50 @@
+import astrostash
 from astrostash.heasarc import Heasarc
-from astropy.coordinates import SkyCoord
+from astropy.coordinates import Angle, SkyCoord
 import os
 import pathlib as pl
 import shutil
+import sqlite3
 import pytest
+import threading
+import time
 import pandas as pd
+from astropy.table import Table
+from unittest.mock import MagicMock, patch
 
 
-@pytest.fixture
-def copy_dir_setup():
-    dbroot = "astrostash/heasarc/tests/data"
-    db = f"{dbroot}/processed-conflict.db"
-    dbcopy = f"{dbroot}/processed-conflict-copy.db"
-    shutil.copy(db, dbcopy)
-    heasarc = Heasarc(dbcopy)
-    yield heasarc
-    os.remove(dbcopy)
+# Database stashed before the schema was versioned, only ever opened
+# through a copy so it stays a legacy database
+FIXTURE_DB = "astrostash/heasarc/tests/data/processed-conflict.db"
 
 
 @pytest.fixture
-def setup():
-    heasarc = Heasarc("astrostash/heasarc/tests/data/processed-conflict.db")
+def copy_dir_setup(tmp_path):
+    dbcopy = tmp_path / "processed-conflict-copy.db"
+    shutil.copy(FIXTURE_DB, dbcopy)
+    heasarc = Heasarc(str(dbcopy))
     yield heasarc
+    heasarc.ldb.close()
+
+
+def test_legacy_fixture_migration(tmp_path):
+    dbcopy = tmp_path / "processed-conflict-copy.db"
+    shutil.copy(FIXTURE_DB, dbcopy)
+    conn = sqlite3.connect(dbcopy)
+    assert conn.execute("PRAGMA user_version;").fetchone() == (0,)
+    conn.close()
+    heasarc = Heasarc(str(dbcopy))
+    latest = len(astrostash.astrostash.schema_migrations())
+    assert heasarc.ldb.get_schema_version() == latest
+    responses = pd.read_sql("SELECT * FROM responses", heasarc.ldb.conn)
+    assert set(responses["hash_version"]) == {1}
+    assert "ix_response_rowid_pivot_rowid" \
+        in heasarc.ldb.list_indexes("response_rowid_pivot")["name"].values
+    # Stashed tables are still read as before
+    heasarc.aq.query_tap = MagicMock(side_effect=ConnectionError)
+    uhuru4 = heasarc.query_tap("SELECT * FROM uhuru4", catalog="uhuru4")
+    assert len(uhuru4) == 339
+    heasarc.ldb.close()
 
 
 def test_list_catalogs():
@@ -44,6 +67,21 @@ def test_list_catalogs():
     os.remove("astrostash.db")
 
 
+def test_check_catalog_exists_cached(copy_dir_setup):
+    heasarc = copy_dir_setup
+    heasarc.list_catalogs = MagicMock(wraps=heasarc.list_catalogs)
+    assert heasarc._check_catalog_exists("nicermastr") is True
+    assert heasarc._check_catalog_exists("xxx") is False
+    heasarc.list_catalogs.assert_called_once()
+    # Stashing to the catalog list again reloads the names
+    heasarc.ldb._stash_table(
+        pd.DataFrame({"name": ["xxx"], "description": ["new catalog"]}),
+        "heasarc_catalog_list",
+        "name")
+    assert heasarc._check_catalog_exists("nicermastr") is True
+    assert heasarc.list_catalogs.call_count == 2
+
+
 def test_query_region():
     heasarc = Heasarc()
     pos = SkyCoord.from_name('ngc 3783')
@@ -58,6 +96,30 @@ def test_query_region():
     os.remove("astrostash.db")
 
 
+def test_query_region_many(copy_dir_setup):
+    heasarc = copy_dir_setup
+    positions = SkyCoord([10.0, 20.0, 10.0], [-5.0, 5.0, -5.0], unit="deg")
+
+    def query_region(position, catalog, radius, kwargs):
+        return Table({"__row": [f"{position.ra.deg:.0f}"],
+                      "ra": [position.ra.deg],
+                      "dec": [position.dec.deg]})
+
+    heasarc.aq.query_region = MagicMock(side_effect=query_region)
+    table = heasarc.query_region_many(positions, catalog="numaster",
+                                      radius="1 deg", max_workers=2)
+    assert heasarc.aq.query_region.call_count == 2
+    assert table["input_index"].to_list() == [0, 1, 2]
+    assert table["__row"].to_list() == ["10", "20", "10"]
+    # The positions are stashed as the same queries query_region makes
+    single = heasarc.query_region(position=positions[1], catalog="numaster",
+                                  radius="1 deg")
+    assert heasarc.aq.query_region.call_count == 2
+    frames = heasarc.query_region_many([positions[1]], catalog="numaster",
+                                       radius="1 deg", as_dict=True)
+    pd.testing.assert_frame_equal(frames[0], single)
+
+
 def test_query_object(copy_dir_setup):
     heasarc = Heasarc()
     init_query = heasarc.query_object("crab", catalog="nicermastr")
@@ -80,14 +142,63 @@ def test_query_object(copy_dir_setup):
     assert len(aql_x1) == 302
 
 
-def test_query_tap(setup):
-    setup.query_tap("SELECT * FROM uhuru4", catalog="uhuru4")
-    assert setup.ldb._check_table_exists("uhuru4") is True
+def test_resolve_names(copy_dir_setup):
+    heasarc = copy_dir_setup
+    crab = SkyCoord(83.63308, 22.01450, unit="deg")
+    aql = SkyCoord(287.81675, 0.58497, unit="deg")
+    sesame = MagicMock(side_effect=[crab, aql, crab])
+    with patch.object(SkyCoord, "from_name", sesame):
+        assert heasarc.resolve_name("crab").to_string() == crab.to_string()
+        coords = heasarc.resolve_names(["crab", "AQL X-1", "crab"])
+        # Only the unseen name goes to Sesame
+        assert sesame.call_count == 2
+        assert list(coords) == ["crab", "AQL X-1"]
+        assert coords["AQL X-1"].to_string() == aql.to_string()
+        heasarc.resolve_name("crab", refresh=True)
+        assert sesame.call_count == 3
+    stashed = heasarc.ldb.get_resolved_names(["crab", "AQL X-1", "xxx"])
+    assert sorted(stashed["name"]) == ["AQL X-1", "crab"]
+    assert stashed["frame"].to_list() == ["icrs", "icrs"]
+
+
+def test_query_tap(copy_dir_setup):
+    heasarc = copy_dir_setup
+    heasarc.query_tap("SELECT * FROM uhuru4", catalog="uhuru4")
+    assert heasarc.ldb._check_table_exists("uhuru4") is True
+
+
+def test_query_tap_iter(copy_dir_setup):
+    heasarc = copy_dir_setup
+    heasarc.aq.query_tap = MagicMock(side_effect=ConnectionError)
+    chunks = list(heasarc.query_tap_iter("SELECT * FROM uhuru4",
+                                         catalog="uhuru4",
+                                         chunksize=100))
+    assert [len(chunk) for chunk in chunks] == [100, 100, 100, 39]
+    stashed = heasarc.query_tap("SELECT * FROM uhuru4", catalog="uhuru4")
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True),
+                                  stashed)
+
+
+def test_legacy_response_hash_migration(copy_dir_setup):
+    heasarc = copy_dir_setup
+    stashed = heasarc.query_tap("SELECT * FROM uhuru4", catalog="uhuru4")
+    heasarc.aq.query_tap = MagicMock(return_value=Table.from_pandas(stashed))
+    refreshed = heasarc.query_tap("SELECT * FROM uhuru4", catalog="uhuru4",
+                                  refresh=True)
+    pd.testing.assert_frame_equal(stashed, refreshed)
+    responses = pd.read_sql("SELECT * FROM responses", heasarc.ldb.conn)
+    # The unchanged response is matched by its legacy hash and upgraded
+    # rather than stashed again
+    assert len(responses) == 4
+    assert responses["hash_version"].to_list() == [1, 1, 1, 2]
+    assert heasarc.ldb._get_response_id(
+        astrostash.make_result_hash(stashed)) == (4,)
 
 
-def test_locate_data(setup):
-    crabdf = setup.query_object("PSR B0531+21", catalog="nicermastr")
-    products = setup.locate_data(crabdf, "nicermastr")
+def test_locate_data(copy_dir_setup):
+    heasarc = copy_dir_setup
+    crabdf = heasarc.query_object("PSR B0531+21", catalog="nicermastr")
+    products = heasarc.locate_data(crabdf, "nicermastr")
     expected_columns = ['rowid', 'access_url', 'sciserver', 'aws',
                         'content_length', 'error_message', 'local_id',
                         'location']
@@ -111,3 +222,146 @@ def test_download_data(copy_dir_setup):
     })
     pd.testing.assert_frame_equal(local_paths, dummy_frame)
     shutil.rmtree(expected_dir)
+
+
+def test_download_data_resumable(copy_dir_setup, tmp_path):
+    heasarc = copy_dir_setup
+    heasarc.host_limits = {"aws": 2}
+    active = []
+    peak = []
+    fail_once = {"3"}
+    lock = threading.Lock()
+
+    def download_data(row, host, location):
+        with lock:
+            active.append(row["rowid"])
+            peak.append(len(active))
+        time.sleep(0.05)
+        with lock:
+            active.remove(row["rowid"])
+        if row["rowid"] in fail_once:
+            fail_once.remove(row["rowid"])
+            raise ConnectionError("interrupted")
+        (pl.Path(location) / row["aws"].split("/")[-2]).mkdir()
+
+    heasarc.aq.download_data = MagicMock(side_effect=download_data)
+    links = pd.DataFrame({
+        "rowid": ["1", "2", "3", "4"],
+        "aws": [f"s3://bucket/obs/{i}/" for i in range(1, 5)],
+        "access_url": [f"https://heasarc/obs/{i}/" for i in range(1, 5)],
+    })
+    with pytest.raises(ConnectionError):
+        heasarc.download_data(links, "nicermastr", location=tmp_path,
+                              max_workers=4)
+    assert max(peak) <= 2
+    # Products that finished are recorded even though one failed
+    local_paths = heasarc.ldb.get_local_data_paths_by_catalog("nicermastr")
+    assert sorted(local_paths["rowid"]) == ["1", "2", "4"]
+    # A rerun only downloads the missing product, and products whose
+    # directory was removed
+    shutil.rmtree(tmp_path / "1")
+    heasarc.aq.download_data.reset_mock()
+    heasarc.download_data(links, "nicermastr", location=tmp_path)
+    downloaded = [c.args[0]["rowid"]
+                  for c in heasarc.aq.download_data.call_args_list]
+    assert sorted(downloaded) == ["1", "3"]
+    local_paths = heasarc.ldb.get_local_data_paths_by_catalog("nicermastr")
+    assert sorted(local_paths["rowid"]) == ["1", "2", "3", "4"]
+
+
+def test_query_region_local(copy_dir_setup):
+    heasarc = copy_dir_setup
+    heasarc.aq.query_region = MagicMock(side_effect=ConnectionError)
+    crab = SkyCoord(83.63308, 22.01450, unit="deg")
+    # Catalog stashed before spatial indexing, so indexed on first use
+    assert heasarc.ldb.get_spatial_index("nicermastr") is None
+    local = heasarc.query_region_local(crab, "nicermastr", "30 arcmin")
+    assert heasarc.ldb.get_spatial_index("nicermastr") == "rtree_nicermastr"
+    stashed = pd.read_sql("SELECT * FROM nicermastr", heasarc.ldb.conn)
+    sep = SkyCoord(stashed["ra"], stashed["dec"],
+                   unit="deg").separation(crab)
+    assert len(local) > 0
+    assert sorted(local["obsid"]) == sorted(stashed["obsid"][sep.deg <= 0.5])
+    assert len(heasarc.query_region_local(crab, "nicermastr", 0.5)) \
+        == len(local)
+    heasarc.aq.query_region.assert_not_called()
+
+
+def test_query_region_subsumption(copy_dir_setup):
+    heasarc = copy_dir_setup
+    stashed = pd.read_sql("SELECT * FROM nicermastr", heasarc.ldb.conn)
+    positions = SkyCoord(stashed["ra"], stashed["dec"], unit="deg")
+
+    def query_region(position=None, catalog=None, radius=None, **kwargs):
+        sep = positions.separation(position).deg
+        return Table.from_pandas(stashed[sep <= Angle(radius).deg])
+
+    heasarc.aq.query_region = MagicMock(side_effect=query_region)
+    crab = SkyCoord(83.63308, 22.01450, unit="deg")
+    inner = SkyCoord(83.8, 22.1, unit="deg")
+    # A response cut at the service's row limit does not cover its
+    # footprint
+    heasarc.service_maxrec = len(query_region(crab, radius="1 deg"))
+    heasarc.query_region(crab, catalog="nicermastr", radius="1 deg")
+    heasarc.query_region(inner, catalog="nicermastr", radius="10 arcmin")
+    assert heasarc.aq.query_region.call_count == 2
+    heasarc.service_maxrec += 1
+    big = heasarc.query_region(crab, catalog="nicermastr", radius="1 deg",
+                               refresh=True)
+    assert heasarc.aq.query_region.call_count == 3
+    # Inside the stashed footprint, answered locally
+    small = heasarc.query_region(inner, catalog="nicermastr",
+                                 radius="20 arcmin")
+    assert heasarc.aq.query_region.call_count == 3
+    expected = query_region(inner, radius="20 arcmin").to_pandas()
+    assert len(small) > 2
+    assert sorted(small["__row"]) == sorted(expected["__row"])
+    assert set(small["__row"]).issubset(big["__row"])
+    assert heasarc.ldb.footprint_stats() == {"lookups": 3, "covered": 1}
+    assert heasarc.ldb.metrics.snapshot()["outcomes"]["covered"] == 1
+    # Served from the result cache when repeated
+    again = heasarc.query_region(inner, catalog="nicermastr",
+                                 radius="20 arcmin")
+    assert sorted(again["__row"]) == sorted(small["__row"])
+    assert heasarc.ldb.footprint_stats() == {"lookups": 3, "covered": 1}
+    assert heasarc.ldb.metrics.snapshot()["outcomes"]["cache_hit"] == 1
+    # maxrec applies to the rows of the covering query
+    limited = heasarc.query_region(inner, catalog="nicermastr",
+                                   radius="20 arcmin", maxrec=2)
+    assert len(limited) == 2
+    assert heasarc.ldb.footprint_stats() == {"lookups": 4, "covered": 2}
+    # Not contained, or with other parameters, goes remote
+    heasarc.query_region(inner, catalog="nicermastr", radius="50 arcmin")
+    heasarc.query_region(inner, catalog="nicermastr", radius="20 arcmin",
+                         columns="name,ra,dec")
+    assert heasarc.aq.query_region.call_count == 5
+    # A stale covering query is not used
+    heasarc.query_region(crab, catalog="nicermastr", radius="5 arcmin",
+                         refresh_rate=0)
+    assert heasarc.aq.query_region.call_count == 6
+    assert heasarc.ldb.footprint_stats() == {"lookups": 7, "covered": 2}
+
+
+def test_refresh_stale(copy_dir_setup):
+    heasarc = copy_dir_setup
+    stashed = heasarc.query_tap("SELECT * FROM uhuru4", catalog="uhuru4")
+    heasarc.aq.query_tap = MagicMock(return_value=Table.from_pandas(stashed))
+    # Stores the call of the query
+    heasarc.query_tap("SELECT * FROM uhuru4", catalog="uhuru4",
+                      refresh_rate=1, refresh=True)
+    heasarc.ldb.cursor.execute(
+        "UPDATE queries SET last_refreshed = '2020-01-01';")
+    heasarc.ldb.conn.commit()
+    stale = heasarc.ldb.get_stale_queries()
+    assert stale["method"].to_list() == ["query_tap"]
+    qid = int(stale["id"].iloc[0])
+    changed = stashed.copy()
+    changed["count_rate"] = 1.0
+    heasarc.aq.query_tap = MagicMock(return_value=Table.from_pandas(changed))
+    summary = heasarc.refresh_stale(max_workers=2)
+    assert summary["refreshed"] == [qid]
+    heasarc.aq.query_tap.assert_called_once_with(
+        query="SELECT * FROM uhuru4", maxrec=None)
+    assert heasarc.ldb.get_stale_queries().empty
+    refreshed = heasarc.query_tap("SELECT * FROM uhuru4", catalog="uhuru4")
+    assert (refreshed["count_rate"] == 1.0).all()
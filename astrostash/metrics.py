@@ -0,0 +1,264 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Phases of fetch_sync that are timed, in the order they run
+FETCH_PHASES = ("hash", "result_cache", "get_query", "footprint", "remote",
+                "to_pandas", "ingest", "stash", "read")
+
+# Outcomes of fetch_sync, served from the result cache (cache_hit), from the
+# stashed rows (hit), from the rows of a query whose footprint contains it
+# (covered), a query run for the first time (miss), a query run again to
+# refresh it (refresh), or stale stashed rows served without waiting for a
+# refresh (stale)
+FETCH_OUTCOMES = ("cache_hit", "hit", "covered", "miss", "refresh", "stale")
+
+
+class FetchRecord:
+    """
+    Timings and counts of a single fetch_sync call
+    """
+    __slots__ = ("table", "outcome", "error", "phases", "counts", "start",
+                 "duration")
+
+    def __init__(self, table: str):
+        """
+        Parameters
+        ----------
+        table: str, name of the table/catalog fetched from
+        """
+        self.table = table
+        self.outcome = None
+        self.error = None
+        self.phases = {}
+        self.counts = {}
+        self.start = time.perf_counter()
+        self.duration = None
+
+    def as_dict(self) -> dict:
+        """
+        Gets the record as a dict of plain values
+
+        Returns
+        -------
+        dict, table, outcome, error (exception name or None), duration and
+              phase durations (phases) in seconds, and counts
+        """
+        return {"table": self.table,
+                "outcome": self.outcome,
+                "error": self.error,
+                "duration": self.duration,
+                "phases": dict(self.phases),
+                "counts": dict(self.counts)}
+
+
+class MetricsRegistry:
+    """
+    In-process registry of fetch_sync metrics. Each fetch is recorded in a
+    FetchRecord, which is aggregated into the registry totals and passed to
+    every hook once the fetch finishes. Phases and counts outside of a fetch
+    on the same thread are not recorded.
+    """
+    def __init__(self, enabled: bool = True):
+        """
+        Parameters
+        ----------
+        enabled: bool, optional, record metrics, default True
+        """
+        self.enabled = enabled
+        self._hooks = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Clears the aggregated metrics
+        """
+        with self._lock:
+            self.fetches = 0
+            self.errors = 0
+            self.outcomes = {}
+            self.phases = {}
+            self.counts = {}
+
+    def add_hook(self, hook) -> None:
+        """
+        Adds a hook called with the FetchRecord of every finished fetch,
+        exceptions raised by a hook are logged and otherwise ignored
+
+        Parameters
+        ----------
+        hook: function, called with a FetchRecord
+        """
+        with self._lock:
+            self._hooks = self._hooks + [hook]
+
+    def remove_hook(self, hook) -> None:
+        """
+        Removes a hook added with add_hook
+
+        Parameters
+        ----------
+        hook: function, hook to remove
+        """
+        with self._lock:
+            self._hooks = [h for h in self._hooks if h != hook]
+
+    def current(self) -> FetchRecord | None:
+        """
+        Gets the record of the fetch running on this thread
+
+        Returns
+        -------
+        FetchRecord or None, None if no fetch is running or metrics are
+                             disabled
+        """
+        return getattr(self._local, "record", None)
+
+    @contextmanager
+    def fetch(self, table: str):
+        """
+        Records a fetch, nested fetches on the same thread are recorded as
+        part of the outer fetch
+
+        Parameters
+        ----------
+        table: str, name of the table/catalog fetched from
+
+        Yields
+        ------
+        FetchRecord or None, record of the fetch, None if disabled
+        """
+        record = self.current()
+        if self.enabled is False or record is not None:
+            yield record
+            return
+        record = FetchRecord(table)
+        self._local.record = record
+        try:
+            yield record
+        except BaseException as exc:
+            record.error = type(exc).__name__
+            raise
+        finally:
+            self._local.record = None
+            record.duration = time.perf_counter() - record.start
+            self._finish(record)
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Times a phase of the fetch running on this thread, repeated phases
+        add up
+
+        Parameters
+        ----------
+        name: str, name of the phase, see FETCH_PHASES
+        """
+        record = self.current()
+        if record is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record.phases[name] = record.phases.get(name, 0.0) \
+                + time.perf_counter() - start
+
+    def count(self, name: str, n: int) -> None:
+        """
+        Adds to a count of the fetch running on this thread
+
+        Parameters
+        ----------
+        name: str, name of the count (e.g. rows, bytes, rows_written)
+
+        n: int, amount to add
+        """
+        record = self.current()
+        if record is not None:
+            record.counts[name] = record.counts.get(name, 0) + int(n)
+
+    def set_outcome(self, outcome: str) -> None:
+        """
+        Sets the outcome of the fetch running on this thread
+
+        Parameters
+        ----------
+        outcome: str, one of FETCH_OUTCOMES
+        """
+        record = self.current()
+        if record is not None:
+            record.outcome = outcome
+
+    def _finish(self, record: FetchRecord) -> None:
+        """
+        Aggregates a finished fetch and passes it to the hooks
+        """
+        with self._lock:
+            self.fetches += 1
+            if record.error is not None:
+                self.errors += 1
+            if record.outcome is not None:
+                self.outcomes[record.outcome] = \
+                    self.outcomes.get(record.outcome, 0) + 1
+            for name, seconds in record.phases.items():
+                phase = self.phases.setdefault(
+                    name, {"count": 0, "total": 0.0, "max": 0.0})
+                phase["count"] += 1
+                phase["total"] += seconds
+                phase["max"] = max(phase["max"], seconds)
+            for name, n in record.counts.items():
+                self.counts[name] = self.counts.get(name, 0) + n
+            hooks = self._hooks
+        for hook in hooks:
+            try:
+                hook(record)
+            except Exception:
+                logging.getLogger(__name__).exception(
+                    "metrics hook %r failed", hook)
+
+    def snapshot(self) -> dict:
+        """
+        Gets a copy of the aggregated metrics
+
+        Returns
+        -------
+        dict, number of fetches and errors, fetches by outcome (outcomes),
+              count, total and max seconds of each phase (phases), and
+              summed counts
+        """
+        with self._lock:
+            return {"fetches": self.fetches,
+                    "errors": self.errors,
+                    "outcomes": dict(self.outcomes),
+                    "phases": {name: dict(phase)
+                               for name, phase in self.phases.items()},
+                    "counts": dict(self.counts)}
+
+
+class LogSink:
+    """
+    Metrics hook writing each fetch as a single line JSON log record
+    """
+    def __init__(self, logger: logging.Logger | None = None,
+                 level: int = logging.INFO):
+        """
+        Parameters
+        ----------
+        logger: logging.Logger or None, optional, logger to write to,
+                                        default astrostash.metrics
+
+        level: int, optional, level of the log records, default INFO
+        """
+        self.logger = logger or logging.getLogger(__name__)
+        self.level = level
+
+    def __call__(self, record: FetchRecord) -> None:
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, json.dumps(record.as_dict()))
@@ -9,6 +9,7 @@ CREATE TABLE IF NOT EXISTS queries (
 CREATE TABLE IF NOT EXISTS responses (
     id INTEGER PRIMARY KEY,
     hash TEXT NOT NULL,
+    hash_version INTEGER NOT NULL DEFAULT 1,
     UNIQUE (hash)
 );
 
@@ -34,3 +35,18 @@ CREATE TABLE IF NOT EXISTS local_data_paths (
     location TEXT NOT NULL,
     UNIQUE (catalog, rowid, location)
 );
+
+CREATE INDEX IF NOT EXISTS ix_query_response_pivot_responseid
+ON query_response_pivot (responseid);
+
+CREATE INDEX IF NOT EXISTS ix_response_rowid_pivot_rowid
+ON response_rowid_pivot (rowid);
+
+CREATE TABLE IF NOT EXISTS resolved_names (
+    name TEXT PRIMARY KEY,
+    ra REAL NOT NULL,
+    dec REAL NOT NULL,
+    frame TEXT NOT NULL,
+    resolved DATE,
+    refresh_rate INTEGER
+);
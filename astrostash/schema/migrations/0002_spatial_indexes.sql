@@ -0,0 +1,5 @@
+CREATE TABLE IF NOT EXISTS spatial_indexes (
+    catalog TEXT PRIMARY KEY,
+    rtree TEXT NOT NULL,
+    UNIQUE (rtree)
+);
@@ -0,0 +1,13 @@
+CREATE TABLE IF NOT EXISTS query_footprints (
+    queryid INTEGER PRIMARY KEY,
+    catalog TEXT NOT NULL,
+    spatial TEXT NOT NULL,
+    ra REAL NOT NULL,
+    dec REAL NOT NULL,
+    radius REAL NOT NULL,
+    signature TEXT NOT NULL,
+    FOREIGN KEY (queryid) REFERENCES queries(id)
+);
+
+CREATE INDEX IF NOT EXISTS ix_query_footprints_catalog_signature
+ON query_footprints (catalog, signature);
@@ -0,0 +1,9 @@
+CREATE TABLE IF NOT EXISTS query_calls (
+    queryid INTEGER PRIMARY KEY,
+    method TEXT NOT NULL,
+    table_name TEXT NOT NULL,
+    idcol TEXT NOT NULL,
+    params TEXT NOT NULL,
+    kwargs TEXT NOT NULL,
+    FOREIGN KEY (queryid) REFERENCES queries(id)
+);
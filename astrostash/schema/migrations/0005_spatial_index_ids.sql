@@ -0,0 +1,10 @@
+-- Spatial indexes are keyed on the id column of their catalog, those keyed
+-- on the catalog rowid (which VACUUM may renumber) are rebuilt on first use
+DROP TABLE IF EXISTS spatial_indexes;
+
+CREATE TABLE spatial_indexes (
+    catalog TEXT PRIMARY KEY,
+    rtree TEXT NOT NULL,
+    idcol TEXT NOT NULL,
+    UNIQUE (rtree)
+);
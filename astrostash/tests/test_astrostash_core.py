@@ -1,12 +1,15 @@
 import astrostash
 import os
+import sqlite3
+import threading
 import pathlib as pl
 from datetime import datetime
 import pytest
+import numpy as np
 import pandas as pd
 from astropy.table import Table
 from astropy.coordinates import SkyCoord
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 
 def test_sha256sum():
@@ -186,3 +189,665 @@ def test_insert_local_data_path(setup_sqlite_db):
         "location": [demo_product_path]
     })
     pd.testing.assert_frame_equal(local_data_frame, dummy_frame)
+
+
+def test_stash_table_upsert(setup_sqlite_db):
+    sql = setup_sqlite_db[0]
+    df1 = pd.DataFrame({'__row': ['1', '2'], 'col1': ['a', 'b']})
+    sql._stash_table(df1, 'test_table', '__row')
+    # Changed row 2, new row 3, and a column not seen before
+    df2 = pd.DataFrame({'__row': ['2', '3'],
+                        'col1': ['x', 'c'],
+                        'col2': [1.5, 2.5]})
+    sql._stash_table(df2, 'test_table', '__row')
+    assert sql.get_columns('test_table') == ['__row', 'col1',
+                                             '_astrostash_rowhash', 'col2']
+    stashed = pd.read_sql("SELECT __row, col1, col2 FROM test_table",
+                          sql.conn)
+    expected = pd.DataFrame({'__row': ['1', '2', '3'],
+                             'col1': ['a', 'x', 'c'],
+                             'col2': [None, 1.5, 2.5]})
+    pd.testing.assert_frame_equal(stashed, expected, check_dtype=False)
+
+
+def test_stash_table_row_hashes(setup_sqlite_db):
+    sql = setup_sqlite_db[0]
+    df1 = pd.DataFrame({'__row': [str(i) for i in range(5)],
+                        'col1': range(5)})
+    assert sql._stash_table(df1, 'test_table', '__row') \
+        == {"inserted": 5, "updated": 0, "unchanged": 0}
+    # Bulk changes, rows 0 and 3 changed and row 5 new
+    df2 = pd.DataFrame({'__row': [str(i) for i in range(6)],
+                        'col1': [10, 1, 2, 13, 4, 5]})
+    assert sql._stash_table(df2, 'test_table', '__row') \
+        == {"inserted": 1, "updated": 2, "unchanged": 3}
+    stashed = pd.read_sql("SELECT __row, col1, _astrostash_rowhash "
+                          "FROM test_table ORDER BY rowid", sql.conn)
+    assert stashed['col1'].to_list() == df2['col1'].to_list()
+    assert stashed['_astrostash_rowhash'].to_list() \
+        == astrostash.astrostash.row_hashes(df2).tolist()
+    # Rows of tables stashed before row hashes are all rewritten once
+    sql.ingest_table(df1, 'legacy_table')
+    assert sql._stash_table(df1, 'legacy_table', '__row') \
+        == {"inserted": 0, "updated": 5, "unchanged": 0}
+    assert sql._stash_table(df1, 'legacy_table', '__row')["unchanged"] == 5
+
+
+def test_stash_table_row_hash_columns(setup_sqlite_db):
+    sql = setup_sqlite_db[0]
+    df = pd.DataFrame({'__row': [str(i) for i in range(5)],
+                       'col1': range(5)})
+    sql._stash_table(df, 'test_table', '__row')
+    # Equal values under a new column name or dtype are changed rows
+    renamed = df.rename(columns={'col1': 'col2'})
+    assert sql._stash_table(renamed, 'test_table', '__row') \
+        == {"inserted": 0, "updated": 5, "unchanged": 0}
+    retyped = renamed.astype({'col2': 'int32'})
+    assert sql._stash_table(retyped, 'test_table', '__row') \
+        == {"inserted": 0, "updated": 5, "unchanged": 0}
+    assert sql._stash_table(retyped, 'test_table', '__row')["unchanged"] \
+        == 5
+
+
+def test_fetch_sync_row_changes(setup_sqlite_db):
+    sql = setup_sqlite_db[0]
+    df = pd.DataFrame({'__row': ['1', '2', '3'], 'col1': ['a', 'b', 'c']})
+    query_func = MagicMock(return_value=Table.from_pandas(df))
+    query_params = {'param1': 'value1', 'refresh_rate': None,
+                    'refresh': False}
+    records = []
+    sql.metrics.add_hook(records.append)
+    sql.fetch_sync(query_func, 'test_table', query_params, None)
+    # Row 1 changed, row 2 dropped and row 4 added
+    changed = pd.DataFrame({'__row': ['1', '3', '4'],
+                            'col1': ['x', 'c', 'd']})
+    query_func.return_value = Table.from_pandas(changed)
+    result = sql.fetch_sync(query_func, 'test_table', query_params, None,
+                            refresh=True)
+    pd.testing.assert_frame_equal(result, changed)
+    assert "_astrostash_rowhash" not in result.columns
+    counts = records[-1].counts
+    assert counts["rows_inserted"] == 1
+    assert counts["rows_updated"] == 1
+    assert counts["rows_deleted"] == 1
+    assert counts["rows_written"] == 2
+    # The dropped row stays stashed for other queries
+    assert len(pd.read_sql("SELECT * FROM test_table", sql.conn)) == 4
+
+
+def test_stash_table_legacy_duplicates(setup_sqlite_db):
+    sql = setup_sqlite_db[0]
+    legacy = pd.DataFrame({'__row': ['1', '1', '2'],
+                           'col1': ['old', 'new', 'b'],
+                           'ra': [50.0, 10.0, 11.0],
+                           'dec': [50.0, 20.0, 21.0]})
+    sql.ingest_table(legacy, 'test_table')
+    with pytest.warns(UserWarning, match="Dropped 1 rows of test_table"):
+        sql._stash_table(pd.DataFrame({'__row': ['3'], 'col1': ['c'],
+                                       'ra': [12.0], 'dec': [22.0]}),
+                         'test_table', '__row')
+    stashed = pd.read_sql("SELECT * FROM test_table", sql.conn)
+    assert stashed['__row'].to_list() == ['1', '2', '3']
+    assert stashed['col1'].to_list() == ['new', 'b', 'c']
+    # The dropped row is not in the spatial index
+    assert sql.cone_search('test_table', 50, 50, 1).empty
+    assert sql.cone_search('test_table', 10, 20, 1)['col1'].to_list() \
+        == ['new']
+    assert sql.drop_duplicate_ids('test_table', '__row') == 0
+
+
+def test_drop_duplicate_ids_null(setup_sqlite_db):
+    sql = setup_sqlite_db[0]
+    legacy = pd.DataFrame({'__row': ['1', '1', None, None],
+                           'col1': ['old', 'new', 'x', 'y']})
+    sql.ingest_table(legacy, 'test_table')
+    with pytest.warns(UserWarning, match="Dropped 1 rows of test_table"):
+        assert sql.drop_duplicate_ids('test_table', '__row') == 1
+    # Rows without an id are not duplicates of each other
+    stashed = pd.read_sql("SELECT * FROM test_table", sql.conn)
+    assert stashed['col1'].to_list() == ['new', 'x', 'y']
+
+
+def test_get_stashed_rows(setup_sqlite_db):
+    sql = setup_sqlite_db[0]
+    df = pd.DataFrame({'obsid': [10, 20, 30], 'col1': ['a', 'b', 'c']})
+    sql._stash_table(df, 'test_table', 'obsid')
+    qid = sql.insert_query(astrostash.sha256sum({'q': 1}), None)
+    rid = sql.insert_response('response-hash')
+    sql.insert_query_response_pivot(qid, rid)
+    # rowids are stored as text in the pivot table, but still match the
+    # integer id column of the catalog
+    for rowid in ['10', '30']:
+        sql.insert_response_rowid_pivot(rid, rowid)
+    rows = sql._get_stashed_rows('test_table', qid, 'obsid')
+    expected = pd.DataFrame({'obsid': [10, 30], 'col1': ['a', 'c']})
+    pd.testing.assert_frame_equal(rows, expected)
+
+
+def test_insert_response_rowid_pivots(setup_sqlite_db):
+    sql = setup_sqlite_db[0]
+    rid = sql.insert_response('response-hash')
+    sql.insert_response_rowid_pivots(rid, [1, 2, 3])
+    rows = pd.read_sql("SELECT * FROM response_rowid_pivot", sql.conn)
+    assert rows['rowid'].to_list() == ['1', '2', '3']
+    assert sql.conn.in_transaction is False
+
+
+def test_transaction_rollback(setup_sqlite_db):
+    sql = setup_sqlite_db[0]
+    with pytest.raises(RuntimeError):
+        with sql.transaction():
+            sql.insert_query('hash1', None)
+            with sql.transaction():
+                sql.insert_response('hash2')
+            raise RuntimeError("failed ingest")
+    assert sql.get_query('hash1').empty
+    assert sql._get_response_id('hash2') is None
+
+
+def test_fetch_sync_atomic(setup_sqlite_db):
+    sql = setup_sqlite_db[0]
+    query_params = {'param1': 'value1', 'refresh_rate': None,
+                    'refresh': False}
+    # A failed remote call leaves no query behind
+    failing_query_func = MagicMock(side_effect=ConnectionError)
+    with pytest.raises(ConnectionError):
+        sql.fetch_sync(failing_query_func, 'test_table',
+                       query_params.copy(), None)
+    assert sql.get_query(astrostash.sha256sum({'param1': 'value1'})).empty
+    # Neither does a failed stash of the response
+    mock_df = pd.DataFrame({'__row': ['1', '2'], 'col1': ['a', 'b']})
+    query_func = MagicMock(return_value=Table.from_pandas(mock_df))
+    sql._stash_table = MagicMock(side_effect=sqlite3.OperationalError)
+    with pytest.raises(sqlite3.OperationalError):
+        sql.fetch_sync(query_func, 'test_table', query_params.copy(), None)
+    assert sql.get_query(astrostash.sha256sum({'param1': 'value1'})).empty
+    assert len(pd.read_sql("SELECT * FROM responses", sql.conn)) == 0
+
+
+def test_index_management(setup_sqlite_db):
+    sql = setup_sqlite_db[0]
+    df = pd.DataFrame({'obsid': ['1', '2'], 'ra': [83.6, 83.7],
+                       'dec': [22.0, 22.1], 'exposure': [10.0, 20.0]})
+    sql._stash_table(df, 'nicermastr', 'obsid')
+    indexes = sql.list_indexes('nicermastr')
+    assert indexes['name'].to_list() == ['ix_nicermastr_dec',
+                                         'ix_nicermastr_ra',
+                                         'ux_nicermastr_obsid']
+    assert indexes['unique'].to_list() == [False, False, True]
+    name = sql.create_index('nicermastr', ['ra', 'exposure'])
+    assert name == 'ix_nicermastr_ra_exposure'
+    assert sql.list_indexes('nicermastr').iloc[2]['columns'] == 'ra,exposure'
+    sql.drop_index(name)
+    assert name not in sql.list_indexes()['name'].values
+    with pytest.raises(ValueError):
+        sql.create_index('nicermastr', 'xxx')
+    # The planner uses the indexes for id and pivot lookups
+    plan = sql.explain_query_plan(
+        """SELECT * FROM nicermastr WHERE obsid IN (
+               SELECT rrp.rowid FROM response_rowid_pivot rrp
+               INNER JOIN query_response_pivot qrp
+               ON qrp.responseid = rrp.responseid
+               WHERE qrp.queryid = :queryid);""",
+        {"queryid": 1})
+    details = " ".join(plan['detail'])
+    assert "SCAN nicermastr" not in details
+    assert "ux_nicermastr_obsid" in details
+    plan = sql.explain_query_plan(
+        "SELECT * FROM response_rowid_pivot WHERE rowid = '1';")
+    assert "ix_response_rowid_pivot_rowid" in plan['detail'].iloc[0]
+
+
+def test_fetch_sync_result_cache(setup_sqlite_db):
+    sql = setup_sqlite_db[0]
+    mock_df = pd.DataFrame({'__row': ['1', '2'], 'col1': ['a', 'b']})
+    query_func = MagicMock(return_value=Table.from_pandas(mock_df))
+
+    def fetch(refresh=False, refresh_rate=None):
+        query_params = {'param1': 'value1', 'refresh_rate': refresh_rate,
+                        'refresh': refresh}
+        return sql.fetch_sync(query_func, 'test_table', query_params,
+                              refresh_rate, refresh=refresh)
+
+    fetch()
+    assert sql.result_cache.stats()['misses'] == 1
+    sql.get_query = MagicMock(side_effect=AssertionError)
+    cached = fetch()
+    pd.testing.assert_frame_equal(cached, mock_df)
+    assert sql.result_cache.stats()['hits'] == 1
+    # Mutating a served frame does not change the cached one
+    cached.loc[0, 'col1'] = 'z'
+    pd.testing.assert_frame_equal(fetch(), mock_df)
+    del sql.get_query
+    # A refresh rewrites the catalog, so the cached result is replaced
+    mock_df2 = pd.DataFrame({'__row': ['1', '2'], 'col1': ['a', 'c']})
+    query_func.return_value = Table.from_pandas(mock_df2)
+    pd.testing.assert_frame_equal(fetch(refresh=True), mock_df2)
+    pd.testing.assert_frame_equal(fetch(), mock_df2)
+    # Changing the refresh rate goes through the database
+    fetch(refresh_rate=3)
+    assert sql.result_cache.get(
+        astrostash.sha256sum({'param1': 'value1'}))['refresh_rate'] == 3
+
+
+def test_fetch_sync_many(setup_sqlite_db):
+    sql = setup_sqlite_db[0]
+    frames = {
+        'a': pd.DataFrame({'__row': ['1', '2'], 'col1': ['a', 'b']}),
+        'b': pd.DataFrame({'__row': ['2', '3'], 'col1': ['b', 'c']}),
+        'c': pd.DataFrame({'__row': ['4'], 'col1': ['d']}),
+    }
+
+    def query_func(param1):
+        return Table.from_pandas(frames[param1])
+
+    mock_query_func = MagicMock(side_effect=query_func)
+
+    def params(value):
+        return {'param1': value, 'refresh_rate': None, 'refresh': False}
+
+    # Query c is already stashed, a is requested twice
+    sql.fetch_sync(mock_query_func, 'test_table', params('c'), None)
+    sql.result_cache.clear()
+    results = sql.fetch_sync_many(mock_query_func, 'test_table',
+                                  [params('a'), params('b'), params('a'),
+                                   params('c')],
+                                  None, max_workers=2)
+    assert mock_query_func.call_count == 3
+    for result, key in zip(results, ['a', 'b', 'a', 'c']):
+        pd.testing.assert_frame_equal(result, frames[key])
+    assert len(sql.get_queries([astrostash.sha256sum({'param1': key})
+                                for key in frames])) == 3
+    # Everything is now served from the stash
+    results = sql.fetch_sync_many(mock_query_func, 'test_table',
+                                  [params('b'), params('c')], None)
+    assert mock_query_func.call_count == 3
+    pd.testing.assert_frame_equal(results[0], frames['b'])
+
+
+def test_result_hasher_chunked():
+    df = pd.DataFrame({'__row': [str(i) for i in range(25)],
+                       'col1': range(25)})
+    hashers = []
+    for chunksize in [25, 10, 7]:
+        hasher = astrostash.astrostash.ResultHasher()
+        for start in range(0, len(df), chunksize):
+            hasher.update(df.iloc[start:start + chunksize])
+        hashers.append(hasher.hexdigest())
+    assert len(set(hashers)) == 1
+    changed = astrostash.astrostash.ResultHasher()
+    changed.update(df.assign(col1=df['col1'] + 1))
+    assert changed.hexdigest() != hashers[0]
+
+
+def test_fetch_sync_iter(setup_sqlite_db):
+    sql = setup_sqlite_db[0]
+    mock_df = pd.DataFrame({'__row': [str(i) for i in range(25)],
+                            'col1': [f'v{i}' for i in range(25)]})
+    query_func = MagicMock(return_value=Table.from_pandas(mock_df))
+
+    def fetch(chunksize):
+        query_params = {'param1': 'value1', 'refresh_rate': None,
+                        'refresh': False}
+        return list(sql.fetch_sync_iter(query_func, 'test_table',
+                                        query_params, None,
+                                        chunksize=chunksize))
+
+    chunks = fetch(10)
+    assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True),
+                                  mock_df)
+    assert len(pd.read_sql("SELECT * FROM responses", sql.conn)) == 1
+    assert len(pd.read_sql("SELECT * FROM response_rowid_pivot",
+                           sql.conn)) == 25
+    # Served from the stash, and shared with fetch_sync
+    chunks = fetch(20)
+    query_func.assert_called_once()
+    assert [len(chunk) for chunk in chunks] == [20, 5]
+    query_params = {'param1': 'value1', 'refresh_rate': None,
+                    'refresh': False}
+    pd.testing.assert_frame_equal(
+        sql.fetch_sync(query_func, 'test_table', query_params, None),
+        mock_df)
+    query_func.assert_called_once()
+
+
+def test_make_result_hash():
+    df = pd.DataFrame({'__row': ['1', '2'], 'col1': [1, 2]})
+    assert astrostash.make_result_hash(df) == \
+        astrostash.make_result_hash(df.copy())
+    # Column names and dtypes are part of the hash
+    assert astrostash.make_result_hash(df) != \
+        astrostash.make_result_hash(df.rename(columns={'col1': 'col2'}))
+    assert astrostash.make_result_hash(df) != \
+        astrostash.make_result_hash(df.astype({'col1': 'float64'}))
+    # The legacy hash is unchanged so old responses can still be matched
+    assert astrostash.astrostash.legacy_make_result_hash(df) == \
+        "9866c5f0dbb7b504422184948d35f90ca6a9e0a8deb502b9a4ec41c729ec5c7b"
+
+
+def test_legacy_response_only_for_linked_queries(setup_sqlite_db):
+    sql = setup_sqlite_db[0]
+    df = pd.DataFrame({'__row': ['1', '2'], 'col1': [1, 2]})
+    legacy_hash = astrostash.astrostash.legacy_make_result_hash(df)
+    qid = sql.insert_query("legacy query", None)
+    with sql.transaction():
+        sql.cursor.execute("INSERT INTO responses (hash, hash_version) "
+                           "VALUES (:hash, 1);", {"hash": legacy_hash})
+        rid = sql.cursor.lastrowid
+    sql.insert_query_response_pivot(qid, rid)
+    legacy = "astrostash.astrostash.legacy_make_result_hash"
+    # Queries not linked to a legacy response never pay for the legacy hash
+    with patch(legacy, wraps=astrostash.astrostash.legacy_make_result_hash) \
+            as legacy_hash_func:
+        new_qid = sql.insert_query("new query", None)
+        other = df.assign(col1=[3, 4])
+        assert sql._ingest_response_and_links(other, new_qid, '__row') \
+            is True
+        legacy_hash_func.assert_not_called()
+        # The query linked to the legacy response has it upgraded
+        assert sql._ingest_response_and_links(df, qid, '__row') is False
+        legacy_hash_func.assert_called_once()
+    assert sql._get_response_id(astrostash.make_result_hash(df)) == (rid,)
+
+
+def test_schema_migrations(tmpdir):
+    db_path = str(tmpdir.join("astrostash_test.db"))
+    latest = len(astrostash.astrostash.schema_migrations())
+    sql = astrostash.SQLiteDB(db_name=db_path)
+    assert sql.get_schema_version() == latest
+    # Lazily created
+    assert sql._engine is None
+    assert sql.aconn is sql.aconn
+    sql.cursor.execute("DROP INDEX ix_response_rowid_pivot_rowid;")
+    sql.close()
+    # Up to date, so the schema is not run again
+    sql = astrostash.SQLiteDB(db_name=db_path)
+    assert "ix_response_rowid_pivot_rowid" \
+        not in sql.list_indexes("response_rowid_pivot")["name"].values
+    sql.close()
+
+    # Database from before the schema was versioned
+    conn = sqlite3.connect(db_path)
+    conn.executescript("""DROP TABLE responses;
+                          CREATE TABLE responses (
+                              id INTEGER PRIMARY KEY,
+                              hash TEXT NOT NULL,
+                              UNIQUE (hash)
+                          );
+                          INSERT INTO responses (hash) VALUES ('abc');
+                          PRAGMA user_version = 0;""")
+    conn.close()
+    sql = astrostash.SQLiteDB(db_name=db_path)
+    assert sql.get_schema_version() == latest
+    assert "ix_response_rowid_pivot_rowid" \
+        in sql.list_indexes("response_rowid_pivot")["name"].values
+    responses = pd.read_sql("SELECT * FROM responses", sql.conn)
+    assert responses["hash_version"].to_list() == [1]
+    sql.close()
+
+
+def _brute_cone(df, ra, dec, radius):
+    center = SkyCoord(ra, dec, unit="deg")
+    sep = SkyCoord(df["ra"], df["dec"], unit="deg").separation(center)
+    return sorted(df["__row"][sep.deg <= radius])
+
+
+def test_cone_search(setup_sqlite_db):
+    sql, _ = setup_sqlite_db
+    rng = np.random.default_rng(42)
+    n = 2000
+    df = pd.DataFrame({"__row": [f"r{i}" for i in range(n)],
+                       "ra": rng.uniform(0, 360, n),
+                       "dec": np.degrees(np.arcsin(rng.uniform(-1, 1, n)))})
+    sql._stash_table(df, "cat", "__row")
+    assert sql.get_spatial_index("cat") == "rtree_cat"
+    cones = [(10, 20, 5), (359.5, -10, 8), (0, 89, 3), (180, 0, 0.5)]
+    for ra, dec, radius in cones:
+        found = sql.cone_search("cat", ra, dec, radius)
+        assert sorted(found["__row"]) == _brute_cone(df, ra, dec, radius)
+    plan = sql.explain_query_plan(
+        "SELECT id FROM rtree_cat WHERE maxx >= 0 AND minx <= 0.1")
+    assert plan["detail"].str.contains("VIRTUAL TABLE INDEX").any()
+    # Moved rows are reindexed when stashed again
+    moved = df.iloc[:50].assign(ra=10.0, dec=20.0)
+    sql._stash_table(moved, "cat", "__row")
+    df = pd.concat([moved, df.iloc[50:]], ignore_index=True)
+    found = sql.cone_search("cat", 10, 20, 5)
+    assert sorted(found["__row"]) == _brute_cone(df, 10, 20, 5)
+    # Keyed on the id column, so renumbered rowids (which VACUUM may do)
+    # do not matter
+    sql.cursor.execute("UPDATE cat SET rowid = rowid + 100000;")
+    sql.conn.commit()
+    for ra, dec, radius in cones:
+        found = sql.cone_search("cat", ra, dec, radius)
+        assert sorted(found["__row"]) == _brute_cone(df, ra, dec, radius)
+    sql._stash_table(pd.DataFrame({"__row": ["a"]}), "nopos", "__row")
+    assert sql.get_spatial_index("nopos") is None
+    with pytest.raises(ValueError):
+        sql.create_spatial_index("nopos")
+
+
+def test_rowid_spatial_index_rebuilt(tmpdir):
+    db_path = str(tmpdir.join("astrostash_test.db"))
+    sql = astrostash.SQLiteDB(db_name=db_path)
+    df = pd.DataFrame({"__row": ["a", "b"], "ra": [10.0, 50.0],
+                       "dec": [20.0, -30.0]})
+    sql._stash_table(df, "cat", "__row")
+    sql.close()
+    # Spatial index from before indexes were keyed on the id column, with
+    # its rowids out of date
+    conn = sqlite3.connect(db_path)
+    conn.executescript("""DROP TABLE rtree_cat;
+                          DROP TABLE rtree_cat_ids;
+                          DROP TABLE spatial_indexes;
+                          CREATE TABLE spatial_indexes (
+                              catalog TEXT PRIMARY KEY,
+                              rtree TEXT NOT NULL,
+                              UNIQUE (rtree)
+                          );
+                          CREATE VIRTUAL TABLE rtree_cat USING rtree(
+                              id, minx, maxx, miny, maxy, minz, maxz);
+                          INSERT INTO rtree_cat SELECT rowid + 1, 0, 0,
+                              0, 0, 0, 0 FROM cat;
+                          INSERT INTO spatial_indexes
+                          VALUES ('cat', 'rtree_cat');
+                          PRAGMA user_version = 4;""")
+    conn.close()
+    sql = astrostash.SQLiteDB(db_name=db_path)
+    assert sql.get_spatial_index("cat") is None
+    assert sql.cone_search("cat", 10, 20, 1)["__row"].to_list() == ["a"]
+    assert sql.get_spatial_index("cat") == "rtree_cat"
+    sql.close()
+
+
+def test_fetch_sync_footprint(setup_sqlite_db):
+    sql = setup_sqlite_db[0]
+    big = pd.DataFrame({"__row": ["a", "b", "c"],
+                        "ra": [10.0, 10.5, 14.0],
+                        "dec": [20.0, 20.0, 20.0]})
+    # Row near the cone stashed by another query only
+    other = pd.DataFrame({"__row": ["d"], "ra": [10.2], "dec": [20.1]})
+    query_func = MagicMock(return_value=Table.from_pandas(big))
+
+    def fetch(ra, radius, refresh_rate=None, policy=None):
+        params = {"ra": ra, "radius": radius,
+                  "refresh_rate": refresh_rate, "refresh": False}
+        return sql.fetch_sync(query_func, "cat", params, refresh_rate,
+                              refresh_policy=policy,
+                              footprint=("sig", ra, 20.0, radius),
+                              row_limit=lambda: 10)
+
+    fetch(10.0, 5.0)
+    sql.fetch_sync(MagicMock(return_value=Table.from_pandas(other)), "cat",
+                   {"other": 1, "refresh_rate": None, "refresh": False},
+                   None)
+    assert sql.get_footprint(1) is not None
+    covered = fetch(10.2, 1.0)
+    assert query_func.call_count == 1
+    assert sorted(covered["__row"]) == ["a", "b"]
+    assert sql.metrics.snapshot()["outcomes"]["covered"] == 1
+    # Cached under its own hash
+    fetch(10.2, 1.0)
+    assert sql.footprint_stats() == {"lookups": 2, "covered": 1}
+    # A stale covering query is only served under cache-only
+    sql.cursor.execute("UPDATE queries SET last_refreshed = '2020-01-01';")
+    sql.conn.commit()
+    assert sorted(fetch(10.1, 1.0, 1, "cache-only")["__row"]) == ["a", "b"]
+    fetch(10.1, 1.0, 1)
+    assert query_func.call_count == 2
+
+
+def test_fetch_sync_refresh_policy(setup_sqlite_db):
+    sql = setup_sqlite_db[0]
+    old_df = pd.DataFrame({'__row': ['1', '2'], 'col1': ['a', 'b']})
+    new_df = pd.DataFrame({'__row': ['1', '2'], 'col1': ['a', 'c']})
+    release = threading.Event()
+
+    def slow_query(**params):
+        release.wait(5)
+        return Table.from_pandas(new_df)
+
+    query_func = MagicMock(return_value=Table.from_pandas(old_df))
+
+    def fetch(policy, param='value1'):
+        query_params = {'param1': param, 'refresh_rate': 1,
+                        'refresh': False}
+        return sql.fetch_sync(query_func, 'test_table', query_params, 1,
+                              refresh_policy=policy)
+
+    with pytest.raises(ValueError):
+        fetch('cache-only')
+    with pytest.raises(ValueError):
+        fetch('sometimes')
+    fetch('blocking')
+    sql.cursor.execute("UPDATE queries SET last_refreshed = '2020-01-01';")
+    sql.conn.commit()
+    sql.result_cache.clear()
+    query_func.side_effect = slow_query
+    # Stale rows are served right away, and refreshed once in the background
+    pd.testing.assert_frame_equal(fetch('stale-while-revalidate'), old_df)
+    pd.testing.assert_frame_equal(fetch('stale-while-revalidate'), old_df)
+    pd.testing.assert_frame_equal(fetch('cache-only'), old_df)
+    assert len(sql.pending_refreshes()) == 1
+    release.set()
+    assert sql.wait_for_refreshes(timeout=5) == []
+    assert sql.pending_refreshes() == {}
+    assert query_func.call_count == 2
+    pd.testing.assert_frame_equal(fetch('cache-only'), new_df)
+    assert sql.get_query(astrostash.sha256sum({'param1': 'value1'}))[
+        'last_refreshed'].iloc[0] == datetime.today().strftime('%Y-%m-%d')
+    # Failed refreshes are reported
+    sql.cursor.execute("UPDATE queries SET last_refreshed = '2020-01-01';")
+    sql.conn.commit()
+    sql.result_cache.clear()
+    query_func.side_effect = ConnectionError
+    pd.testing.assert_frame_equal(fetch('stale-while-revalidate'), new_df)
+    errors = sql.wait_for_refreshes(timeout=5)
+    assert [type(e) for e in errors] == [ConnectionError]
+
+
+def test_fetch_sync_explicit_refresh_policy(setup_sqlite_db):
+    sql = setup_sqlite_db[0]
+    old_df = pd.DataFrame({'__row': ['1', '2'], 'col1': ['a', 'b']})
+    new_df = pd.DataFrame({'__row': ['1', '2'], 'col1': ['a', 'c']})
+    query_func = MagicMock(return_value=Table.from_pandas(old_df))
+
+    def fetch(policy, refresh):
+        query_params = {'param1': 'value1', 'refresh_rate': 1,
+                        'refresh': refresh}
+        return sql.fetch_sync(query_func, 'test_table', query_params, 1,
+                              refresh=refresh, refresh_policy=policy)
+
+    fetch('blocking', False)
+    sql.cursor.execute("UPDATE queries SET last_refreshed = '2020-01-01';")
+    sql.conn.commit()
+    query_func.return_value = Table.from_pandas(new_df)
+    # An explicit refresh is not served stale
+    with pytest.raises(ValueError):
+        fetch('cache-only', True)
+    pd.testing.assert_frame_equal(fetch('stale-while-revalidate', True),
+                                  new_df)
+    assert query_func.call_count == 2
+    assert sql.pending_refreshes() == {}
+
+
+def test_fetch_sync_unchanged_refresh(setup_sqlite_db):
+    sql = setup_sqlite_db[0]
+    df = pd.DataFrame({'__row': ['1', '2'], 'col1': ['a', 'b']})
+    query_func = MagicMock(return_value=Table.from_pandas(df))
+    query_params = {'param1': 'value1', 'refresh_rate': None,
+                    'refresh': True}
+    records = []
+    sql.metrics.add_hook(records.append)
+    sql.fetch_sync(query_func, 'test_table', query_params, None)
+    version = sql.table_version('test_table')
+    sql.cursor.execute("UPDATE queries SET last_refreshed = '2020-01-01';")
+    sql.conn.commit()
+    result = sql.fetch_sync(query_func, 'test_table', query_params, None,
+                            refresh=True)
+    pd.testing.assert_frame_equal(result, df)
+    # The unchanged response is not stashed again
+    assert sql.table_version('test_table') == version
+    assert "stash" not in records[-1].phases
+    assert records[-1].counts["unchanged_refreshes"] == 1
+    assert sql.refresh_stats() == {"refreshes": 1, "unchanged": 1}
+    assert sql.get_query(astrostash.sha256sum({'param1': 'value1'}))[
+        'last_refreshed'].iloc[0] == datetime.today().strftime('%Y-%m-%d')
+    # A changed response is
+    query_func.return_value = Table.from_pandas(df.assign(col1=['a', 'c']))
+    result = sql.fetch_sync(query_func, 'test_table', query_params, None,
+                            refresh=True)
+    assert result['col1'].to_list() == ['a', 'c']
+    assert sql.table_version('test_table') == version + 1
+    assert sql.refresh_stats() == {"refreshes": 2, "unchanged": 1}
+
+
+def test_refresh_stale(setup_sqlite_db):
+    sql = setup_sqlite_db[0]
+    position = SkyCoord(83.63308, 22.01450, unit="deg")
+
+    def query(position=None, radius=None, kwargs=None, version=1):
+        return Table({'__row': ['1', '2'],
+                      'ra': [position.ra.deg] * 2,
+                      'version': [version] * 2})
+
+    funcs = {"query": MagicMock(side_effect=query)}
+    for radius in ("1 deg", "2 deg", "3 deg"):
+        query_params = {'position': position, 'radius': radius,
+                        'kwargs': {}, 'refresh_rate': 1, 'refresh': False}
+        sql.fetch_sync(funcs["query"], 'cat_' + radius[0], query_params, 1,
+                       call_name="query" if radius != "3 deg" else "other")
+    call = sql.get_query_call(1)
+    assert call["method"] == "query"
+    assert call["params"]["position"].separation(position).deg < 1e-9
+    assert sql.get_stale_queries().empty
+    sql.cursor.execute("UPDATE queries SET last_refreshed = '2020-01-01';")
+    sql.conn.commit()
+    assert sql.get_stale_queries()["id"].to_list() == [1, 2, 3]
+    funcs["query"] = MagicMock(side_effect=lambda **params: query(
+        **params, version=2))
+    summary = sql.refresh_stale(funcs, max_workers=2, batch_size=1)
+    assert sorted(summary["refreshed"]) == [1, 2]
+    assert summary["unchanged"] == []
+    assert summary["failed"] == {}
+    assert summary["skipped"] == [3]
+    assert funcs["query"].call_count == 2
+    assert pd.read_sql("SELECT version FROM cat_1",
+                       sql.conn)["version"].to_list() == [2, 2]
+    assert sql.get_stale_queries()["id"].to_list() == [3]
+    # Unchanged responses are reported
+    sql.cursor.execute("UPDATE queries SET last_refreshed = '2020-01-01' "
+                       "WHERE id = 1;")
+    sql.conn.commit()
+    summary = sql.refresh_stale(funcs)
+    assert summary["refreshed"] == [1]
+    assert summary["unchanged"] == [1]
+    assert sql.refresh_stats() == {"refreshes": 3, "unchanged": 1}
+    # Failures are reported and the query stays stale
+    sql.cursor.execute("UPDATE queries SET last_refreshed = '2020-01-01';")
+    sql.conn.commit()
+    funcs["query"] = MagicMock(side_effect=ConnectionError)
+    summary = sql.refresh_stale(funcs)
+    assert list(summary["failed"]) == [1, 2]
+    assert sql.get_stale_queries()["id"].to_list() == [1, 2, 3]
@@ -0,0 +1,52 @@
+from astrostash.cache import ResultCache
+import pandas as pd
+
+
+def make_frame(nrows):
+    return pd.DataFrame({'__row': [str(i) for i in range(nrows)],
+                         'col1': range(nrows)})
+
+
+def test_lru_eviction():
+    cache = ResultCache(max_entries=2)
+    for key in ['a', 'b']:
+        cache.put(key, make_frame(2), 'test_table', 1, '2025-01-01', None)
+    # Touch a so b is the least recently used
+    assert cache.get('a') is not None
+    cache.put('c', make_frame(2), 'test_table', 3, '2025-01-01', None)
+    assert 'a' in cache and 'c' in cache
+    assert 'b' not in cache
+    assert cache.get('b') is None
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+    assert cache.stats()['evictions'] == 1
+
+
+def test_byte_limit():
+    small = make_frame(10)
+    nbytes = int(small.memory_usage(index=True, deep=True).sum())
+    cache = ResultCache(max_bytes=nbytes * 2)
+    cache.put('a', small, 'test_table', 1, '2025-01-01', None)
+    cache.put('b', small, 'test_table', 2, '2025-01-01', None)
+    assert len(cache) == 2
+    cache.put('c', small, 'test_table', 3, '2025-01-01', None)
+    assert len(cache) == 2
+    assert cache.stats()['bytes'] == nbytes * 2
+    # Results bigger than the whole cache are never cached
+    cache.put('d', make_frame(1000), 'test_table', 4, '2025-01-01', None)
+    assert 'd' not in cache
+
+
+def test_invalidation():
+    cache = ResultCache()
+    cache.put('a', make_frame(2), 'table1', 1, '2025-01-01', None)
+    cache.put('b', make_frame(2), 'table2', 2, '2025-01-01', None)
+    cache.put('c', make_frame(2), 'table2', 3, '2025-01-01', None)
+    cache.invalidate_table('table2')
+    assert len(cache) == 1
+    cache.invalidate_query(1)
+    assert len(cache) == 0
+    cache.put('a', make_frame(2), 'table1', 1, '2025-01-01', None)
+    assert cache.get('a', lambda entry: False) is None
+    assert 'a' not in cache
+    assert cache.stats()['bytes'] == 0
@@ -0,0 +1,26 @@
+from astrostash import cli
+from astrostash.heasarc import Heasarc
+from unittest.mock import patch
+
+
+def test_refresh_dry_run(tmp_path, capsys):
+    db_path = str(tmp_path / "test.db")
+    assert cli.main(["refresh", "--db", db_path, "--dry-run"]) == 0
+    assert capsys.readouterr().out.strip() == "0 stale queries"
+
+
+def test_refresh(tmp_path, capsys):
+    db_path = str(tmp_path / "test.db")
+    summary = {"refreshed": [1, 2], "unchanged": [2], "failed": {},
+               "skipped": [3]}
+    with patch.object(Heasarc, "refresh_stale",
+                      return_value=summary) as refresh_stale:
+        assert cli.main(["refresh", "--db", db_path,
+                         "--max-workers", "2", "--batch-size", "10"]) == 0
+    refresh_stale.assert_called_once_with(max_workers=2, batch_size=10)
+    assert capsys.readouterr().out.strip() \
+        == "2 refreshed (1 unchanged), 0 failed, 1 skipped"
+    summary["failed"] = {4: ConnectionError()}
+    with patch.object(Heasarc, "refresh_stale", return_value=summary):
+        assert cli.main(["refresh", "--db", db_path]) == 1
+    assert "query 4 failed" in capsys.readouterr().err
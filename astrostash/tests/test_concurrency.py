@@ -0,0 +1,160 @@
+import astrostash
+import multiprocessing as mp
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from astropy.table import Table
+
+
+N_QUERIES = 10
+N_ROWS = 50
+
+
+def _fake_query(ra, catalog):
+    names = [f"{catalog}_{ra}_{i}" for i in range(N_ROWS)]
+    return Table({"name": names,
+                  "ra": [float(ra)] * N_ROWS,
+                  "dec": [float(i) for i in range(N_ROWS)]})
+
+
+def _worker(db_path, n_fetches, offset):
+    """
+    Runs n_fetches queries against a shared database, overlapping with the
+    queries of the other workers
+
+    Returns
+    -------
+    list, messages of the sqlite3 errors raised by the fetches
+    """
+    ldb = astrostash.SQLiteDB(db_name=db_path, profile="concurrent",
+                              cache_entries=0)
+    errors = []
+    try:
+        for i in range(n_fetches):
+            ra = (i + offset) % N_QUERIES
+            params = {"ra": ra, "catalog": "stress",
+                      "refresh_rate": None, "refresh": False}
+            try:
+                df = ldb.fetch_sync(_fake_query, "stress", params, None,
+                                    idcol="name")
+            except sqlite3.Error as e:
+                errors.append(str(e))
+                continue
+            assert len(df) == N_ROWS
+            assert set(df["ra"]) == {float(ra)}
+    finally:
+        ldb.close()
+    return errors
+
+
+def test_pragma_profiles(tmp_path):
+    ldb = astrostash.SQLiteDB(db_name=str(tmp_path / "test.db"),
+                              profile="concurrent",
+                              pragmas={"cache_size": -1024})
+    pragmas = ldb.get_pragmas()
+    assert pragmas["journal_mode"] == "wal"
+    assert pragmas["busy_timeout"] == 30000
+    assert pragmas["cache_size"] == -1024
+    ldb.close()
+    with pytest.raises(ValueError):
+        astrostash.SQLiteDB(db_name=str(tmp_path / "test.db"),
+                            profile="fastest")
+    with pytest.raises(ValueError):
+        astrostash.SQLiteDB(db_name=str(tmp_path / "test.db"),
+                            pragmas={"locking_mode": "EXCLUSIVE"})
+
+
+def test_reader_not_blocked_by_writer(tmp_path):
+    db_path = str(tmp_path / "test.db")
+    writer = astrostash.SQLiteDB(db_name=db_path, profile="concurrent")
+    reader = astrostash.SQLiteDB(db_name=db_path, profile="concurrent",
+                                 pragmas={"busy_timeout": 0})
+    writer.insert_query("committed", None)
+    with writer.transaction():
+        writer.insert_query("uncommitted", None)
+        # The write lock is held, reads still go through immediately and
+        # only see committed data
+        assert len(reader.get_query("committed")) == 1
+        assert reader.get_query("uncommitted").empty
+    assert len(reader.get_query("uncommitted")) == 1
+    writer.close()
+    reader.close()
+
+
+def test_multiprocess_stress(tmp_path):
+    n_procs = 4
+    n_fetches = 25
+    db_path = str(tmp_path / "stress.db")
+    # Create the schema up front, as a fresh deployment would
+    astrostash.SQLiteDB(db_name=db_path, profile="concurrent").close()
+    ctx = mp.get_context("spawn")
+    with ctx.Pool(n_procs) as pool:
+        errors = pool.starmap(_worker, [(db_path, n_fetches, i)
+                                        for i in range(n_procs)])
+    # No worker hit "database is locked" or any other sqlite3 error
+    assert [e for worker in errors for e in worker] == []
+
+    ldb = astrostash.SQLiteDB(db_name=db_path, profile="concurrent")
+
+    def count(table):
+        return ldb.cursor.execute(
+            f"SELECT COUNT(*) FROM {table};").fetchone()[0]
+
+    # Every query, response, row and link is stashed exactly once
+    assert count("queries") == N_QUERIES
+    assert count("responses") == N_QUERIES
+    assert count("query_response_pivot") == N_QUERIES
+    assert count("response_rowid_pivot") == N_QUERIES * N_ROWS
+    assert count("stress") == N_QUERIES * N_ROWS
+    ldb.close()
+
+
+def test_thread_safe_shared_instance(tmp_path):
+    ldb = astrostash.SQLiteDB(db_name=str(tmp_path / "test.db"),
+                              thread_safe=True)
+    barrier = threading.Barrier(8)
+
+    def work(offset):
+        barrier.wait()
+        conns = set()
+        for i in range(20):
+            ra = (i + offset) % N_QUERIES
+            params = {"ra": ra, "catalog": "stress",
+                      "refresh_rate": None, "refresh": False}
+            df = ldb.fetch_sync(_fake_query, "stress", params, None,
+                                idcol="name")
+            assert len(df) == N_ROWS
+            assert set(df["ra"]) == {float(ra)}
+            conns.add(id(ldb.conn))
+        return conns
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        conns = list(pool.map(work, range(8)))
+    # Every thread read through its own connection
+    assert all(len(c) == 1 for c in conns)
+    assert len(set.union(*conns)) == 8
+    assert id(ldb._writer_conn) not in set.union(*conns)
+    assert ldb.cursor.execute(
+        "SELECT COUNT(*) FROM queries;").fetchone()[0] == N_QUERIES
+    assert ldb.result_cache.stats()["hits"] > 0
+    ldb.close()
+
+
+def test_thread_safe_inserted_ids(tmp_path):
+    ldb = astrostash.SQLiteDB(db_name=str(tmp_path / "test.db"),
+                              thread_safe=True)
+    assert ldb.insert_query("hash1", None) == 1
+    assert ldb.insert_response("rhash1") == 1
+    assert ldb.insert_local_data_path("cat", "1", "/data/1") == 1
+
+    def insert(i):
+        return ldb.insert_query(f"hash{i}", None)
+
+    # Each thread gets the id of its own insert
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        qids = list(pool.map(insert, range(2, 42)))
+    assert sorted(qids) == list(range(2, 42))
+    for i, qid in zip(range(2, 42), qids):
+        assert int(ldb.get_query(f"hash{i}")["id"].iloc[0]) == qid
+    ldb.close()
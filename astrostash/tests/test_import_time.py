@@ -0,0 +1,67 @@
+import os
+import shutil
+import subprocess
+import sys
+import pathlib as pl
+import pytest
+
+
+HEAVY_MODULES = ("pandas", "sqlalchemy", "astropy", "astroquery")
+# Budget for the cumulative import time of the package itself, in
+# microseconds, far above what the lazy imports take
+IMPORT_BUDGET_US = 250000
+
+FIXTURE_DB = pl.Path(__file__).parents[1].joinpath(
+    "heasarc", "tests", "data", "processed-conflict.db")
+
+
+def _run(code: str) -> subprocess.CompletedProcess:
+    env = os.environ.copy()
+    root = str(pl.Path(__file__).parents[2])
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [root, env.get("PYTHONPATH")]))
+    return subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          capture_output=True, text=True, env=env,
+                          check=True)
+
+
+def _import_times(stderr: str) -> dict:
+    """
+    Parses the -X importtime report into cumulative microseconds by module
+    """
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        times[module.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.parametrize("module", ["astrostash", "astrostash.heasarc"])
+def test_import_time(module):
+    times = _import_times(_run(f"import {module}").stderr)
+    assert module in times
+    assert [m for m in HEAVY_MODULES if m in times] == []
+    assert times[module] < IMPORT_BUDGET_US
+
+
+def test_lazy_submodules():
+    code = ("import sys\n"
+            "import astrostash\n"
+            "assert {'cli', 'tracing'}.issubset(dir(astrostash))\n"
+            "assert 'astrostash.tracing' not in sys.modules\n"
+            "astrostash.tracing.SQLTracer\n"
+            "astrostash.cli.main\n")
+    _run(code)
+
+
+def test_cache_hit_skips_astroquery(tmp_path):
+    db_path = tmp_path / "test.db"
+    shutil.copy(FIXTURE_DB, db_path)
+    code = ("from astrostash.heasarc import Heasarc\n"
+            f"Heasarc(db_name={str(db_path)!r}).list_catalogs()\n")
+    times = _import_times(_run(code).stderr)
+    assert "pandas" in times
+    assert "astroquery" not in times
+    assert "astropy" not in times
@@ -0,0 +1,88 @@
+import astrostash
+from astrostash.metrics import LogSink, MetricsRegistry
+import json
+import logging
+import pytest
+import pandas as pd
+from astropy.table import Table
+from unittest.mock import MagicMock
+
+
+def test_registry_outside_fetch():
+    metrics = MetricsRegistry()
+    with metrics.phase("remote"):
+        metrics.count("rows", 10)
+    assert metrics.current() is None
+    assert metrics.snapshot()["fetches"] == 0
+    disabled = MetricsRegistry(enabled=False)
+    with disabled.fetch("test_table") as record:
+        assert record is None
+    assert disabled.snapshot()["fetches"] == 0
+
+
+def test_registry_hooks():
+    metrics = MetricsRegistry()
+    records = []
+    metrics.add_hook(records.append)
+    metrics.add_hook(MagicMock(side_effect=RuntimeError))
+    with pytest.raises(ValueError):
+        with metrics.fetch("test_table"):
+            metrics.set_outcome("miss")
+            with metrics.phase("remote"):
+                pass
+            raise ValueError
+    assert len(records) == 1
+    assert records[0].error == "ValueError"
+    assert records[0].duration >= records[0].phases["remote"]
+    snapshot = metrics.snapshot()
+    assert snapshot["errors"] == 1
+    assert snapshot["outcomes"] == {"miss": 1}
+    metrics.remove_hook(records.append)
+    with metrics.fetch("test_table"):
+        pass
+    assert len(records) == 1
+    metrics.reset()
+    assert metrics.snapshot()["fetches"] == 0
+
+
+def test_fetch_sync_metrics(tmp_path, caplog):
+    sql = astrostash.SQLiteDB(db_name=str(tmp_path / "test.db"))
+    records = []
+    sql.metrics.add_hook(records.append)
+    sql.metrics.add_hook(LogSink())
+    df = pd.DataFrame({'__row': ['1', '2', '3'], 'col1': [1, 2, 3]})
+    query_func = MagicMock(return_value=Table.from_pandas(df))
+    query_params = {'param1': 'value1', 'refresh_rate': None,
+                    'refresh': False}
+
+    def fetch(refresh=False):
+        return sql.fetch_sync(query_func, 'test_table', query_params, None,
+                              refresh=refresh)
+
+    with caplog.at_level(logging.INFO, logger="astrostash.metrics"):
+        fetch()
+    assert json.loads(caplog.records[0].getMessage())["outcome"] == "miss"
+    fetch()
+    sql.result_cache.clear()
+    fetch()
+    fetch(refresh=True)
+    outcomes = [r.outcome for r in records]
+    assert outcomes == ["miss", "cache_hit", "hit", "refresh"]
+    miss = records[0]
+    assert set(miss.phases) == {"hash", "result_cache", "get_query",
+                                "remote", "to_pandas", "ingest", "stash",
+                                "read"}
+    assert miss.counts["response_rows"] == 3
+    assert miss.counts["rows"] == 3
+    assert miss.counts["rows_written"] == 3
+    assert miss.counts["bytes"] > 0
+    assert "remote" not in records[1].phases
+    assert records[1].counts["rows"] == 3
+    assert "stash" not in records[2].phases
+    snapshot = sql.metrics.snapshot()
+    assert snapshot["fetches"] == 4
+    assert snapshot["phases"]["remote"]["count"] == 2
+    # The refresh response is unchanged, so no rows are written
+    assert snapshot["counts"]["rows_written"] == 3
+    assert snapshot["counts"]["unchanged_refreshes"] == 1
+    sql.close()
@@ -0,0 +1,82 @@
+import astrostash
+from astrostash.tracing import TracedConnection, full_scans, normalize_sql
+import pandas as pd
+import pytest
+import sqlite3
+import threading
+
+
+def test_full_scans():
+    sql = normalize_sql("""SELECT c.* FROM "my catalog" c
+                           INNER JOIN queries AS q ON q.id = c.qid
+                           WHERE c.ra > 1;""")
+    plan = ["SCAN c", "SEARCH q USING INTEGER PRIMARY KEY (rowid=?)"]
+    assert full_scans(sql, plan) == ["my catalog"]
+    assert full_scans("SELECT * FROM t;", ["SCAN TABLE t"]) == ["t"]
+    assert full_scans("SELECT * FROM temp.t s;", ["SCAN s"]) == ["t"]
+    assert full_scans("SELECT * FROM t ORDER BY a;",
+                      ["SCAN t USING INDEX ix_t_a"]) == []
+
+
+def test_sql_tracing(tmp_path):
+    sql = astrostash.SQLiteDB(db_name=str(tmp_path / "test.db"))
+    df = pd.DataFrame({'__row': [str(i) for i in range(100)],
+                       'name': [f'src{i}' for i in range(100)]})
+    sql._stash_table(df, 'test_table', '__row')
+    # Connections are only traced connections while tracing
+    assert type(sql.conn) is sqlite3.Connection
+    tracer = sql.start_tracing(slow_threshold=0)
+    assert isinstance(sql.conn, TracedConnection)
+    sql.cursor.execute("SELECT __row, name FROM test_table "
+                       "WHERE name = :name;",
+                       {"name": "src5"})
+    assert sql.cursor.fetchall() == [('5', 'src5')]
+    sql.get_query("nohash")
+    sql._stash_table(df, 'test_table', '__row')
+    statements = tracer.statements()
+    scan = statements["SELECT __row, name FROM test_table "
+                      "WHERE name = :name;"]
+    assert scan["calls"] == 1
+    assert scan["slow"] == 1
+    assert scan["full_scans"] == ["test_table"]
+    assert len(scan["plan"]) > 0
+    # Scans of the astrostash tables are not flagged
+    flagged = [s for s, stats in statements.items()
+               if len(stats["full_scans"]) > 0]
+    assert flagged == ["SELECT __row, name FROM test_table "
+                       "WHERE name = :name;"]
+    # Commits are counted through the trace callback
+    assert statements["COMMIT"]["calls"] > 0
+    assert statements["COMMIT"]["timed"] == 0
+    report = tracer.report(top=3)
+    assert len(report) == 3
+    assert report["total"].is_monotonic_decreasing
+    assert sql.stop_tracing() is tracer
+    assert type(sql.conn) is sqlite3.Connection
+    ntraced = len(tracer.log)
+    sql.get_query("nohash")
+    assert len(tracer.log) == ntraced
+    sql.close()
+
+
+def test_sql_tracing_thread_safe(tmp_path):
+    sql = astrostash.SQLiteDB(db_name=str(tmp_path / "test.db"),
+                              thread_safe=True)
+    sql.get_query("nohash")
+    other = threading.Thread(target=sql.get_query, args=("nohash",))
+    other.start()
+    other.join()
+    tracer = sql.start_tracing()
+    sql.get_query("nohash")
+    with sql.transaction():
+        sql.insert_query("hash", None)
+        with pytest.raises(RuntimeError):
+            sql.stop_tracing()
+    statements = tracer.statements()
+    assert any(s.startswith("SELECT") for s in statements)
+    assert any(s.startswith("INSERT INTO queries") for s in statements)
+    # Read connections are reopened by the thread using them, the other
+    # thread's connection is left as it was
+    assert [isinstance(conn, TracedConnection) for conn in sql._readers] \
+        == [False, True]
+    sql.close()
@@ -0,0 +1,342 @@
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from itertools import chain
+
+
+# Statements EXPLAIN QUERY PLAN is captured for
+_EXPLAINABLE = re.compile(r"^\s*(SELECT|INSERT|UPDATE|DELETE|REPLACE|WITH)\b",
+                          re.IGNORECASE)
+# Full table scan in a query plan, "SCAN t" without an index (SQLite >= 3.36)
+# or "SCAN TABLE t" (older versions)
+_FULL_SCAN = re.compile(r"^SCAN (?:TABLE )?(\S+)$")
+# Tables and their aliases in FROM/JOIN clauses
+_TABLE_REFS = re.compile(
+    r"\b(?:FROM|JOIN)\s+(\"(?:[^\"]|\"\")+\"|[\w.]+)"
+    r"(?:\s+(?:AS\s+)?(?!(?:WHERE|ON|USING|INNER|LEFT|CROSS|JOIN|ORDER|"
+    r"GROUP|LIMIT|WINDOW|HAVING|UNION)\b)(\w+))?",
+    re.IGNORECASE)
+
+
+def normalize_sql(sql: str) -> str:
+    """
+    Collapses the whitespace of a statement, so the same statement issued
+    from differently indented code is traced as one
+
+    Parameters
+    ----------
+    sql: str, SQL statement
+
+    Returns
+    -------
+    str, normalized statement
+    """
+    return " ".join(sql.split())
+
+
+def full_scans(sql: str, plan: list) -> list:
+    """
+    Gets the tables a query plan reads with a full table scan
+
+    Parameters
+    ----------
+    sql: str, SQL statement the plan is for
+
+    plan: list, detail of each step of the query plan
+
+    Returns
+    -------
+    list, names of the fully scanned tables
+    """
+    aliases = {}
+    for table, alias in _TABLE_REFS.findall(sql):
+        if table.startswith('"'):
+            table = table[1:-1].replace('""', '"')
+        else:
+            # Leave out the schema (e.g. temp.)
+            table = table.rsplit(".", 1)[-1]
+        aliases[alias or table] = table
+        aliases.setdefault(table, table)
+    tables = []
+    for detail in plan:
+        match = _FULL_SCAN.match(detail)
+        if match is not None:
+            tables.append(aliases.get(match.group(1), match.group(1)))
+    return tables
+
+
+class SQLTracer:
+    """
+    Records the statements run through traced connections with their
+    duration. Statements run through a cursor's execute/executemany are
+    timed, including the time spent fetching their rows with
+    fetchone/fetchmany/fetchall (as pandas.read_sql does), but not rows read
+    by iterating over the cursor. Any other statement SQLite runs (commits,
+    executescript) is only counted, through the connection's trace callback.
+    EXPLAIN QUERY PLAN is captured the first time a statement takes longer
+    than slow_threshold, and full table scans of tables not in ignore_tables
+    are flagged.
+    """
+    def __init__(self, slow_threshold: float = 0.1,
+                 ignore_tables=(), max_log: int = 10000):
+        """
+        Parameters
+        ----------
+        slow_threshold: float, optional, duration in seconds above which a
+                                         statement is slow (default 0.1)
+
+        ignore_tables: iterable, optional, tables whose full scans are not
+                                           flagged
+
+        max_log: int, optional, number of most recent statements kept in
+                                log (default 10000)
+        """
+        self.slow_threshold = slow_threshold
+        self.ignore_tables = set(ignore_tables)
+        self.log = deque(maxlen=max_log)
+        self._statements = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stats(self, sql: str) -> dict:
+        stats = self._statements.get(sql)
+        if stats is None:
+            stats = {"calls": 0, "timed": 0, "total": 0.0, "max": 0.0,
+                     "slow": 0, "plan": None, "full_scans": []}
+            self._statements[sql] = stats
+        return stats
+
+    def trace_callback(self, statement: str) -> None:
+        """
+        Trace callback of the traced connections, counts the statements not
+        run through a timed cursor
+        """
+        if getattr(self._local, "timing", False) is True:
+            return
+        sql = normalize_sql(statement)
+        with self._lock:
+            self._stats(sql)["calls"] += 1
+            self.log.append((sql, None))
+
+    def start(self, sql: str, params=None) -> dict:
+        """
+        Starts timing a statement run through a traced cursor
+
+        Parameters
+        ----------
+        sql: str, SQL statement
+
+        params: optional, parameters of the statement, used to capture the
+                          query plan
+
+        Returns
+        -------
+        dict, call with the statement, its parameters and its duration so
+              far
+        """
+        return {"sql": normalize_sql(sql), "params": params,
+                "duration": 0.0, "slow": False}
+
+    @property
+    def timing(self) -> bool:
+        """
+        Whether the calling thread is running a timed statement
+        """
+        return getattr(self._local, "timing", False)
+
+    @timing.setter
+    def timing(self, timing: bool) -> None:
+        self._local.timing = timing
+
+    def record(self, call: dict, seconds: float, conn: sqlite3.Connection,
+               calls: int = 1) -> None:
+        """
+        Adds the time spent running or fetching a statement
+
+        Parameters
+        ----------
+        call: dict, call from start
+
+        seconds: float, time spent
+
+        conn: sqlite3.Connection, connection the statement ran on, used to
+                                  capture the query plan
+
+        calls: int, optional, number of times the statement ran, 0 when
+                              adding fetch time
+        """
+        call["duration"] += seconds
+        with self._lock:
+            stats = self._stats(call["sql"])
+            stats["calls"] += calls
+            stats["timed"] += calls
+            stats["total"] += seconds
+            stats["max"] = max(stats["max"], call["duration"])
+            if calls > 0:
+                self.log.append((call["sql"], seconds))
+            slow = call["slow"] is False \
+                and call["duration"] > self.slow_threshold
+            if slow is True:
+                call["slow"] = True
+                stats["slow"] += 1
+            explain = slow is True and stats["plan"] is None
+        if explain is True:
+            self._explain(call["sql"], conn, call["params"])
+
+    def _explain(self, sql: str, conn: sqlite3.Connection, params) -> None:
+        """
+        Captures the query plan of a slow statement
+        """
+        if _EXPLAINABLE.match(sql) is None:
+            plan = []
+        else:
+            self.timing = True
+            try:
+                cursor = sqlite3.Connection.cursor(conn)
+                cursor.execute(f"EXPLAIN QUERY PLAN {sql}",
+                               params if params is not None else ())
+                plan = [row[3] for row in cursor.fetchall()]
+                cursor.close()
+            except sqlite3.Error:
+                plan = []
+            finally:
+                self.timing = False
+        scans = [table for table in full_scans(sql, plan)
+                 if table not in self.ignore_tables
+                 and not table.startswith("sqlite_")]
+        with self._lock:
+            stats = self._stats(sql)
+            stats["plan"] = plan
+            stats["full_scans"] = scans
+
+    def reset(self) -> None:
+        """
+        Clears the traced statements
+        """
+        with self._lock:
+            self._statements.clear()
+            self.log.clear()
+
+    def statements(self) -> dict:
+        """
+        Gets the statistics of each traced statement
+
+        Returns
+        -------
+        dict, calls, timed calls, total and max seconds, number of slow
+              calls, query plan (None if never slow) and fully scanned
+              tables of each normalized statement
+        """
+        with self._lock:
+            return {sql: {**stats, "full_scans": list(stats["full_scans"])}
+                    for sql, stats in self._statements.items()}
+
+    def report(self, top: int | None = None):
+        """
+        Summarizes the traced statements, slowest in total first
+
+        Parameters
+        ----------
+        top: int or None, optional, number of statements to report, all if
+                                    None
+
+        Returns
+        -------
+        pd.DataFrame, sql, calls, total, mean and max seconds, slow calls,
+                      fully scanned tables (full_scans) and query plan of
+                      each statement
+        """
+        import pandas as pd
+        rows = []
+        for sql, stats in self.statements().items():
+            timed = stats["timed"]
+            rows.append({"sql": sql,
+                         "calls": stats["calls"],
+                         "total": stats["total"],
+                         "mean": stats["total"] / timed if timed > 0 else None,
+                         "max": stats["max"],
+                         "slow": stats["slow"],
+                         "full_scans": ", ".join(stats["full_scans"]),
+                         "plan": "; ".join(stats["plan"] or [])})
+        report = pd.DataFrame(rows, columns=["sql", "calls", "total", "mean",
+                                             "max", "slow", "full_scans",
+                                             "plan"])
+        report = report.sort_values("total", ascending=False,
+                                    ignore_index=True)
+        return report if top is None else report.head(top)
+
+
+class TracedCursor(sqlite3.Cursor):
+    """
+    Cursor timing its statements with the SQLTracer of its connection, and
+    behaving as a plain sqlite3.Cursor while tracing is off. Fetching with
+    fetchone/fetchmany/fetchall is timed, iterating over the cursor is not.
+    """
+    _trace_call = None
+
+    def execute(self, sql, parameters=(), /):
+        tracer = self.connection.tracer
+        if tracer is None or tracer.timing is True:
+            return super().execute(sql, parameters)
+        self._trace_call = tracer.start(sql, parameters)
+        tracer.timing = True
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            elapsed = time.perf_counter() - start
+            tracer.timing = False
+            tracer.record(self._trace_call, elapsed, self.connection)
+
+    def executemany(self, sql, seq_of_parameters, /):
+        tracer = self.connection.tracer
+        if tracer is None or tracer.timing is True:
+            return super().executemany(sql, seq_of_parameters)
+        # Keep the first parameters, in case the plan has to be captured
+        params = iter(seq_of_parameters)
+        first = next(params, None)
+        if first is not None:
+            params = chain([first], params)
+        self._trace_call = tracer.start(sql, first)
+        tracer.timing = True
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, params)
+        finally:
+            elapsed = time.perf_counter() - start
+            tracer.timing = False
+            tracer.record(self._trace_call, elapsed, self.connection)
+
+    def _fetch(self, fetch, *args):
+        tracer = self.connection.tracer
+        if tracer is None or self._trace_call is None:
+            return fetch(*args)
+        start = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            tracer.record(self._trace_call, time.perf_counter() - start,
+                          self.connection, calls=0)
+
+    def fetchone(self):
+        return self._fetch(super().fetchone)
+
+    def fetchmany(self, *args):
+        return self._fetch(super().fetchmany, *args)
+
+    def fetchall(self):
+        return self._fetch(super().fetchall)
+
+
+class TracedConnection(sqlite3.Connection):
+    """
+    Connection whose cursors are TracedCursor, statements are traced while
+    tracer is set. SQLiteDB only opens these while tracing (see
+    SQLiteDB.start_tracing).
+    """
+    tracer = None
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
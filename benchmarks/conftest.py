@@ -0,0 +1,53 @@
+"""
+Offline benchmark suite, run with pytest-benchmark:
+
+    pytest benchmarks --benchmark-autosave
+    pytest benchmarks --benchmark-compare
+
+Every remote call is served by fake_heasarc.FakeHeasarc, so no network is
+needed and results are reproducible. Catalog sizes are set with
+ASTROSTASH_BENCH_ROWS (comma separated, default 1000,100000), e.g.
+ASTROSTASH_BENCH_ROWS=1000,100000,1000000,10000000 for the full range.
+"""
+import os
+import pytest
+from astrostash.heasarc import Heasarc
+from fake_heasarc import FakeHeasarc
+
+
+ROW_COUNTS = [int(n) for n in
+              os.environ.get("ASTROSTASH_BENCH_ROWS", "1000,100000")
+              .split(",")]
+
+
+@pytest.fixture(params=ROW_COUNTS, ids=lambda n: f"{n}rows")
+def rows(request):
+    return request.param
+
+
+@pytest.fixture
+def make_heasarc(tmp_path):
+    """
+    Makes Heasarc instances on fresh databases, served by a FakeHeasarc
+    """
+    made = []
+
+    def make(rows, **kwargs):
+        heasarc = Heasarc(db_name=str(tmp_path / f"bench{len(made)}.db"),
+                          **kwargs)
+        heasarc.aq = FakeHeasarc(rows)
+        made.append(heasarc)
+        return heasarc
+
+    yield make
+    for heasarc in made:
+        heasarc.ldb.close()
+
+
+@pytest.fixture
+def rounds(rows):
+    """
+    Number of rounds of the slow (cold/refresh) benchmarks, fewer for the
+    large catalogs
+    """
+    return max(1, min(10, 1000000 // rows))
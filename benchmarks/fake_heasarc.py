@@ -0,0 +1,96 @@
+import pathlib as pl
+import numpy as np
+from astropy.table import Table
+
+
+CATALOG = "fakecat"
+
+
+def synthetic_catalog(rows: int, seed: int = 0, version: int = 0) -> Table:
+    """
+    Builds a deterministic synthetic catalog shaped like a HEASARC master
+    catalog
+
+    Parameters:
+    rows: int, number of rows
+
+    seed: int, optional, random seed of the positions and values
+
+    version: int, optional, bumps the exposure column, so the same rows can
+                            be served with changed values
+
+    Returns:
+    `astropy.table.Table`, synthetic catalog
+    """
+    rng = np.random.default_rng(seed)
+    ids = np.arange(rows)
+    return Table({
+        "__row": ids.astype(str),
+        "name": np.char.add("SRC_", ids.astype(str)),
+        "ra": rng.uniform(0, 360, rows),
+        "dec": np.degrees(np.arcsin(rng.uniform(-1, 1, rows))),
+        "time": rng.uniform(58000, 60000, rows),
+        "obsid": np.char.add("9", ids.astype(str)),
+        "exposure": rng.uniform(100, 5000, rows) + version,
+    })
+
+
+class FakeHeasarc:
+    """
+    Offline stand-in for astroquery.heasarc.Heasarc, every query returns
+    the same synthetic catalog, so runs are reproducible without network
+    """
+    def __init__(self, rows: int = 1000, seed: int = 0):
+        """
+        Parameters:
+        rows: int, optional, number of rows returned by each query
+
+        seed: int, optional, random seed of the synthetic catalog
+        """
+        self.rows = rows
+        self.seed = seed
+        self.version = 0
+        self.calls = 0
+        self._catalog = synthetic_catalog(rows, seed)
+
+    def change(self) -> None:
+        """
+        Changes the values returned by later queries
+        """
+        self.version += 1
+        self._catalog = synthetic_catalog(self.rows, self.seed, self.version)
+
+    def list_catalogs(self, master=False, keywords=None) -> Table:
+        self.calls += 1
+        return Table({"name": [CATALOG, "xtemaster", "nicermastr"],
+                      "description": ["Synthetic catalog",
+                                      "RXTE Master Catalog",
+                                      "NICER Master Catalog"]})
+
+    def query_region(self, position=None, catalog=None, radius=None,
+                     **kwargs) -> Table:
+        self.calls += 1
+        return self._catalog.copy()
+
+    def query_tap(self, query=None, maxrec=None) -> Table:
+        self.calls += 1
+        return self._catalog.copy()
+
+    def locate_data(self, table: Table, catalog: str) -> Table:
+        self.calls += 1
+        ids = [str(row) for row in table["__row"]]
+        base = "https://heasarc.gsfc.nasa.gov/FTP/fake"
+        return Table({
+            "ID": [f"ivo://nasa.heasarc/{catalog}?{i}" for i in ids],
+            "access_url": [f"{base}/{i}/" for i in ids],
+            "aws": [f"s3://nasa-heasarc/fake/{i}/" for i in ids],
+            "sciserver": [f"/FTP/fake/{i}/" for i in ids],
+        })
+
+    def download_data(self, links, host="aws", location=".") -> None:
+        self.calls += 1
+        linkcol = "access_url" if host == "heasarc" else host
+        name = links[linkcol].split("/")[-2]
+        product = pl.Path(location).joinpath(name)
+        product.mkdir(parents=True, exist_ok=True)
+        product.joinpath("data.evt").write_bytes(b"\0" * 1024)
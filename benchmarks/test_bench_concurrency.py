@@ -0,0 +1,69 @@
+import multiprocessing as mp
+import os
+import time
+import pytest
+import astrostash
+from astropy.table import Table
+
+
+N_QUERIES = 10
+N_ROWS = 50
+N_FETCHES = 100
+
+
+def _fake_query(ra, catalog):
+    names = [f"{catalog}_{ra}_{i}" for i in range(N_ROWS)]
+    return Table({"name": names,
+                  "ra": [float(ra)] * N_ROWS,
+                  "dec": [float(i) for i in range(N_ROWS)]})
+
+
+def _worker(db_path, n_fetches, offset):
+    """
+    Runs n_fetches queries against a shared database, overlapping with the
+    queries of the other workers
+    """
+    ldb = astrostash.SQLiteDB(db_name=db_path, profile="concurrent",
+                              cache_entries=0)
+    try:
+        for i in range(n_fetches):
+            ra = (i + offset) % N_QUERIES
+            params = {"ra": ra, "catalog": "stress",
+                      "refresh_rate": None, "refresh": False}
+            ldb.fetch_sync(_fake_query, "stress", params, None, idcol="name")
+    finally:
+        ldb.close()
+    return n_fetches
+
+
+@pytest.fixture(scope="module")
+def pool():
+    """
+    Pool of worker processes, started once so interpreter start up is not
+    timed
+    """
+    n_procs = min(4, os.cpu_count() or 1)
+    with mp.get_context("spawn").Pool(n_procs) as pool:
+        pool.map(time.sleep, [0.01] * n_procs)
+        yield pool, n_procs
+
+
+@pytest.mark.parametrize("processes", ["single", "multi"])
+def test_multiprocess_throughput(benchmark, pool, processes, tmp_path):
+    """
+    N_FETCHES fetches against one database, from a single process or split
+    across the pool, compare the two to see how reads scale with processes
+    """
+    pool, n_procs = pool
+    n_procs = 1 if processes == "single" else n_procs
+    db_path = str(tmp_path / "throughput.db")
+    astrostash.SQLiteDB(db_name=db_path, profile="concurrent").close()
+
+    def run():
+        return sum(pool.starmap(_worker,
+                                [(db_path, N_FETCHES // n_procs, i)
+                                 for i in range(n_procs)]))
+
+    benchmark.extra_info["processes"] = n_procs
+    done = benchmark.pedantic(run, rounds=3)
+    assert done == N_FETCHES // n_procs * n_procs
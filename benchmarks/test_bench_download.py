@@ -0,0 +1,38 @@
+import shutil
+
+
+N_PRODUCTS = 200
+
+
+def test_download_data(benchmark, make_heasarc, tmp_path):
+    """
+    Bookkeeping overhead of downloading (instantly, from the fake) and
+    recording N_PRODUCTS data products
+    """
+    heasarc = make_heasarc(N_PRODUCTS)
+    result = heasarc.query_tap("SELECT * FROM fakecat", catalog="fakecat")
+    links = heasarc.locate_data(result, "fakecat")
+    location = tmp_path / "products"
+
+    def setup():
+        shutil.rmtree(location, ignore_errors=True)
+        heasarc.ldb.cursor.execute("DELETE FROM local_data_paths;")
+        heasarc.ldb.conn.commit()
+        return (links, "fakecat"), {"location": location}
+
+    benchmark.pedantic(heasarc.download_data, setup=setup, rounds=5)
+    assert len(heasarc.ldb.get_local_data_paths_by_catalog("fakecat")) \
+        == N_PRODUCTS
+
+
+def test_download_data_resume(benchmark, make_heasarc, tmp_path):
+    """
+    Repeated download of products already present, which are skipped
+    """
+    heasarc = make_heasarc(N_PRODUCTS)
+    result = heasarc.query_tap("SELECT * FROM fakecat", catalog="fakecat")
+    links = heasarc.locate_data(result, "fakecat")
+    heasarc.download_data(links, "fakecat", location=tmp_path)
+    calls = heasarc.aq.calls
+    benchmark(heasarc.download_data, links, "fakecat", location=tmp_path)
+    assert heasarc.aq.calls == calls
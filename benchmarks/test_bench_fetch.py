@@ -0,0 +1,92 @@
+import astrostash
+import pytest
+from astropy.coordinates import SkyCoord
+from fake_heasarc import CATALOG, synthetic_catalog
+
+
+POSITION = SkyCoord(83.63308, 22.01450, unit="deg")
+
+
+def query(heasarc, refresh=False):
+    return heasarc.query_region(POSITION, catalog=CATALOG, radius="1 deg",
+                                refresh=refresh)
+
+
+def test_fetch_sync_cold(benchmark, make_heasarc, rows, rounds):
+    """
+    First call, the response is stashed into an empty database
+    """
+    def setup():
+        heasarc = make_heasarc(rows)
+        heasarc.list_catalogs()
+        return (heasarc,), {}
+
+    result = benchmark.pedantic(query, setup=setup, rounds=rounds)
+    assert len(result) == rows
+
+
+def test_fetch_sync_warm_cache(benchmark, make_heasarc, rows):
+    """
+    Repeated call served by the in-memory result cache
+    """
+    heasarc = make_heasarc(rows)
+    query(heasarc)
+    result = benchmark(query, heasarc)
+    assert len(result) == rows
+    assert heasarc.aq.calls == 2
+
+
+def test_fetch_sync_warm_db(benchmark, make_heasarc, rows):
+    """
+    Repeated call served from the stashed rows in the database
+    """
+    heasarc = make_heasarc(rows, cache_entries=0)
+    query(heasarc)
+    result = benchmark(query, heasarc)
+    assert len(result) == rows
+    assert heasarc.aq.calls == 2
+
+
+@pytest.mark.parametrize("changed", [False, True],
+                         ids=["unchanged", "changed"])
+def test_fetch_sync_refresh(benchmark, make_heasarc, rows, rounds, changed):
+    """
+    Forced refresh, with the same or changed response
+    """
+    heasarc = make_heasarc(rows)
+    query(heasarc)
+
+    def setup():
+        if changed is True:
+            heasarc.aq.change()
+        return (heasarc,), {"refresh": True}
+
+    result = benchmark.pedantic(query, setup=setup, rounds=rounds)
+    assert len(result) == rows
+
+
+def test_stash_table(benchmark, tmp_path, rows, rounds):
+    """
+    Upsert of a response into a table already holding it
+    """
+    ldb = astrostash.SQLiteDB(db_name=str(tmp_path / "bench.db"))
+    df = synthetic_catalog(rows).to_pandas(index=False)
+    ldb._stash_table(df, CATALOG, "__row")
+    benchmark.pedantic(ldb._stash_table, args=(df, CATALOG, "__row"),
+                       rounds=rounds)
+    ldb.close()
+
+
+def test_get_stashed_rows(benchmark, make_heasarc, rows):
+    heasarc = make_heasarc(rows)
+    query(heasarc)
+    qid = heasarc.ldb.cursor.execute(
+        "SELECT MAX(id) FROM queries;").fetchone()[0]
+    result = benchmark(heasarc.ldb._get_stashed_rows, CATALOG, qid,
+                       "__row")
+    assert len(result) == rows
+
+
+def test_make_result_hash(benchmark, rows):
+    df = synthetic_catalog(rows).to_pandas(index=False)
+    benchmark(astrostash.make_result_hash, df)
@@ -0,0 +1,14 @@
+import subprocess
+import sys
+import pytest
+
+
+@pytest.mark.parametrize("module", ["astrostash", "astrostash.heasarc"])
+def test_import_time(benchmark, module):
+    """
+    Wall time of a fresh interpreter importing the package
+    """
+    benchmark.pedantic(subprocess.run,
+                       args=([sys.executable, "-c", f"import {module}"],),
+                       kwargs={"check": True},
+                       rounds=10)